@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+"""Microbenchmarks for the HTML processing code.
+
+Run from the repository, e.g.: python scripts/benchmark.py utf8
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import timeit
+import tornado.locale
+import tracemalloc
+
+from taguette import convert, database, export, extract, main as tg_main
+
+
+def make_text(length, seed=0):
+    """Make some text mixing ASCII, Arabic, CJK, and emoji.
+    """
+    rand = random.Random(seed)
+    alphabets = [
+        'abcdefghijklmnopqrstuvwxyz ',
+        'العربية ',
+        '中文文本字 ',
+        '\U0001F600\U0001F60D ',
+    ]
+    return ''.join(
+        rand.choice(rand.choice(alphabets))
+        for _ in range(length)
+    )
+
+
+def make_document(paragraphs, length, seed=0):
+    return ''.join(
+        '<p>%s <strong>%s</strong></p>\n' % (
+            make_text(length, seed + i),
+            make_text(20, seed - i),
+        )
+        for i in range(paragraphs)
+    )
+
+
+def make_highlights(html, count, seed=0):
+    rand = random.Random(seed)
+    size = extract.build_index(html)['length']
+    highlights = []
+    for _ in range(count):
+        start = rand.randrange(size - 1)
+        end = min(start + rand.randint(1, 200), size)
+        highlights.append((start, end, ['tag']))
+    return highlights
+
+
+def _scan_str_index(string, byte_index):
+    # What byte_to_str_index() used to do, for comparison
+    for idx, char in enumerate(string):
+        char_size = len(char.encode('utf-8'))
+        if char_size > byte_index:
+            return idx
+        byte_index -= char_size
+    return len(string)
+
+
+def report(name, number, seconds):
+    print("%-30s %10.3f ms" % (name, seconds * 1000.0 / number))
+
+
+def bench_utf8(args):
+    text = make_text(args.length)
+    size = len(text.encode('utf-8'))
+    rand = random.Random(1)
+    offsets = [rand.randrange(size) for _ in range(args.conversions)]
+    print("%d conversions in a text of %d characters" % (
+        args.conversions, len(text),
+    ))
+
+    def scan():
+        for offset in offsets:
+            _scan_str_index(text, offset)
+
+    def table():
+        converter = extract.Utf8Offsets(text)
+        for offset in offsets:
+            converter.str_index(offset)
+
+    assert (
+        [_scan_str_index(text, o) for o in offsets]
+        == [extract.Utf8Offsets(text).str_index(o) for o in offsets]
+    )
+    report("per-character scan", args.number,
+           timeit.timeit(scan, number=args.number))
+    report("Utf8Offsets", args.number,
+           timeit.timeit(table, number=args.number))
+
+
+def bench_highlight(args):
+    html = make_document(args.paragraphs, args.length)
+    highlights = make_highlights(html, args.highlights)
+    print("%d highlights in a document of %d bytes" % (
+        len(highlights), len(html.encode('utf-8')),
+    ))
+    for engine in extract.HIGHLIGHT_ENGINES:
+        report(
+            "highlight(engine=%r)" % engine, args.number,
+            timeit.timeit(
+                lambda: extract.highlight(
+                    html, highlights, show_tags=True, engine=engine,
+                ),
+                number=args.number,
+            ),
+        )
+
+
+def make_page(paragraphs, length, seed=0):
+    """Make a document looking like what Calibre outputs.
+    """
+    rand = random.Random(seed)
+    body = []
+    for i in range(paragraphs):
+        text = make_text(length, seed + i)
+        kind = rand.randrange(4)
+        if kind == 0:
+            body.append(
+                '<div class="calibre%d"><p class="block">%s '
+                '<span class="bold">%s</span></p></div>\n' % (
+                    i, text, make_text(20, seed - i),
+                )
+            )
+        elif kind == 1:
+            body.append(
+                '<p class="block">%s <a href="#note%d" id="ref%d">%d</a> '
+                '<a href="https://example.org/%d">link</a></p>\n' % (
+                    text, i, i, i, i,
+                )
+            )
+        elif kind == 2:
+            body.append(
+                '<table class="t"><tr><td>%s</td><td>%d</td></tr></table>'
+                '<img src="images/%d.png" alt="">\n' % (text, i, i)
+            )
+        else:
+            body.append(
+                '<blockquote><p>%s</p></blockquote><!-- %d -->\n'
+                '<pre>\n%s</pre>\n' % (text, i, make_text(40, i))
+            )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head>'
+        '<title>Benchmark</title><style>p { margin: 0 }</style>'
+        '</head><body class="calibre">\n%s</body></html>\n' % ''.join(body)
+    )
+
+
+def bench_sanitize(args):
+    html = make_page(args.paragraphs, args.length)
+    print("Sanitizing a document of %d bytes" % len(html.encode('utf-8')))
+    outputs = [
+        convert.get_html_body(html, engine=engine)
+        for engine in convert.SANITIZE_ENGINES
+    ]
+    assert all(output == outputs[0] for output in outputs)
+    for engine in convert.SANITIZE_ENGINES:
+        report(
+            "get_html_body(engine=%r)" % engine, args.number,
+            timeit.timeit(
+                lambda: convert.get_html_body(html, engine=engine),
+                number=args.number,
+            ),
+        )
+    report(
+        "is_html_safe()", args.number,
+        timeit.timeit(
+            lambda: convert.is_html_safe(outputs[0]),
+            number=args.number,
+        ),
+    )
+
+
+def make_project(db, highlights, with_text=True, seed=0):
+    """Fill a database with a project with many highlights.
+
+    If ``with_text`` is False, the plain-text version of the snippets is not
+    stored, like for highlights that were not backfilled.
+    """
+    rand = random.Random(seed)
+    project = database.Project(name="benchmark", description='')
+    db.add(project)
+    db.flush()
+    documents = []
+    for i in range(10):
+        documents.append(database.Document(
+            name='document%d.txt' % i, description='',
+            filename='document%d.txt' % i, project=project,
+            contents=make_text(200, seed + i),
+            text_direction=database.TextDirection.LEFT_TO_RIGHT,
+        ))
+    tags = [
+        database.Tag(project=project, path='tag%d' % i, description='')
+        for i in range(20)
+    ]
+    db.add_all(documents)
+    db.add_all(tags)
+    db.flush()
+    snippets = [make_text(50, seed + i) for i in range(highlights)]
+    db.execute(
+        database.Highlight.__table__.insert(),
+        [
+            dict(
+                id=i + 1,
+                document_id=rand.choice(documents).id,
+                start_offset=i, end_offset=i + 50,
+                snippet='<p>%s</p>' % snippet,
+                snippet_text=snippet.strip() if with_text else None,
+            )
+            for i, snippet in enumerate(snippets)
+        ],
+    )
+    db.execute(
+        database.highlight_tags.insert(),
+        [
+            dict(highlight_id=i + 1, tag_id=tag.id)
+            for i in range(highlights)
+            for tag in rand.sample(tags, rand.randint(0, 2))
+        ],
+    )
+    db.commit()
+    return project.id
+
+
+def bench_xlsx(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = database.connect(
+            'sqlite:///' + os.path.join(tmp, 'db.sqlite3'),
+        )()
+        project_id = make_project(db, args.highlights, not args.without_text)
+        print("Exporting %d highlights to Excel%s" % (
+            args.highlights,
+            " (without stored text)" if args.without_text else "",
+        ))
+        filename = os.path.join(tmp, 'highlights.xlsx')
+
+        def run():
+            asyncio.run(
+                export.highlights_xslx(db, project_id, '', filename)
+            )
+
+        report("highlights_xslx()", args.number,
+               timeit.timeit(run, number=args.number))
+
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%-30s %10.1f MB" % ("peak memory", peak / 1e6))
+        print("%-30s %10.1f MB" % (
+            "output size", os.path.getsize(filename) / 1e6,
+        ))
+        db.close()
+
+
+def bench_highlights_html(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = database.connect(
+            'sqlite:///' + os.path.join(tmp, 'db.sqlite3'),
+        )()
+        project_id = make_project(db, args.highlights)
+        print("Exporting %d highlights to HTML" % args.highlights)
+
+        async def export_html():
+            _, contents = await export.highlights_doc(
+                db, project_id, '', 'html',
+                config=tg_main.DEFAULT_CONFIG,
+                locale=tornado.locale.get('en_US'),
+            )
+            size = 0
+            for chunk in contents:
+                size += len(chunk)
+            return size
+
+        def run():
+            return asyncio.run(export_html())
+
+        report("highlights_doc()", args.number,
+               timeit.timeit(run, number=args.number))
+
+        tracemalloc.start()
+        size = run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%-30s %10.1f MB" % ("peak memory", peak / 1e6))
+        print("%-30s %10.1f MB" % ("output size", size / 1e6))
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=5,
+                        help="Number of runs to average over")
+    subparsers = parser.add_subparsers(title="benchmarks", dest='benchmark',
+                                       required=True)
+
+    parser_utf8 = subparsers.add_parser(
+        'utf8',
+        help="Converting UTF-8 offsets in a long non-ASCII text node",
+    )
+    parser_utf8.add_argument('--length', type=int, default=20000)
+    parser_utf8.add_argument('--conversions', type=int, default=500)
+    parser_utf8.set_defaults(func=bench_utf8)
+
+    parser_highlight = subparsers.add_parser(
+        'highlight',
+        help="Highlighting a document (extract.highlight())",
+    )
+    parser_highlight.add_argument('--paragraphs', type=int, default=200)
+    parser_highlight.add_argument('--length', type=int, default=2000)
+    parser_highlight.add_argument('--highlights', type=int, default=1000)
+    parser_highlight.set_defaults(func=bench_highlight)
+
+    parser_sanitize = subparsers.add_parser(
+        'sanitize',
+        help="Sanitizing an uploaded document (convert.get_html_body())",
+    )
+    parser_sanitize.add_argument('--paragraphs', type=int, default=200)
+    parser_sanitize.add_argument('--length', type=int, default=500)
+    parser_sanitize.set_defaults(func=bench_sanitize)
+
+    parser_xlsx = subparsers.add_parser(
+        'xlsx',
+        help="Exporting highlights to Excel (export.highlights_xslx())",
+    )
+    parser_xlsx.add_argument('--highlights', type=int, default=100000)
+    parser_xlsx.add_argument('--without-text', action='store_true',
+                             help="Don't store the plain-text snippets")
+    parser_xlsx.set_defaults(func=bench_xlsx)
+
+    parser_highlights_html = subparsers.add_parser(
+        'highlights-html',
+        help="Exporting highlights to HTML (export.highlights_doc())",
+    )
+    parser_highlights_html.add_argument('--highlights', type=int,
+                                        default=100000)
+    parser_highlights_html.set_defaults(func=bench_highlights_html)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,507 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import prometheus_client
+import shutil
+import tempfile
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_DOCUMENT_CACHE = prometheus_client.Counter(
+    'document_cache_total',
+    "Lookups in the document cache",
+    ['result'],
+)
+PROM_DOCUMENT_CACHE.labels('hit').inc(0)
+PROM_DOCUMENT_CACHE.labels('miss').inc(0)
+PROM_DOCUMENT_CACHE_EVICTIONS = prometheus_client.Counter(
+    'document_cache_evictions_total',
+    "Documents evicted from the document cache to make room",
+)
+PROM_DOCUMENT_CACHE_SIZE = prometheus_client.Gauge(
+    'document_cache_bytes',
+    "Approximate size of the documents in the document cache",
+)
+PROM_CONVERSION_CACHE = prometheus_client.Counter(
+    'conversion_cache_total',
+    "Lookups in the conversion cache",
+    ['result'],
+)
+PROM_CONVERSION_CACHE.labels('hit').inc(0)
+PROM_CONVERSION_CACHE.labels('miss').inc(0)
+PROM_CONVERSION_CACHE_SAVED = prometheus_client.Counter(
+    'conversion_cache_saved_bytes_total',
+    "Size of the uploaded files that didn't have to be converted again",
+)
+PROM_CONVERSION_CACHE_EVICTIONS = prometheus_client.Counter(
+    'conversion_cache_evictions_total',
+    "Conversions evicted from the conversion cache to make room",
+)
+PROM_CONVERSION_CACHE_SIZE = prometheus_client.Gauge(
+    'conversion_cache_bytes',
+    "Size of the conversion cache on disk",
+)
+PROM_EXPORT_CACHE = prometheus_client.Counter(
+    'export_cache_total',
+    "Lookups in the export cache",
+    ['result'],
+)
+PROM_EXPORT_CACHE.labels('hit').inc(0)
+PROM_EXPORT_CACHE.labels('miss').inc(0)
+PROM_EXPORT_CACHE_EVICTIONS = prometheus_client.Counter(
+    'export_cache_evictions_total',
+    "Exports evicted from the export cache to make room",
+)
+PROM_EXPORT_CACHE_SIZE = prometheus_client.Gauge(
+    'export_cache_bytes',
+    "Size of the export cache on disk",
+)
+
+
+# Rough memory use of one node of a text index (a list of 3 integers and a
+# list of ancestors)
+INDEX_NODE_SIZE = 200
+
+
+class DocumentCache(object):
+    """Size-bounded LRU cache of the contents and text index of documents.
+
+    Documents are immutable, so entries only need to be invalidated when
+    documents get deleted.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, document_id):
+        """Get the ``(contents, text_index)`` of a document, or None.
+        """
+        try:
+            entry = self._entries[document_id]
+        except KeyError:
+            PROM_DOCUMENT_CACHE.labels('miss').inc()
+            return None
+        self._entries.move_to_end(document_id)
+        PROM_DOCUMENT_CACHE.labels('hit').inc()
+        return entry[2], entry[3]
+
+    def put(self, document_id, project_id, contents, text_index):
+        self.invalidate(document_id)
+
+        size = len(contents.encode('utf-8'))
+        if text_index is not None and text_index['nodes']:
+            size += INDEX_NODE_SIZE * len(text_index['nodes'])
+        if size > self.max_size:
+            return
+
+        # Make room
+        while self.size + size > self.max_size:
+            _, (old_size, _, _, _) = self._entries.popitem(last=False)
+            self.size -= old_size
+            PROM_DOCUMENT_CACHE_EVICTIONS.inc()
+
+        self._entries[document_id] = size, project_id, contents, text_index
+        self.size += size
+        PROM_DOCUMENT_CACHE_SIZE.set(self.size)
+
+    def invalidate(self, document_id):
+        entry = self._entries.pop(document_id, None)
+        if entry is not None:
+            self.size -= entry[0]
+            PROM_DOCUMENT_CACHE_SIZE.set(self.size)
+
+    def invalidate_project(self, project_id):
+        for document_id, entry in list(self._entries.items()):
+            if entry[1] == project_id:
+                self.invalidate(document_id)
+
+
+class FileCache(object):
+    """Size-bounded cache of files on disk.
+
+    Least-recently-used entries are evicted first, using the files'
+    modification times. If ``max_age`` is set, entries that have not been
+    used for that many seconds are evicted as well. With a directory of
+    None, nothing is cached.
+
+    Subclasses set the suffix of the files and the metrics to update.
+    """
+    SUFFIX = None
+    PROM_LOOKUPS = None
+    PROM_EVICTIONS = None
+    PROM_SIZE = None
+
+    def __init__(self, directory, max_size, max_age=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.size = 0
+        self._pinned = collections.Counter()
+        self._last_sweep = time.time()
+        if directory is None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(self.SUFFIX):
+                self.size += os.stat(os.path.join(directory, name)).st_size
+        self.PROM_SIZE.set(self.size)
+        logger.info("%s in %s, %d bytes",
+                    type(self).__name__, directory, self.size)
+        if max_age is not None:
+            self._evict(self.max_size)
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def _open(self, key):
+        """Open the file for a key, or return None.
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            fp = open(path, 'rb')
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            self.PROM_LOOKUPS.labels('miss').inc()
+            return None
+        self.PROM_LOOKUPS.labels('hit').inc()
+        return fp
+
+    def _store(self, key, size, write):
+        """Add a file of the given size, written by ``write(fp)``.
+        """
+        if not self.enabled:
+            return
+        if size > self.max_size:
+            return
+        if os.path.exists(self._path(key)):
+            return
+
+        self._commit(key, self._write_temp(write), size)
+
+    def _write_temp(self, write):
+        """Write a temporary file, so readers never see partial files.
+        """
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                write(fp)
+        except BaseException:
+            os.remove(temp)
+            raise
+        return temp
+
+    def _commit(self, key, temp, size):
+        """Move a temporary file into the cache, making room for it.
+        """
+        if size > self.max_size:
+            os.remove(temp)
+            return
+        if (
+            self.size + size > self.max_size
+            or (
+                self.max_age is not None
+                and time.time() > self._last_sweep + self.max_age / 10
+            )
+        ):
+            self._evict(self.max_size - size)
+        os.replace(temp, self._path(key))
+        self.size += size
+        self.PROM_SIZE.set(self.size)
+
+    def pin(self, key):
+        """Prevent an entry from being evicted, until ``unpin()``.
+        """
+        self._pinned[key] += 1
+
+    def unpin(self, key):
+        self._pinned[key] -= 1
+        if not self._pinned[key]:
+            del self._pinned[key]
+
+    def _evict(self, target_size):
+        now = time.time()
+        self._last_sweep = now
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+
+        # Re-count, other processes might share this directory
+        self.size = sum(size for _, size, _ in entries)
+        for mtime, size, name in entries:
+            expired = (
+                self.max_age is not None
+                and mtime < now - self.max_age
+            )
+            if self.size <= target_size and not expired:
+                break
+            if name[:-len(self.SUFFIX)] in self._pinned:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            self.PROM_EVICTIONS.inc()
+        self.PROM_SIZE.set(self.size)
+
+
+def _hash_key(h, extension, version):
+    h.update(b'\0')
+    h.update(extension.lower().encode('utf-8'))
+    h.update(b'\0')
+    h.update(version.encode('utf-8'))
+    return h.hexdigest()
+
+
+class ConversionCache(FileCache):
+    """Size-bounded cache of converted documents, on disk.
+
+    Entries are keyed by a hash of the uploaded file and of everything else
+    that changes the output (see ``key()``).
+    """
+    SUFFIX = '.html'
+    PROM_LOOKUPS = PROM_CONVERSION_CACHE
+    PROM_EVICTIONS = PROM_CONVERSION_CACHE_EVICTIONS
+    PROM_SIZE = PROM_CONVERSION_CACHE_SIZE
+
+    @staticmethod
+    def key(body, extension, version):
+        """Compute the key for an uploaded file.
+
+        :param body: The uploaded bytes
+        :param extension: The extension of the file, which selects the
+            converter
+        :param version: Version of the converters and their options
+        """
+        return _hash_key(hashlib.sha256(body), extension, version)
+
+    @staticmethod
+    def file_key(filename, extension, version):
+        """Compute the key for an uploaded file, reading it from disk.
+
+        This gives the same key as ``key()`` on the file's contents.
+        """
+        h = hashlib.sha256()
+        with open(filename, 'rb') as fp:
+            chunk = fp.read(65536)
+            while chunk:
+                h.update(chunk)
+                chunk = fp.read(65536)
+        return _hash_key(h, extension, version)
+
+    def get(self, key, input_size=0):
+        """Get the converted HTML for a key, or None.
+        """
+        fp = self._open(key)
+        if fp is None:
+            return None
+        with fp:
+            html = fp.read().decode('utf-8')
+        PROM_CONVERSION_CACHE_SAVED.inc(input_size)
+        return html
+
+    def put(self, key, html):
+        data = html.encode('utf-8')
+        self._store(key, len(data), lambda fp: fp.write(data))
+
+
+class ExportCache(FileCache):
+    """Size-bounded cache of exported documents, on disk.
+
+    Entries are either keyed by a hash of the HTML that was converted and of
+    the format it was converted to (see ``key()``), or by the state of the
+    project that was exported (see ``project_key()``). Both are suitable for
+    an ETag as well.
+    """
+    SUFFIX = '.export'
+    PROM_LOOKUPS = PROM_EXPORT_CACHE
+    PROM_EVICTIONS = PROM_EXPORT_CACHE_EVICTIONS
+    PROM_SIZE = PROM_EXPORT_CACHE_SIZE
+
+    @staticmethod
+    def key(html, extension, version):
+        """Compute the key for an export.
+
+        :param html: The HTML document being exported
+        :param extension: The format it is exported to
+        :param version: Version of the converters and their options
+        """
+        return ExportCache.hash_key(
+            hashlib.sha256(html.encode('utf-8')), extension, version,
+        )
+
+    @staticmethod
+    def hash_key(h, extension, version):
+        """Compute the key for an export from a hash of the HTML.
+
+        This is the same as ``key()``, for a ``hashlib.sha256`` object that
+        was already updated with the HTML encoded as UTF-8.
+        """
+        return _hash_key(h, extension, version)
+
+    @staticmethod
+    def project_key(project_id, last_event, kind, params, locale, version):
+        """Compute the key for an export of a project.
+
+        The last event of the project identifies its state, so the export
+        only depends on that and on the parameters.
+
+        :param kind: What is exported, e.g. ``'codebook'``
+        :param params: List of parameters of the export, e.g. the extension
+        :param locale: The language, for exports that get translated
+        :param version: Version of the exporters
+        """
+        h = hashlib.sha256(json.dumps(
+            [project_id, last_event, kind, list(params), locale],
+        ).encode('utf-8'))
+        return _hash_key(h, '', version)
+
+    def open(self, key):
+        """Open the exported file for a key, or return None.
+
+        The entry is pinned until the file is closed, so it doesn't get
+        evicted while it is being sent.
+        """
+        fp = self._open(key)
+        if fp is None:
+            return None
+        return _PinnedFile(fp, self, key)
+
+    def tee(self, key, chunks):
+        """Store chunks of an export in the cache while they are sent.
+
+        This returns an iterable over the same chunks (``str`` chunks are
+        stored as UTF-8). The entry only gets added once all the chunks have
+        been read.
+        """
+        if not self.enabled or os.path.exists(self._path(key)):
+            return chunks
+        return self._tee(key, chunks)
+
+    def _tee(self, key, chunks):
+        writer = _EntryWriter(self, key)
+        try:
+            for chunk in chunks:
+                yield chunk
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            raise
+        writer.commit()
+
+    def atee(self, key, chunks, cacheable=None):
+        """Like ``tee()``, for an asynchronous iterable.
+
+        :param cacheable: Optional function called once all the chunks have
+            been read; the entry is not added if it returns False.
+        """
+        if not self.enabled or os.path.exists(self._path(key)):
+            return chunks
+        return self._atee(key, chunks, cacheable)
+
+    async def _atee(self, key, chunks, cacheable):
+        writer = _EntryWriter(self, key)
+        try:
+            async for chunk in chunks:
+                yield chunk
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            aclose = getattr(chunks, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+            raise
+        if cacheable is not None and not cacheable():
+            writer.abort()
+        else:
+            writer.commit()
+
+    async def put_file(self, key, filename):
+        """Copy an exported file into the cache.
+
+        The copy is made from a thread, only adding it to the cache happens on
+        the event loop.
+        """
+        def write(fp):
+            with open(filename, 'rb') as src:
+                shutil.copyfileobj(src, fp)
+
+        size = os.path.getsize(filename)
+        if (
+            not self.enabled
+            or size > self.max_size
+            or os.path.exists(self._path(key))
+        ):
+            return
+        loop = asyncio.get_event_loop()
+        temp = await loop.run_in_executor(None, self._write_temp, write)
+        self._commit(key, temp, size)
+
+
+class _EntryWriter(object):
+    """Writes a new entry to a temporary file, then adds it to the cache.
+    """
+    def __init__(self, cache, key):
+        self._cache = cache
+        self._key = key
+        fd, self._temp = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self._fp = os.fdopen(fd, 'wb')
+        self._size = 0
+
+    def write(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        self._fp.write(chunk)
+        self._size += len(chunk)
+
+    def commit(self):
+        self._fp.close()
+        self._cache._commit(self._key, self._temp, self._size)
+
+    def abort(self):
+        self._fp.close()
+        os.remove(self._temp)
+
+
+class _PinnedFile(object):
+    """A file from the cache, that unpins its entry when closed.
+    """
+    def __init__(self, fp, cache, key):
+        self._fp = fp
+        self._cache = cache
+        self._key = key
+        cache.pin(key)
+
+    def read(self, size=-1):
+        return self._fp.read(size)
+
+    def close(self):
+        if self._cache is not None:
+            self._fp.close()
+            self._cache.unpin(self._key)
+            self._cache = None
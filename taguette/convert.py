@@ -1,8 +1,15 @@
 import asyncio
+import bisect
 import bleach
 import bs4
 import chardet
 import codecs
+import collections
+import contextlib
+import contextvars
+import csv
+import hashlib
+import html5lib
 import importlib_resources
 import io
 import jinja2
@@ -10,6 +17,7 @@ import logging
 import opentelemetry.trace
 import os
 import prometheus_client
+import re
 from prometheus_async.aio import time as prom_async_time
 import shutil
 import subprocess
@@ -17,9 +25,15 @@ from subprocess import CalledProcessError
 import subtitle_parser
 import sys
 import tempfile
+import time
+import urllib.parse
+import zipfile
 from xml.etree import ElementTree
 
-from .utils import log_and_wait_proc, sanitize_filename
+from . import __version__
+from . import extract
+from . import pool
+from .utils import log_and_wait_proc
 
 
 logger = logging.getLogger(__name__)
@@ -64,10 +78,71 @@ PROM_CONVERT_QUEUE = prometheus_client.Gauge(
     'convert_queue',
     "Number of conversions waiting to run",
 )
+PROM_CONVERT_QUEUE_TIME = prometheus_client.Histogram(
+    'convert_queue_seconds',
+    "Time conversions waited to run",
+    ['queue'],
+    buckets=[0.1, 0.5] + BUCKETS + [120.0, 300.0],
+)
+PROM_CONVERT_LIMIT = prometheus_client.Gauge(
+    'convert_processes_limit',
+    "Maximum number of concurrent conversion processes",
+)
+PROM_CONVERT_STRATEGY = prometheus_client.Counter(
+    'convert_strategy_total',
+    "Outcome of conversion strategies (run_strategies())",
+    ['strategy', 'result'],
+)
+PROM_CONVERT_STRATEGY_TIME = prometheus_client.Histogram(
+    'convert_strategy_seconds',
+    "Time taken by successful conversion strategies (run_strategies())",
+    ['strategy'],
+    buckets=BUCKETS,
+)
+for strategy in ('heuristics', 'default'):
+    for result in ('success', 'error', 'timeout', 'cancelled'):
+        PROM_CONVERT_STRATEGY.labels(strategy, result).inc(0)
+PROM_CONVERT_SPECULATIVE = prometheus_client.Counter(
+    'convert_speculative_total',
+    "Conversions that ran all their strategies at once (run_strategies())",
+)
+PROM_NATIVE_TOHTML = prometheus_client.Counter(
+    'convert_native_tohtml_total',
+    "Conversions to HTML without an external program (native_to_html())",
+    ['format'],
+)
+PROM_NATIVE_TOHTML_TIME = prometheus_client.Histogram(
+    'convert_native_tohtml_seconds',
+    "Time to convert to HTML without an external program (native_to_html())",
+    ['format'],
+    buckets=[0.01, 0.05, 0.1, 0.5] + BUCKETS,
+)
+for fmt in ('txt', 'md', 'csv'):
+    PROM_NATIVE_TOHTML.labels(fmt).inc(0)
+PROM_OFFICE_TOHTML = prometheus_client.Counter(
+    'convert_office_tohtml_total',
+    "Office documents converted natively or with Calibre (office_to_html())",
+    ['format', 'path'],
+)
+for fmt in ('docx', 'odt'):
+    for path in ('native', 'calibre'):
+        PROM_OFFICE_TOHTML.labels(fmt, path).inc(0)
+PROM_SANITIZE_ENGINE = prometheus_client.Counter(
+    'html_sanitize_engine_total',
+    "Documents sanitized by each engine (get_html_body())",
+    ['engine'],
+)
+PROM_SANITIZE_ENGINE.labels('bleach').inc(0)
+PROM_SANITIZE_ENGINE.labels('single').inc(0)
+pool.forward_metrics(PROM_SANITIZE_ENGINE)
 
 
 HTML_EXTENSIONS = ('.htm', '.html', '.xhtml')
 
+# Part of the key of the conversion cache, bump this when to_html() or the
+# options passed to the converters change
+CONVERTER_VERSION = '%s-3' % __version__
+
 
 template_env = jinja2.Environment(
     loader=jinja2.FileSystemLoader(
@@ -91,40 +166,215 @@ class UnsupportedFormat(ConversionError):
 
 PROC_TERM_GRACE = 5  # Wait 5s after SIGTERM before sending SIGKILL
 
-PROC_MAX_CONCURRENT = 4  # Maximum concurrent conversion processes
+# Priorities of conversions, lower goes first
+PRIORITY_INTERACTIVE = 0  # Importing documents
+PRIORITY_BULK = 1  # Exporting documents
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_BULK: 'bulk',
+}
+for n in PRIORITY_NAMES.values():
+    PROM_CONVERT_QUEUE_TIME.labels(n)
+
+
+_conversion_owner = contextvars.ContextVar(
+    'conversion_owner',
+    default=(None, None),
+)
+
+
+@contextlib.contextmanager
+def conversion_owner(user_login, project_id):
+    """Attribute the conversions started in this context to a user and project.
+
+    This is used to share the conversion processes fairly.
+    """
+    token = _conversion_owner.set((user_login, project_id))
+    try:
+        yield
+    finally:
+        _conversion_owner.reset(token)
+
+
+def available_memory():
+    """Get the memory available for new processes, in bytes, or None.
+    """
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class ConversionScheduler(object):
+    """Limits the number of concurrent conversion processes.
 
+    Waiting conversions are picked by priority, then round-robin between the
+    users, then between the projects of that user. This way someone uploading
+    many documents doesn't make everyone else wait.
 
-class MeasuredSemaphore(asyncio.Semaphore):
-    def __init__(self, value, metric_acquired, metric_waiting):
-        super(MeasuredSemaphore, self).__init__(value)
-        self._metric_acquired = metric_acquired
-        self._metric_waiting = metric_waiting
+    If ``process_memory`` is set, no process is started (apart from the first
+    one) while less than that much memory is available.
+    """
+    def __init__(self, limit, process_memory=None):
+        self.limit = limit
+        self.process_memory = process_memory
+        self.running = 0
+        self.waiting = 0
+        # priority -> user -> project -> deque of futures
+        self._queues = {}
+        PROM_CONVERT_LIMIT.set(limit)
+
+    def configure(self, limit, process_memory=None):
+        self.limit = limit
+        self.process_memory = process_memory
+        PROM_CONVERT_LIMIT.set(limit)
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=PRIORITY_INTERACTIVE):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
 
-    async def acquire(self):
-        self._metric_waiting.inc()
-        ret = await super(MeasuredSemaphore, self).acquire()
-        self._metric_waiting.dec()
-        self._metric_acquired.inc()
-        return ret
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        start = time.perf_counter()
+        if not self.waiting and self._can_start():
+            self._start()
+        else:
+            user, project = _conversion_owner.get()
+            future = asyncio.get_event_loop().create_future()
+            (
+                self._queues
+                .setdefault(priority, collections.OrderedDict())
+                .setdefault(user, collections.OrderedDict())
+                .setdefault(project, collections.deque())
+            ).append(future)
+            self.waiting += 1
+            PROM_CONVERT_QUEUE.inc()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # We got a slot, but won't use it
+                    self.release()
+                else:
+                    future.cancel()
+                    self._remove(priority, user, project, future)
+                raise
+        PROM_CONVERT_QUEUE_TIME.labels(PRIORITY_NAMES[priority]).observe(
+            time.perf_counter() - start,
+        )
 
     def release(self):
-        super(MeasuredSemaphore, self).release()
-        self._metric_acquired.dec()
+        self.running -= 1
+        PROM_CONVERT_PROCESSES.dec()
+        self._wake()
+
+    def has_room(self, count=1):
+        """Whether this many processes could start right away.
+        """
+        if self.waiting or self.running + count > self.limit:
+            return False
+        if self.process_memory:
+            available = available_memory()
+            needed = self.process_memory * (count - (self.running == 0))
+            if available is not None and available < needed:
+                return False
+        return True
+
+    def _can_start(self):
+        if self.running >= self.limit:
+            return False
+        if self.running > 0 and self.process_memory:
+            available = available_memory()
+            if available is not None and available < self.process_memory:
+                return False
+        return True
+
+    def _start(self):
+        self.running += 1
+        PROM_CONVERT_PROCESSES.inc()
+
+    def _wake(self):
+        while self.waiting and self._can_start():
+            future = self._pop()
+            self._start()
+            future.set_result(None)
+
+    def _pop(self):
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            if not users:
+                continue
+            user, projects = next(iter(users.items()))
+            project, futures = next(iter(projects.items()))
+            future = futures.popleft()
+
+            # Move to the back of the queue, or remove if empty
+            if futures:
+                projects.move_to_end(project)
+            else:
+                del projects[project]
+            if projects:
+                users.move_to_end(user)
+            else:
+                del users[user]
+
+            self.waiting -= 1
+            PROM_CONVERT_QUEUE.dec()
+            return future
+        raise AssertionError("No waiting conversion")
+
+    def _remove(self, priority, user, project, future):
+        projects = self._queues[priority][user]
+        futures = projects[project]
+        futures.remove(future)
+        if not futures:
+            del projects[project]
+            if not projects:
+                del self._queues[priority][user]
+        self.waiting -= 1
+        PROM_CONVERT_QUEUE.dec()
+
+
+def default_process_limit(process_memory):
+    """Pick a number of concurrent conversions from CPUs and memory.
+    """
+    limit = os.cpu_count() or 1
+    memory = available_memory()
+    if process_memory and memory is not None:
+        limit = min(limit, memory // process_memory)
+    return max(1, limit)
 
 
-subprocess_sem = MeasuredSemaphore(
-    PROC_MAX_CONCURRENT,
-    PROM_CONVERT_PROCESSES,
-    PROM_CONVERT_QUEUE,
-)
+subprocess_scheduler = ConversionScheduler(4)
+
+
+def configure_scheduler(max_processes, process_memory):
+    """Set the limits of the conversion scheduler from the configuration.
+
+    If ``max_processes`` is None, it is picked from the number of CPUs and the
+    available memory.
+    """
+    if max_processes is None:
+        max_processes = default_process_limit(process_memory)
+    logger.info("Running up to %d conversion processes", max_processes)
+    subprocess_scheduler.configure(max_processes, process_memory)
 
 
 # Windows only supports subprocesses with the asyncio ProactorEventLoop
 # However tornado only supports the SelectorEventLoop
 # https://github.com/tornadoweb/tornado/issues/2608
 # For now we can't use asyncio subprocesses on Windows
-async def _check_call_threadpool(cmd, timeout, env=None):
-    async with subprocess_sem:
+async def _check_call_threadpool(cmd, timeout, env=None,
+                                 priority=PRIORITY_INTERACTIVE):
+    async with subprocess_scheduler.slot(priority):
         with tracer.start_as_current_span(
             'taguette/subprocess',
             attributes={'command': ' '.join(cmd)},
@@ -135,8 +385,9 @@ async def _check_call_threadpool(cmd, timeout, env=None):
             )
 
 
-async def _check_call_asyncio(cmd, timeout, env=None):
-    async with subprocess_sem:
+async def _check_call_asyncio(cmd, timeout, env=None,
+                              priority=PRIORITY_INTERACTIVE):
+    async with subprocess_scheduler.slot(priority):
         with tracer.start_as_current_span(
             'taguette/subprocess',
             attributes={'command': ' '.join(cmd)},
@@ -157,30 +408,233 @@ async def _check_call_asyncio(cmd, timeout, env=None):
                     "Process didn't finish before %ds timeout: %r",
                     timeout, cmd,
                 )
-                try:
-                    proc.terminate()
-                    try:
-                        await asyncio.wait_for(proc.wait(), PROC_TERM_GRACE)
-                    except asyncio.TimeoutError:
-                        proc.kill()
-                except ProcessLookupError:
-                    pass
+                await _terminate(proc)
                 raise asyncio.TimeoutError
+            except asyncio.CancelledError:
+                logger.info("Stopping process: %r", cmd)
+                await _terminate(proc)
+                raise
             else:
                 if retcode != 0:
                     raise CalledProcessError(retcode, cmd)
 
 
+async def _terminate(proc):
+    try:
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), PROC_TERM_GRACE)
+        except asyncio.TimeoutError:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+
+
 if sys.platform == 'win32':
     check_call = _check_call_threadpool
 else:
     check_call = _check_call_asyncio
 
 
+class StrategyHistory(object):
+    """Remembers which conversion strategies work for which kind of file.
+
+    Outcomes are counted per key (file extension and size bucket) and
+    strategy. They decay with every conversion of that kind of file, so that
+    a strategy that failed gets tried again eventually.
+    """
+    DECAY = 0.9
+    SIZE_BUCKETS = [1000000, 10000000]  # 1 MB, 10 MB
+
+    def __init__(self):
+        # key -> strategy -> [successes, attempts]
+        self._stats = {}
+
+    @classmethod
+    def key(cls, extension, size):
+        return extension.lower(), bisect.bisect(cls.SIZE_BUCKETS, size)
+
+    def tick(self, key):
+        """Age the outcomes for a key, before a new conversion.
+        """
+        for stats in self._stats.get(key, {}).values():
+            stats[0] *= self.DECAY
+            stats[1] *= self.DECAY
+
+    def record(self, key, strategy, success):
+        stats = self._stats.setdefault(key, {}).setdefault(
+            strategy, [0.0, 0.0],
+        )
+        if success:
+            stats[0] += 1
+        stats[1] += 1
+
+    def success_rate(self, key, strategy):
+        """Estimated success rate, strategies are assumed to work at first.
+        """
+        successes, attempts = self._stats.get(key, {}).get(
+            strategy, (0.0, 0.0),
+        )
+        return (successes + 1.0) / (attempts + 1.0)
+
+
+strategy_history = StrategyHistory()
+
+# Strategies with this success rate are trusted to work, no need to try other
+# ones at the same time
+RELIABLE_RATE = 0.8
+
+
+async def run_strategies(strategies, key, speculative=True, history=None):
+    """Run a conversion, trying different strategies.
+
+    Strategies are tried in turn, moving to the next one if a strategy times
+    out. If the preferred strategy has been failing for this kind of file and
+    there are enough idle conversion slots, all the strategies run at once
+    instead; the first successful result is used, and the other ones get
+    cancelled (killing their processes).
+
+    :param strategies: List of ``(name, func)`` in order of preference, where
+        ``func`` is a coroutine function doing the conversion
+    :param key: The kind of file, see ``StrategyHistory.key()``
+    """
+    if history is None:
+        history = strategy_history
+    history.tick(key)
+    rates = {name: history.success_rate(key, name) for name, _ in strategies}
+
+    async def attempt(name, func):
+        start = time.perf_counter()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            PROM_CONVERT_STRATEGY.labels(name, 'cancelled').inc()
+            raise
+        except asyncio.TimeoutError:
+            PROM_CONVERT_STRATEGY.labels(name, 'timeout').inc()
+            history.record(key, name, False)
+            raise
+        except Exception:
+            PROM_CONVERT_STRATEGY.labels(name, 'error').inc()
+            history.record(key, name, False)
+            raise
+        PROM_CONVERT_STRATEGY.labels(name, 'success').inc()
+        PROM_CONVERT_STRATEGY_TIME.labels(name).observe(
+            time.perf_counter() - start,
+        )
+        history.record(key, name, True)
+        return result
+
+    order = strategies
+    if len(strategies) > 1 and rates[strategies[0][0]] < RELIABLE_RATE:
+        # Processes can't be killed from the thread pool, don't speculate
+        if (
+            speculative
+            and sys.platform != 'win32'
+            and subprocess_scheduler.has_room(len(strategies))
+        ):
+            logger.info("Running strategies %s at once",
+                        ', '.join(name for name, _ in strategies))
+            PROM_CONVERT_SPECULATIVE.inc()
+            return await _run_concurrently(strategies, attempt)
+        # Start with what worked best
+        order = sorted(strategies, key=lambda s: -rates[s[0]])
+
+    for i, (name, func) in enumerate(order):
+        try:
+            return await attempt(name, func)
+        except asyncio.TimeoutError:
+            if i + 1 == len(order):
+                raise
+            logger.warning("Strategy %r timed out, trying %r...",
+                           name, order[i + 1][0])
+
+
+async def _run_concurrently(strategies, attempt):
+    tasks = {
+        asyncio.ensure_future(attempt(name, func)): i
+        for i, (name, func) in enumerate(strategies)
+    }
+    errors = {}
+    try:
+        while tasks:
+            done, _ = await asyncio.wait(
+                tasks,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in sorted(done, key=tasks.get):
+                i = tasks.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    errors[i] = e
+                else:
+                    logger.info("Using result of strategy %r",
+                                strategies[i][0])
+                    return result
+        # Report the error from the preferred strategy
+        raise errors[min(errors)]
+    finally:
+        if tasks:
+            for task in tasks:
+                task.cancel()
+            # Wait for the processes to be gone before their files get removed
+            await asyncio.wait(tasks)
+
+
 # Something to HTML
 
 
-def get_html_body(body):
+# Elements kept in documents, everything else is stripped (keeping the text)
+ALLOWED_TAGS = {
+    'p', 'br', 'code', 'blockquote', 'pre',  # formatting
+    'sub', 'sup', 'caption',
+    'a', 'img',  # non-text
+    'h1', 'h2', 'h3', 'h4', 'h5',  # headers
+    'strong', 'em', 'b', 'u', 'q', 'del',  # emphasis
+    'ul', 'ol', 'li', 'dl', 'dt', 'dd',  # lists
+    'table', 'thead', 'tbody', 'tr', 'th', 'td',  # tables
+    'colgroup', 'col',  # columns
+}
+
+ALLOWED_PROTOCOLS = {'http', 'https', 'mailto'}
+
+SANITIZE_ENGINES = ('bleach', 'single')
+
+
+def get_html_body(body, engine='single'):
+    """Get the sanitized body of an HTML document.
+
+    :param engine: 'bleach' to rewrite the document with BeautifulSoup then
+        have bleach parse it again to sanitize it, or 'single' to do both in a
+        single walk over the html5lib tree, then check that the result parses
+        back the same. The output is the same, except for some invalid
+        nestings that 'single' outputs in a form that parses back the same and
+        bleach doesn't. Documents with SVG or MathML, or that don't settle
+        after a few parses, go through bleach
+    """
+    if engine == 'single':
+        if hasattr(body, 'read'):
+            body = body.read()
+        root = html5lib.parse(
+            body,
+            treebuilder='etree',
+            namespaceHTMLElements=False,
+        )
+        try:
+            html = _sanitize_tree(root, rewrite=True).strip()
+        except _ForeignContent:
+            html = None
+        del root
+        if html is not None:
+            html = _reparse(html)
+        if html is not None:
+            PROM_SANITIZE_ENGINE.labels('single').inc()
+            return html
+    elif engine != 'bleach':
+        raise ValueError("Unknown sanitize engine %r" % engine)
+    PROM_SANITIZE_ENGINE.labels('bleach').inc()
+
     # Use beautifulsoup to remove head, script, style elements
     # (bleach can do that, but would keep the text inside them)
     soup = bs4.BeautifulSoup(body, 'html5lib')
@@ -211,25 +665,28 @@ def get_html_body(body):
     # Use bleach to sanitize the content
     body = bleach.clean(
         body,
-        tags={
-            'p', 'br', 'code', 'blockquote', 'pre',  # formatting
-            'sub', 'sup', 'caption',
-            'a', 'img',  # non-text
-            'h1', 'h2', 'h3', 'h4', 'h5',  # headers
-            'strong', 'em', 'b', 'u', 'q', 'del',  # emphasis
-            'ul', 'ol', 'li', 'dl', 'dt', 'dd',  # lists
-            'table', 'thead', 'tbody', 'tr', 'th', 'td',  # tables
-            'colgroup', 'col',  # columns
-        },
+        tags=ALLOWED_TAGS,
         attributes={'a': {'href', 'title'}, 'img': {'src'}},
+        protocols=ALLOWED_PROTOCOLS,
         strip=True,
     )
 
     body = body.strip()
 
+    if engine == 'single':
+        # bleach's output doesn't always parse back the same either
+        body = _reparse(body) or body
+
     return body
 
 
+def get_html_file_body(input_filename, engine='single'):
+    """Get the sanitized body of an HTML file, see ``get_html_body()``.
+    """
+    with open(input_filename, 'rb') as fp:
+        return get_html_body(fp, engine=engine)
+
+
 def is_html_safe(text):
     """Check whether the given HTML is safe.
 
@@ -247,26 +704,35 @@ def is_html_safe(text):
             type(text).__name__,
         ))
 
-    soup = bs4.BeautifulSoup(text, 'html5lib')
     # Check 'src' URLs
-    for e in soup.find_all('img'):
-        if e.attrs.get('src') != '/static/missing.png':
+    root = html5lib.parse(
+        text,
+        treebuilder='etree',
+        namespaceHTMLElements=False,
+    )
+    for e in root.iter():
+        if (
+            isinstance(e.tag, str) and _local_name(e.tag) == 'img'
+            and e.get('src') != '/static/missing.png'
+        ):
             return False
 
+    # Serialize the allowed part of the tree, it should match what we got
+    # This recognizes what get_html_body() outputs. Anything else (such as
+    # entities or HTML from older versions) goes through bleach to be sure
+    cleaned = _sanitize_tree(root, rewrite=False)
+    if (
+        text.strip().replace('/>', '>')
+        == cleaned.strip().replace('/>', '>')
+    ):
+        return True
+
     # Use bleach to sanitize the content
     cleaned = bleach.clean(
         text,
-        tags={
-            'p', 'br', 'code', 'blockquote', 'pre',  # formatting
-            'sub', 'sup', 'caption',
-            'a', 'img',  # non-text
-            'h1', 'h2', 'h3', 'h4', 'h5',  # headers
-            'strong', 'em', 'b', 'u', 'q', 'del',  # emphasis
-            'ul', 'ol', 'li', 'dl', 'dt', 'dd',  # lists
-            'table', 'thead', 'tbody', 'tr', 'th', 'td',  # tables
-            'colgroup', 'col',  # columns
-        },
+        tags=ALLOWED_TAGS,
         attributes={'a': {'href', 'title'}, 'img': {'src', 'width', 'height'}},
+        protocols=ALLOWED_PROTOCOLS,
         strip=True,
     )
 
@@ -279,41 +745,265 @@ def is_html_safe(text):
     )
 
 
+# The single-pass engine serializes the tree the way bleach would
+_formatter = bs4.formatter.HTMLFormatter.REGISTRY['minimal']
+
+_VOID_TAGS = {'br', 'img', 'col'}
+
+# Elements dropped with their contents
+_REMOVED_TAGS = {'head', 'script', 'style'}
+
+# bleach leaves a line break in place of those elements when stripping them
+# (bleach.html5lib_shim.HTML_TAGS_BLOCK_LEVEL)
+_BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'details', 'dialog', 'dd',
+    'div', 'dl', 'dt', 'fieldset', 'figcaption', 'figure', 'footer', 'form',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'li',
+    'main', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'ul',
+}
+
+_uri_ignored_re = re.compile(r'[`\000-\040\177-\240\s]+')
+_uri_non_ascii_re = re.compile(r'[^\x00-\x7f]')
+
+
+def _local_name(tag):
+    # html5lib puts SVG and MathML elements in their namespace
+    if tag[0] == '{':
+        return tag.rsplit('}', 1)[1]
+    return tag
+
+
+def _newlines(text):
+    # bleach's parser normalizes line endings
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _is_allowed_uri(value):
+    """Check the protocol of a link, like bleach does.
+    """
+    uri = _uri_ignored_re.sub('', value)
+    uri = _uri_non_ascii_re.sub('', uri).lower()
+    try:
+        scheme = urllib.parse.urlparse(uri).scheme
+    except ValueError:
+        return False
+    if scheme:
+        return scheme in ALLOWED_PROTOCOLS
+    return (
+        uri.startswith('#')
+        or ':' not in uri
+        or uri.split(':')[0] in ALLOWED_PROTOCOLS
+    )
+
+
+def _attribute(name, value):
+    return ' %s=%s' % (
+        name,
+        _formatter.quoted_attribute_value(
+            _formatter.attribute_value(_newlines(value)),
+        ),
+    )
+
+
+def _children(element):
+    """List the children of an element and the text between them, reversed.
+    """
+    children = []
+    for child in reversed(element):
+        if child.tail:
+            children.append(child.tail)
+        children.append(child)
+    if element.text:
+        children.append(element.text)
+    return children
+
+
+def _text(element):
+    parts = []
+    todo = [element]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, str):
+            parts.append(node)
+        elif (
+            isinstance(node.tag, str)
+            and _local_name(node.tag) not in _REMOVED_TAGS
+        ):
+            todo.extend(_children(node))
+    return ''.join(parts)
+
+
+def _reparse(html, attempts=4):
+    """Parse sanitized HTML again until it serializes to itself.
+
+    An invalid nesting kept by ``_sanitize_tree()`` gets arranged differently
+    by a new parse (like bleach's second parse does), and the result would
+    fail ``is_html_safe()``. Returns None if it doesn't settle.
+    """
+    for _ in range(attempts):
+        root = html5lib.parse(
+            html,
+            treebuilder='etree',
+            namespaceHTMLElements=False,
+        )
+        again = _sanitize_tree(root, rewrite=False).strip()
+        if again == html:
+            return html
+        html = again
+    return None
+
+
+class _EndTag(str):
+    pass
+
+
+class _ForeignContent(Exception):
+    """The document has SVG or MathML, which only bleach handles.
+    """
+
+
+def _sanitize_tree(root, rewrite):
+    """Serialize the allowed elements of an html5lib tree.
+
+    :param rewrite: Whether to do the changes ``get_html_body()`` makes
+        (dropping scripts and styles, replacing images, turning relative links
+        into titles), otherwise attributes are only filtered.
+    """
+    output = []
+    todo = [root]
+    # The parser drops a line break right after <pre>, so it has to go when
+    # what comes before it is stripped
+    pre_start = False
+    while todo:
+        node = todo.pop()
+        if type(node) is _EndTag:
+            output.append(node)
+            pre_start = False
+            continue
+        elif isinstance(node, str):
+            node = _newlines(node)
+            if pre_start:
+                if node[0] == '\n':
+                    node = node[1:]
+                pre_start = False
+            output.append(_escape(node))
+            continue
+        elif not isinstance(node.tag, str):  # Comment
+            pre_start = False
+            continue
+
+        name = _local_name(node.tag)
+        if name is not node.tag:
+            # SVG or MathML element: its local name can't be trusted (e.g.
+            # <td> in <svg> is not a cell) and unwrapping it can expose HTML
+            # that a new parse would arrange differently
+            if rewrite:
+                raise _ForeignContent
+            todo.extend(_children(node))
+            pre_start = False
+            continue
+        attrs = node.attrib
+        if rewrite:
+            if name in _REMOVED_TAGS:
+                continue
+            if name == 'a' and 'href' not in attrs:
+                text = _newlines(_text(node))
+                if pre_start and text:
+                    if text[0] == '\n':
+                        text = text[1:]
+                    pre_start = False
+                output.append(_escape(text))
+                continue
+
+        if name in ALLOWED_TAGS:
+            tag = ['<', name]
+            if name == 'a':
+                if not rewrite:
+                    for key, value in attrs.items():
+                        if key == 'title' or (
+                            key == 'href' and _is_allowed_uri(value)
+                        ):
+                            tag.append(_attribute(key, value))
+                else:
+                    href = attrs['href']
+                    lower = href.lower()
+                    if not (lower.startswith('http://') or
+                            lower.startswith('https://') or
+                            lower.startswith('mailto:')):
+                        tag.append(_attribute('title', href))
+                    elif _is_allowed_uri(href):
+                        tag.append(_attribute('href', href))
+            elif name == 'img':
+                if not rewrite:
+                    for key, value in attrs.items():
+                        if key in ('width', 'height') or (
+                            key == 'src' and _is_allowed_uri(value)
+                        ):
+                            tag.append(_attribute(key, value))
+                else:
+                    tag.append(' src="/static/missing.png"')
+            tag.append('>')
+            output.append(''.join(tag))
+            pre_start = name == 'pre'
+            if name not in _VOID_TAGS:
+                todo.append(_EndTag('</%s>' % name))
+        elif name in _BLOCK_TAGS:
+            output.append('\n')
+            pre_start = False
+        todo.extend(_children(node))
+    return ''.join(output)
+
+
 @tracer.start_as_current_span('taguette/convert/calibre_to_html')
 @prom_async_time(PROM_CALIBRE_TOHTML_TIME)
 async def calibre_to_html(input_filename, temp_dir, config):
     PROM_CALIBRE_TOHTML.inc()
 
-    output_dir = os.path.join(temp_dir, 'output')
-    output = []
     convert = 'ebook-convert'
     if os.environ.get('CALIBRE'):
         convert = os.path.join(os.environ['CALIBRE'], convert)
-    cmd = [convert, input_filename, output_dir]
 
-    def run_calibre(cmd):
-        logger.info("Running: %s", ' '.join(cmd))
-        return check_call(
-            cmd,
-            config['CONVERT_TO_HTML_TIMEOUT'],
-            env=dict(os.environ, TMPDIR=temp_dir),
-        )
+    def strategy(name, options):
+        output_dir = os.path.join(temp_dir, 'output-%s' % name)
 
+        async def run_calibre():
+            cmd = [convert, input_filename, output_dir] + options
+            logger.info("Running: %s", ' '.join(cmd))
+            await check_call(
+                cmd,
+                config['CONVERT_TO_HTML_TIMEOUT'],
+                env=dict(os.environ, TMPDIR=temp_dir),
+            )
+            if not os.path.isdir(output_dir) or not any(
+                e.lower().endswith('.opf') for e in os.listdir(output_dir)
+            ):
+                logger.error("No OPF manifest in Calibre's output")
+                raise ConversionError("Invalid output from Calibre")
+            return output_dir
+
+        return name, run_calibre
+
+    # Plain text never gets here, see NATIVE_CONVERTERS
     ext = os.path.splitext(input_filename)[1].lower()
+    options = []
+    if ext == '.pdf':
+        options.append('--no-images')
+    strategies = [
+        strategy('heuristics', options + ['--enable-heuristics']),
+        strategy('default', options),
+    ]
     try:
-        if ext == '.txt':
-            cmd.append('--formatting-type=plain')
-            await run_calibre(cmd)
-        else:
-            if ext == '.pdf':
-                cmd.append('--no-images')
-            cmd_heuristics = cmd + ['--enable-heuristics']
-            try:
-                await run_calibre(cmd_heuristics)
-            except asyncio.TimeoutError:
-                logger.warning("Calibre timed out, trying again without "
-                               "heuristics...")
-                await run_calibre(cmd)
+        output_dir = await run_strategies(
+            strategies,
+            StrategyHistory.key(ext, os.path.getsize(input_filename)),
+            speculative=config['CALIBRE_SPECULATIVE'],
+        )
     except asyncio.TimeoutError:
         raise ConversionError("Calibre took too long and was stopped")
     except OSError:
@@ -388,7 +1078,7 @@ async def calibre_to_html(input_filename, temp_dir, config):
     logger.info("Read %d items", len(items))
 
     # Read <spine>
-    size = 0
+    filenames = []
     for item in spine:
         if item.tag not in ('itemref', ns + 'itemref'):
             continue
@@ -415,21 +1105,68 @@ async def calibre_to_html(input_filename, temp_dir, config):
                          output_name)
             raise ConversionError("Invalid output from Calibre")
 
-        # Read output
-        logger.info("Reading in %r", output_name)
-        size += os.stat(output_filename).st_size
-        if size > config['HTML_OUT_SIZE_LIMIT']:
-            logger.warning(
-                "File is %d bytes for a total of %d bytes; aborting",
-                os.stat(output_filename).st_size,
-                size,
-            )
+        # Don't even parse files that can't fit
+        size = os.stat(output_filename).st_size
+        if size > config['HTML_OUT_SIZE_LIMIT'] * SPINE_FILE_SIZE_FACTOR:
+            logger.warning("File %r is %d bytes; aborting",
+                           output_name, size)
             raise ConversionError("Output file is too long")
-        with open(output_filename, 'rb') as fp:
-            output.append(get_html_body(fp.read()))
+        filenames.append(output_filename)
     # TODO: Store media files
 
-    # Assemble output
+    return await sanitize_files(filenames, config)
+
+
+# Sanitizing removes most of the markup Calibre outputs, so input files can be
+# bigger than the output limit, up to this factor
+SPINE_FILE_SIZE_FACTOR = 4
+
+
+async def sanitize_files(filenames, config):
+    """Sanitize HTML files and concatenate them, enforcing the size limit.
+
+    The files are sanitized in the process pool, a few at a time, and their
+    output is collected in order. ``HTML_OUT_SIZE_LIMIT`` applies to the
+    sanitized output, and the remaining files are dropped as soon as it is
+    reached: files that are waiting for a worker are not sanitized, but files
+    that are already being sanitized keep their worker until they are done.
+    """
+    limit = config['HTML_OUT_SIZE_LIMIT']
+    window = max(1, pool.size())
+    pending = collections.deque()
+    output = []
+    size = 0
+    files = iter(filenames)
+    try:
+        while True:
+            # Keep the pool busy
+            while len(pending) < window:
+                filename = next(files, None)
+                if filename is None:
+                    break
+                logger.info("Reading in %r", os.path.basename(filename))
+                pending.append(asyncio.ensure_future(pool.run(
+                    get_html_file_body, filename,
+                    engine=config['SANITIZE_ENGINE'],
+                )))
+            if not pending:
+                break
+
+            html = await pending.popleft()
+            if output:
+                size += 1  # Separator
+            size += len(html.encode('utf-8'))
+            if size > limit:
+                logger.warning("Output is more than %d bytes; aborting",
+                               limit)
+                raise ConversionError("Output file is too long")
+            output.append(html)
+    finally:
+        # This only stops waiting, the pool frees the workers when they finish
+        for future in pending:
+            future.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
     return '\n'.join(output)
 
 
@@ -456,31 +1193,1247 @@ async def wvware_to_html(input_filename, tmp, config):
     logger.info("wvHtml successful")
 
     # Read output
-    with open(output_filename, 'rb') as fp:
-        return get_html_body(fp.read())
+    return await pool.run(
+        get_html_file_body, output_filename,
+        engine=config['SANITIZE_ENGINE'],
+    )
+
+
+# Plain text formats, converted in-process
+
+
+# Amount of data looked at to detect the encoding and CSV dialect
+SAMPLE_SIZE = 65536
+
+# Control characters that can't appear in HTML
+_control_chars_re = re.compile('[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]')
+
+
+def detect_encoding(body):
+    """Detect the encoding of a text file from its beginning.
+    """
+    for bom, encoding in [
+        (codecs.BOM_UTF8, 'utf-8-sig'),
+        (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16'),
+    ]:
+        if body.startswith(bom):
+            return encoding
+    detector = chardet.UniversalDetector()
+    for pos in range(0, min(len(body), SAMPLE_SIZE), 4096):
+        detector.feed(body[pos:pos + 4096])
+        if detector.done:
+            break
+    encoding = detector.close()['encoding']
+    # The sample might be ASCII without the rest of the file being
+    if not encoding or encoding.lower() == 'ascii':
+        return 'utf-8'
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return 'utf-8'
+    return encoding
+
+
+def _read_text(input_filename, newline=None):
+    """Open a text file for reading, detecting its encoding.
+    """
+    fp = open(input_filename, 'rb')
+    try:
+        encoding = detect_encoding(fp.read(SAMPLE_SIZE))
+        fp.seek(0)
+    except BaseException:
+        fp.close()
+        raise
+    return io.TextIOWrapper(
+        fp,
+        encoding=encoding,
+        errors='replace',
+        newline=newline,
+    )
+
+
+def _clean_text(text):
+    return _escape(_control_chars_re.sub('', text))
+
+
+class _Output(object):
+    """Collects the HTML output of a converter.
+
+    Raises ``ConversionError`` as soon as the output gets longer than
+    ``size_limit``.
+    """
+    def __init__(self, size_limit=None):
+        self.output = []
+        self.size = 0
+        self.size_limit = size_limit
+
+    def write(self, html):
+        self.output.append(html)
+        self.size += len(html)
+        if self.size_limit is not None and self.size > self.size_limit:
+            raise ConversionError("Output file is too long")
+
+    def getvalue(self):
+        return ''.join(self.output)
+
+
+def text_to_html(input_filename, size_limit=None):
+    """Convert a plain text file to HTML.
+
+    Paragraphs are separated by empty lines, other line breaks are kept.
+    """
+    output = _Output(size_limit)
+    paragraph = []
+    with _read_text(input_filename) as fp:
+        for line in fp:
+            line = line.rstrip('\n')
+            if line.strip():
+                paragraph.append(_clean_text(line))
+            elif paragraph:
+                output.write('<p>%s</p>\n' % '<br>'.join(paragraph))
+                paragraph = []
+    if paragraph:
+        output.write('<p>%s</p>\n' % '<br>'.join(paragraph))
+    return output.getvalue()
+
+
+def csv_to_html(input_filename, size_limit=None):
+    """Convert a CSV file to an HTML table.
+    """
+    with _read_text(input_filename, newline='') as fp:
+        sample = fp.read(SAMPLE_SIZE)
+        sniffer = csv.Sniffer()
+        try:
+            dialect = sniffer.sniff(sample, delimiters=',;\t|')
+            has_header = sniffer.has_header(sample)
+        except csv.Error:
+            dialect = csv.excel
+            has_header = False
+        fp.seek(0)
+
+        output = _Output(size_limit)
+        output.write('<table>')
+        try:
+            rows = csv.reader(fp, dialect)
+            if has_header:
+                header = next(rows, None)
+                if header is not None:
+                    output.write('<thead><tr>')
+                    for cell in header:
+                        output.write('<th>%s</th>' % _clean_text(cell))
+                    output.write('</tr></thead>')
+            output.write('<tbody>')
+            for row in rows:
+                if not row:
+                    continue
+                output.write('<tr>')
+                for cell in row:
+                    output.write('<td>%s</td>' % _clean_text(cell))
+                output.write('</tr>\n')
+        except csv.Error as e:
+            raise ConversionError("Invalid CSV file: %s" % e)
+        output.write('</tbody></table>')
+    return output.getvalue()
+
+
+_md_fence_re = re.compile(r' {0,3}(`{3,}|~{3,})')
+_md_heading_re = re.compile(r' {0,3}(#{1,6})(?:[ \t]+|$)')
+_md_setext_re = re.compile(r' {0,3}(=+|-+)[ \t]*$')
+_md_rule_re = re.compile(r' {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$')
+_md_quote_re = re.compile(r' {0,3}> ?')
+_md_item_re = re.compile(r'( {0,3})([-*+]|[0-9]{1,9}[.)])([ \t]{1,4}|$)')
+_md_backticks_re = re.compile(r'`+')
+# None of these can scan further than the next bracket, space or quote, so
+# that finding all the matches in a paragraph takes linear time
+_md_inline_re = re.compile(
+    r'\\(?P<escaped>[!-/:-@\[-`{-~])'
+    r'|(?P<image>!?)\[(?P<text>[^\[\]]*)\]'
+    r'\(\s*(?P<href>[^\s)]+)(?:\s+"(?P<title>[^"]*)")?\s*\)'
+    r'|&lt;(?P<url>(?:https?://|mailto:)[^\s&]+)&gt;'
+    r'|(?P<delimiter>\*+|_+)'
+    r'|(?P<br>(?<! ) {2,}|\\)\n'
+)
+_md_word_re = re.compile(r'[0-9A-Za-z]')
+
+# Quotes and lists nested deeper than this are kept as text
+MARKDOWN_MAX_DEPTH = 16
+
+
+def _md_inline_replace(m):
+    if m.group('escaped') is not None:
+        return '&#%d;' % ord(m.group('escaped'))
+    elif m.group('href') is not None:
+        if m.group('image'):
+            return '<img src="%s" alt="%s">' % (
+                _md_quote(m.group('href')), _md_quote(m.group('text')),
+            )
+        title = ''
+        if m.group('title'):
+            title = ' title="%s"' % _md_quote(m.group('title'))
+        return '<a href="%s"%s>%s</a>' % (
+            _md_quote(m.group('href')), title, _md_emphasis(m.group('text')),
+        )
+    elif m.group('url') is not None:
+        return '<a href="%s">%s</a>' % (m.group('url'), m.group('url'))
+    else:
+        return '<br>'
+
+
+def _md_quote(value):
+    return value.replace('"', '&quot;')
+
+
+class _MdDelimiter(object):
+    """A run of ``*`` or ``_``, that can open and close emphasis.
+    """
+    def __init__(self, run, index):
+        self.char = run[0]
+        self.count = len(run)
+        self.index = index
+        self.opening = []
+        self.closing = []
+
+    def __str__(self):
+        # The delimiters used for closing are on the left of the run, those
+        # used for opening on the right, the innermost first
+        return (
+            ''.join(self.closing)
+            + self.char * self.count
+            + ''.join(reversed(self.opening))
+        )
+
+
+def _md_emphasis(text):
+    """Render links and emphasis.
+
+    Delimiters are matched using a stack for each kind, like CommonMark does
+    (without its finer rules), which takes linear time.
+    """
+    parts = []
+    openers = {'*': [], '_': []}
+    pos = 0
+    for m in _md_inline_re.finditer(text):
+        parts.append(text[pos:m.start()])
+        pos = m.end()
+        if m.group('delimiter') is None:
+            parts.append(_md_inline_replace(m))
+            continue
+
+        delimiter = _MdDelimiter(m.group('delimiter'), len(parts))
+        parts.append(delimiter)
+        before = text[m.start() - 1] if m.start() > 0 else ' '
+        after = text[pos] if pos < len(text) else ' '
+        can_open = not after.isspace()
+        can_close = not before.isspace()
+        if delimiter.char == '_':
+            # Underscores don't work inside words
+            can_open = can_open and not _md_word_re.match(before)
+            can_close = can_close and not _md_word_re.match(after)
+
+        stack = openers[delimiter.char]
+        while can_close and delimiter.count and stack:
+            opener = stack[-1]
+            if delimiter.count >= 2 and opener.count >= 2:
+                used, tag = 2, 'strong'
+            else:
+                used, tag = 1, 'em'
+            opener.count -= used
+            delimiter.count -= used
+            opener.opening.append('<%s>' % tag)
+            delimiter.closing.append('</%s>' % tag)
+            if not opener.count:
+                stack.pop()
+
+            # The other kind of delimiters can't be closed across this
+            other = openers['_' if delimiter.char == '*' else '*']
+            while other and other[-1].index > opener.index:
+                other.pop()
+        if can_open and delimiter.count:
+            stack.append(delimiter)
+    parts.append(text[pos:])
+    return ''.join(str(part) for part in parts)
+
+
+def _md_inline(text):
+    """Render the inline elements of Markdown (emphasis, links, code).
+    """
+    # Find code spans, between runs of backticks of the same length
+    runs = [(m.start(), m.end()) for m in _md_backticks_re.finditer(text)]
+    runs_by_length = {}
+    for i, (start, end) in enumerate(runs):
+        runs_by_length.setdefault(end - start, []).append(i)
+    next_run = {}  # Index in runs_by_length of the next run to consider
+
+    output = []
+    pos = 0
+    i = 0
+    while i < len(runs):
+        start, end = runs[i]
+        same_length = runs_by_length[end - start]
+        j = next_run.get(end - start, 0)
+        while j < len(same_length) and same_length[j] <= i:
+            j += 1
+        next_run[end - start] = j
+        if j == len(same_length):
+            i += 1  # No closing run, keep the backticks as text
+            continue
+        closing = same_length[j]
+        output.append(_md_emphasis(_clean_text(text[pos:start])))
+        output.append('<code>%s</code>' % _clean_text(
+            text[end:runs[closing][0]].strip(),
+        ))
+        pos = runs[closing][1]
+        i = closing + 1
+    output.append(_md_emphasis(_clean_text(text[pos:])))
+    return ''.join(output)
+
+
+def _md_heading_text(text):
+    """Remove the optional closing sequence of an ATX heading.
+    """
+    text = text.rstrip(' \t')
+    stripped = text.rstrip('#')
+    if not stripped:
+        return ''
+    elif stripped != text and stripped[-1] in ' \t':
+        return stripped.rstrip(' \t')
+    return text
+
+
+def _md_blocks(lines, size_limit=None):
+    """Render the blocks of Markdown (paragraphs, lists, headings, quotes).
+
+    Nested blocks are rendered using a stack rather than recursion, see
+    ``_md_render_blocks()``.
+    """
+    stack = [_md_render_blocks(lines, 0, size_limit)]
+    html = None
+    while stack:
+        try:
+            nested = stack[-1].send(html)
+        except StopIteration as e:
+            stack.pop()
+            html = e.value
+        else:
+            stack.append(_md_render_blocks(nested, len(stack), None))
+            html = None
+    return html
+
+
+def _md_render_blocks(lines, depth, size_limit):
+    """Generator rendering blocks of Markdown.
+
+    It yields the lines of nested blocks, and is sent their HTML back.
+    """
+    output = _Output(size_limit)
+    paragraph = []
+
+    def end_paragraph():
+        if paragraph:
+            text = '\n'.join(paragraph).rstrip()
+            output.write('<p>%s</p>\n' % _md_inline(text))
+            del paragraph[:]
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if not line.strip():
+            end_paragraph()
+            continue
+
+        m = _md_setext_re.match(line)
+        if m and paragraph:
+            level = 1 if m.group(1)[0] == '=' else 2
+            output.write('<h%d>%s</h%d>\n' % (
+                level, _md_inline('\n'.join(paragraph).rstrip()), level,
+            ))
+            del paragraph[:]
+            continue
+
+        if _md_rule_re.match(line):
+            end_paragraph()
+            output.write('<hr>\n')
+            continue
+
+        m = _md_fence_re.match(line)
+        if m:
+            end_paragraph()
+            fence = m.group(1)
+            code = []
+            while i < len(lines) and not lines[i].lstrip().startswith(fence):
+                code.append(lines[i])
+                i += 1
+            i += 1
+            output.write('<pre><code>%s</code></pre>\n' % _clean_text(
+                ''.join(line + '\n' for line in code),
+            ))
+            continue
+
+        if not paragraph and (line.startswith('    ') or line[0] == '\t'):
+            code = []
+            i -= 1
+            while i < len(lines) and (
+                not lines[i].strip()
+                or lines[i].startswith('    ') or lines[i][0] == '\t'
+            ):
+                if lines[i].startswith('    '):
+                    code.append(lines[i][4:])
+                else:
+                    code.append(lines[i][1:])
+                i += 1
+            while code and not code[-1].strip():
+                code.pop()
+            output.write('<pre><code>%s</code></pre>\n' % _clean_text(
+                ''.join(line + '\n' for line in code),
+            ))
+            continue
+
+        m = _md_heading_re.match(line)
+        if m:
+            end_paragraph()
+            # Only up to <h5> is allowed in documents
+            level = min(len(m.group(1)), 5)
+            output.write('<h%d>%s</h%d>\n' % (
+                level, _md_inline(_md_heading_text(line[m.end():])), level,
+            ))
+            continue
+
+        m = _md_quote_re.match(line)
+        if m and depth < MARKDOWN_MAX_DEPTH:
+            end_paragraph()
+            quote = [line[m.end():]]
+            while i < len(lines) and lines[i].strip():
+                m = _md_quote_re.match(lines[i])
+                quote.append(lines[i][m.end():] if m else lines[i])
+                i += 1
+            html = yield quote
+            output.write('<blockquote>%s</blockquote>\n' % html)
+            continue
+
+        m = _md_item_re.match(line)
+        if m and depth < MARKDOWN_MAX_DEPTH:
+            end_paragraph()
+            ordered = m.group(2)[-1] in '.)'
+            output.write('<ol>' if ordered else '<ul>')
+            while True:
+                indent = m.end()
+                item = [line[indent:]]
+                loose = False
+                while i < len(lines):
+                    line = lines[i]
+                    if not line.strip():
+                        if (
+                            i + 1 < len(lines)
+                            and lines[i + 1].startswith(' ' * indent)
+                        ):
+                            loose = True
+                            item.append('')
+                            i += 1
+                            continue
+                        break
+                    if line.startswith(' ' * indent):
+                        item.append(line[indent:])
+                    elif _md_item_re.match(line):
+                        break
+                    else:  # Lazy continuation
+                        item.append(line)
+                    i += 1
+                html = yield item
+                if not loose and html.startswith('<p>'):
+                    # Tight list, no paragraph in the first block
+                    end = html.index('</p>\n')
+                    html = html[3:end] + html[end + 5:]
+                output.write('<li>%s</li>' % html.strip())
+
+                # Find next item
+                next_line = i
+                while next_line < len(lines) and not lines[next_line].strip():
+                    next_line += 1
+                if next_line >= len(lines):
+                    break
+                m = _md_item_re.match(lines[next_line])
+                if not m or (m.group(2)[-1] in '.)') != ordered:
+                    break
+                line = lines[next_line]
+                i = next_line + 1
+            output.write('</ol>\n' if ordered else '</ul>\n')
+            continue
+
+        paragraph.append(line.lstrip())
+
+    end_paragraph()
+    return output.getvalue()
+
+
+def markdown_to_html(input_filename, engine='single', size_limit=None):
+    """Convert a Markdown file to HTML.
+
+    This supports the common syntax (CommonMark without HTML blocks), and the
+    result is sanitized with ``get_html_body()``.
+    """
+    with _read_text(input_filename) as fp:
+        lines = [line.rstrip('\n') for line in fp]
+    try:
+        return get_html_body(_md_blocks(lines, size_limit), engine=engine)
+    except RecursionError:
+        raise ConversionError("Document is too complex")
+
+
+NATIVE_CONVERTERS = {
+    '.txt': ('txt', text_to_html),
+    '.text': ('txt', text_to_html),
+    '.md': ('md', markdown_to_html),
+    '.markdown': ('md', markdown_to_html),
+    '.csv': ('csv', csv_to_html),
+}
+
+
+@tracer.start_as_current_span('taguette/convert/native_to_html')
+async def native_to_html(input_filename, ext, config):
+    """Convert a text-based format to HTML, without running a process.
+    """
+    fmt, func = NATIVE_CONVERTERS[ext]
+    PROM_NATIVE_TOHTML.labels(fmt).inc()
+    with PROM_NATIVE_TOHTML_TIME.labels(fmt).time():
+        if fmt == 'md':
+            html = await pool.run(
+                func, input_filename,
+                engine=config['SANITIZE_ENGINE'],
+                size_limit=config['HTML_OUT_SIZE_LIMIT'],
+            )
+        else:
+            html = await pool.run(
+                func, input_filename,
+                size_limit=config['HTML_OUT_SIZE_LIMIT'],
+            )
+    if len(html) > config['HTML_OUT_SIZE_LIMIT']:
+        logger.warning("Converted %s file is %d characters; aborting",
+                       fmt, len(html))
+        raise ConversionError("Output file is too long")
+    return html
+
+
+# Office documents, converted in-process when possible
+
+
+class _NativeUnsupported(Exception):
+    """The document uses something the native converter doesn't support.
+    """
+
+
+def _iter_xml(fp):
+    """Go through an XML document in order, without keeping it in memory.
+
+    Yields ``('start', element)``, ``('text', text)``, and
+    ``('end', element)``. Elements have their attributes in 'start' events,
+    children are removed from the tree once they've been seen.
+    """
+    # The parser might be ahead of the events, so keep track of the last
+    # child seen for each open element
+    stack = []
+    for event, elem in ElementTree.iterparse(fp, events=('start', 'end')):
+        if event == 'start':
+            if stack:
+                parent, previous = stack[-1]
+                if previous is not None:
+                    text = previous.tail
+                    parent.remove(previous)
+                else:
+                    text = parent.text
+                if text:
+                    yield 'text', text
+            stack.append([elem, None])
+            yield 'start', elem
+        else:
+            previous = stack.pop()[1]
+            if previous is not None:
+                text = previous.tail
+                elem.remove(previous)
+            else:
+                text = elem.text
+            if text:
+                yield 'text', text
+            yield 'end', elem
+            if stack:
+                stack[-1][1] = elem
+
+
+class _HtmlWriter(_Output):
+    """Writes HTML for the office converters, handling formatting and lists.
+    """
+    def __init__(self, size_limit=None):
+        super(_HtmlWriter, self).__init__(size_limit)
+        self.format = ()
+        self.lists = []
+        self.mark = 0
+
+    def take(self, mark):
+        """Remove and return the output written since a mark.
+        """
+        contents = ''.join(self.output[mark:])
+        del self.output[mark:]
+        self.size -= len(contents)
+        return contents
+
+    def set_format(self, fmt):
+        if fmt != self.format:
+            for tag in reversed(self.format):
+                self.write('</%s>' % tag)
+            for tag in fmt:
+                self.write('<%s>' % tag)
+            self.format = fmt
+
+    def text(self, text, fmt=()):
+        self.set_format(fmt)
+        self.write(_clean_text(text))
+
+    def tag(self, tag):
+        self.set_format(())
+        self.write(tag)
+
+    def set_list(self, level, tag=None):
+        """Close and open lists so we're at a new item at the given level.
+
+        Level -1 means outside of lists.
+        """
+        self.set_format(())
+        lists = self.lists
+        while len(lists) > level + 1 or (
+            lists and len(lists) == level + 1 and lists[-1] != tag
+        ):
+            self.write('</li></%s>\n' % lists.pop())
+        if level < 0:
+            return
+        if len(lists) == level + 1:
+            self.write('</li><li>')
+        while len(lists) < level + 1:
+            self.write('<%s><li>' % tag)
+            lists.append(tag)
+
+    def getvalue(self):
+        self.set_list(-1)
+        return super(_HtmlWriter, self).getvalue()
+
+
+# The XML in office documents is much more verbose than the HTML we get from
+# it, members can be bigger than the output limit up to this factor
+OFFICE_MEMBER_SIZE_FACTOR = 20
+
+
+def _check_zip_sizes(zip, names, size_limit):
+    """Reject an office document if the XML we read from it is too big.
+
+    This is checked before decompressing anything, using the sizes recorded
+    in the ZIP file (which ``zipfile`` won't read past).
+    """
+    if size_limit is None:
+        return
+    for name in names:
+        try:
+            info = zip.getinfo(name)
+        except KeyError:
+            continue
+        if info.file_size > size_limit * OFFICE_MEMBER_SIZE_FACTOR:
+            logger.warning("Office document member %r is %d bytes; aborting",
+                           name, info.file_size)
+            raise ConversionError("Output file is too long")
+
+
+def _zip_xml(zip, name):
+    try:
+        fp = zip.open(name)
+    except KeyError:
+        return None
+    with fp:
+        return ElementTree.parse(fp).getroot()
+
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_R = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_MC = '{http://schemas.openxmlformats.org/markup-compatibility/2006}'
+_DOCX_UNSUPPORTED = {
+    _W + 'txbxContent': "text box",
+    _W + 'footnoteReference': "footnote",
+    _W + 'endnoteReference': "endnote",
+    _W + 'altChunk': "embedded document",
+    _W + 'subDoc': "sub-document",
+    _W + 'sym': "symbol",
+    '{http://schemas.openxmlformats.org/officeDocument/2006/math}oMath':
+        "equation",
+}
+_DOCX_RUN_FORMATS = {
+    _W + 'b': 'strong',
+    _W + 'i': 'em',
+    _W + 'u': 'u',
+    _W + 'strike': 'del',
+    _W + 'dstrike': 'del',
+}
+_DOCX_FALSE = {'0', 'false', 'off', 'none'}
+
+
+def _docx_styles(zip):
+    """Read heading levels and numbering of paragraph styles.
+    """
+    root = _zip_xml(zip, 'word/styles.xml')
+    if root is None:
+        return {}
+    styles = {}
+    for style in root.iter(_W + 'style'):
+        if style.get(_W + 'type') != 'paragraph':
+            continue
+        name = style.find(_W + 'name')
+        name = '' if name is None else name.get(_W + 'val', '').lower()
+        based_on = style.find(_W + 'basedOn')
+        outline = style.find('%spPr/%soutlineLvl' % (_W, _W))
+        num = style.find('%spPr/%snumPr/%snumId' % (_W, _W, _W))
+        styles[style.get(_W + 'styleId')] = dict(
+            name=name,
+            based_on=None if based_on is None else based_on.get(_W + 'val'),
+            outline=None if outline is None else outline.get(_W + 'val'),
+            num=None if num is None else num.get(_W + 'val'),
+        )
+
+    result = {}
+    for style_id in styles:
+        level = num = None
+        current = style_id
+        for _ in range(10):  # Follow 'basedOn' a few times, avoiding loops
+            style = styles.get(current)
+            if style is None:
+                break
+            if level is None:
+                if style['name'] == 'title':
+                    level = 1
+                elif re.match(r'heading [1-9]$', style['name']):
+                    level = int(style['name'][8:])
+                elif style['outline'] and style['outline'].isdigit():
+                    level = int(style['outline']) + 1
+            if num is None:
+                num = style['num']
+            current = style['based_on']
+        result[style_id] = level, num
+    return result
+
+
+def _docx_numbering(zip):
+    """Read which lists are numbered or bulleted.
+    """
+    root = _zip_xml(zip, 'word/numbering.xml')
+    if root is None:
+        return {}
+    abstract = {}
+    for num in root.iter(_W + 'abstractNum'):
+        levels = abstract[num.get(_W + 'abstractNumId')] = {}
+        for lvl in num.iter(_W + 'lvl'):
+            fmt = lvl.find(_W + 'numFmt')
+            fmt = 'bullet' if fmt is None else fmt.get(_W + 'val')
+            levels[lvl.get(_W + 'ilvl')] = (
+                'ul' if fmt in ('bullet', 'none') else 'ol'
+            )
+    numbering = {}
+    for num in root.iter(_W + 'num'):
+        ref = num.find(_W + 'abstractNumId')
+        if ref is not None and ref.get(_W + 'val') in abstract:
+            numbering[num.get(_W + 'numId')] = abstract[ref.get(_W + 'val')]
+    return numbering
+
+
+def _docx_links(zip):
+    root = _zip_xml(zip, 'word/_rels/document.xml.rels')
+    if root is None:
+        return {}
+    return {
+        rel.get('Id'): rel.get('Target')
+        for rel in root
+        if rel.get('TargetMode') == 'External'
+    }
+
+
+_DOCX_MEMBERS = (
+    'word/document.xml',
+    'word/styles.xml',
+    'word/numbering.xml',
+    'word/_rels/document.xml.rels',
+)
+
+
+def docx_to_html(input_filename, engine='single', size_limit=None):
+    """Convert a Word document (DOCX) to HTML.
+
+    Raises ``_NativeUnsupported`` if the document has to go through Calibre,
+    ``ConversionError`` if the output would be longer than ``size_limit``.
+    """
+    try:
+        with zipfile.ZipFile(input_filename) as zip:
+            _check_zip_sizes(zip, _DOCX_MEMBERS, size_limit)
+            styles = _docx_styles(zip)
+            numbering = _docx_numbering(zip)
+            links = _docx_links(zip)
+            with zip.open('word/document.xml') as fp:
+                html = _docx_body(fp, styles, numbering, links, size_limit)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        raise _NativeUnsupported("invalid document: %s" % e)
+    return get_html_body(html, engine=engine)
+
+
+def _docx_body(fp, styles, numbering, links, size_limit=None):
+    writer = _HtmlWriter(size_limit)
+    paragraph = None  # [style, numId, ilvl]
+    fmt = set()
+    in_run = in_text = False
+    hyperlinks = []
+    tables = 0
+    skip = None
+    for event, elem in _iter_xml(fp):
+        if skip is not None:
+            if event == 'end' and elem is skip:
+                skip = None
+            continue
+        if event == 'text':
+            if in_text:
+                writer.text(elem, tuple(t for t in _FORMAT_ORDER if t in fmt))
+            continue
+
+        tag = elem.tag
+        if event == 'start':
+            if tag in _DOCX_UNSUPPORTED:
+                raise _NativeUnsupported(_DOCX_UNSUPPORTED[tag])
+            elif tag == _MC + 'Fallback':
+                skip = elem  # Alternative to mc:Choice, which we read
+            elif tag == _W + 'p':
+                paragraph = [None, None, '0']
+                fmt = set()
+                writer.set_format(())
+                writer.mark = len(writer.output)
+            elif tag == _W + 'pStyle' and paragraph is not None:
+                paragraph[0] = elem.get(_W + 'val')
+            elif tag == _W + 'numId' and paragraph is not None:
+                paragraph[1] = elem.get(_W + 'val')
+            elif tag == _W + 'ilvl' and paragraph is not None:
+                paragraph[2] = elem.get(_W + 'val')
+            elif tag == _W + 'r':
+                fmt = set()
+                in_run = True
+            elif tag in _DOCX_RUN_FORMATS:
+                if elem.get(_W + 'val', 'true').lower() not in _DOCX_FALSE:
+                    fmt.add(_DOCX_RUN_FORMATS[tag])
+            elif tag == _W + 'vertAlign':
+                value = elem.get(_W + 'val')
+                if value == 'superscript':
+                    fmt.add('sup')
+                elif value == 'subscript':
+                    fmt.add('sub')
+            elif tag == _W + 't':
+                in_text = True
+            elif tag == _W + 'hyperlink':
+                if elem.get(_R + 'id') in links:
+                    href = links[elem.get(_R + 'id')]
+                elif elem.get(_W + 'anchor'):
+                    href = '#' + elem.get(_W + 'anchor')
+                else:
+                    href = None
+                hyperlinks.append(href is not None)
+                if href is not None:
+                    writer.tag('<a href="%s">' % _quote_attribute(href))
+            elif tag in (_W + 'drawing', _W + 'pict', _W + 'object'):
+                writer.tag('<img>')
+            elif tag == _W + 'tbl':
+                writer.set_list(-1)
+                writer.tag('<table>')
+                tables += 1
+            elif tag == _W + 'tr':
+                writer.tag('<tr>')
+            elif tag == _W + 'tc':
+                writer.tag('<td>')
+        else:
+            if tag == _W + 't':
+                in_text = False
+            elif tag == _W + 'r':
+                in_run = False
+            elif not in_run:
+                pass
+            elif tag == _W + 'tab':
+                writer.text('\t')
+            elif tag in (_W + 'br', _W + 'cr'):
+                if elem.get(_W + 'type') not in ('page', 'column'):
+                    writer.tag('<br>')
+            elif tag == _W + 'noBreakHyphen':
+                writer.text('-')
+            if tag == _W + 'hyperlink':
+                if hyperlinks.pop():
+                    writer.tag('</a>')
+            elif tag == _W + 'p':
+                writer.set_format(())
+                _docx_paragraph(
+                    writer, paragraph, styles, numbering, tables > 0,
+                )
+                paragraph = None
+            elif tag == _W + 'tc':
+                writer.tag('</td>')
+            elif tag == _W + 'tr':
+                writer.tag('</tr>\n')
+            elif tag == _W + 'tbl':
+                writer.tag('</table>\n')
+                tables -= 1
+    return writer.getvalue()
+
+
+def _docx_paragraph(writer, paragraph, styles, numbering, in_table):
+    """Wrap a paragraph that has been written, now that we know its style.
+    """
+    style, num_id, level = paragraph
+    contents = writer.take(writer.mark)
+    if not contents.strip():
+        return
+    heading, style_num = styles.get(style, (None, None))
+    if num_id is None:
+        num_id = style_num
+    if heading is not None and not in_table:
+        writer.set_list(-1)
+        level = min(heading, 5)
+        writer.write('<h%d>' % level)
+        writer.write(contents)
+        writer.write('</h%d>\n' % level)
+    elif num_id in numbering and not in_table:
+        level = int(level) if level.isdigit() else 0
+        writer.set_list(level, numbering[num_id].get(str(level), 'ul'))
+        writer.write(contents)
+    else:
+        if not in_table:
+            writer.set_list(-1)
+        writer.write('<p>')
+        writer.write(contents)
+        writer.write('</p>\n')
+
+
+_FORMAT_ORDER = ('strong', 'em', 'u', 'del', 'sup', 'sub')
+
+
+def _quote_attribute(value):
+    return _escape(value).replace('"', '&quot;')
+
+
+_TEXT = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+_TABLE = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+_OFFICE = '{urn:oasis:names:tc:opendocument:xmlns:office:1.0}'
+_STYLE = '{urn:oasis:names:tc:opendocument:xmlns:style:1.0}'
+_FO = '{urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0}'
+_DRAW = '{urn:oasis:names:tc:opendocument:xmlns:drawing:1.0}'
+_XLINK = '{http://www.w3.org/1999/xlink}'
+_ODT_UNSUPPORTED = {
+    _TEXT + 'note': "footnote",
+    _DRAW + 'text-box': "text box",
+    _DRAW + 'object': "embedded object",
+}
+# Those are skipped with their contents
+_ODT_SKIPPED = {
+    _TEXT + 'tracked-changes', _OFFICE + 'annotation',
+    _TABLE + 'covered-table-cell', _TEXT + 'note-citation',
+}
+_odt_spaces_re = re.compile(r'[ \t\r\n]+')
+
+
+class _OdtStyles(object):
+    """Text formatting and list styles from an OpenDocument file.
+    """
+    def __init__(self):
+        self.text = {}  # name -> (parent, format)
+        self.lists = {}  # name -> {level: tag}
+        self._style = None
+        self._list = None
+
+    def feed(self, event, elem):
+        """Read style definitions, from a parsed or streamed document.
+        """
+        tag = elem.tag
+        if event == 'start':
+            if tag == _STYLE + 'style':
+                self._style = elem.get(_STYLE + 'name')
+                self.text[self._style] = (
+                    elem.get(_STYLE + 'parent-style-name'), {},
+                )
+            elif tag == _STYLE + 'text-properties' and self._style is not None:
+                fmt = self.text[self._style][1]
+                weight = elem.get(_FO + 'font-weight')
+                if weight is not None:
+                    fmt['strong'] = weight == 'bold' or (
+                        weight.isdigit() and int(weight) >= 600
+                    )
+                style = elem.get(_FO + 'font-style')
+                if style is not None:
+                    fmt['em'] = style in ('italic', 'oblique')
+                underline = elem.get(_STYLE + 'text-underline-style')
+                if underline is not None:
+                    fmt['u'] = underline != 'none'
+                strike = elem.get(_STYLE + 'text-line-through-style')
+                if strike is not None:
+                    fmt['del'] = strike != 'none'
+                position = elem.get(_STYLE + 'text-position')
+                if position is not None:
+                    position = position.split()[0]
+                    fmt['sup'] = position == 'super' or (
+                        position.endswith('%') and position[0] != '-'
+                        and position not in ('0%', '0')
+                    )
+                    fmt['sub'] = position == 'sub' or position[0] == '-'
+            elif tag == _TEXT + 'list-style':
+                self._list = self.lists[elem.get(_STYLE + 'name')] = {}
+            elif (
+                tag == _TEXT + 'list-level-style-number'
+                and self._list is not None
+            ):
+                self._list[elem.get(_TEXT + 'level', '1')] = 'ol'
+            elif (
+                tag == _TEXT + 'list-level-style-bullet'
+                and self._list is not None
+            ):
+                self._list[elem.get(_TEXT + 'level', '1')] = 'ul'
+        elif tag == _STYLE + 'style':
+            self._style = None
+        elif tag == _TEXT + 'list-style':
+            self._list = None
+
+    def format(self, name, fmt):
+        """Apply a text style on the current format.
+        """
+        properties = {}
+        for _ in range(10):  # Follow parents a few times, avoiding loops
+            if name not in self.text:
+                break
+            name, style = self.text[name]
+            for key, value in style.items():
+                properties.setdefault(key, value)
+        if not properties:
+            return fmt
+        fmt = set(fmt)
+        for key, value in properties.items():
+            if value:
+                fmt.add(key)
+            else:
+                fmt.discard(key)
+        return tuple(t for t in _FORMAT_ORDER if t in fmt)
+
+
+def odt_to_html(input_filename, engine='single', size_limit=None):
+    """Convert an OpenDocument text file (ODT) to HTML.
+
+    Raises ``_NativeUnsupported`` if the document has to go through Calibre,
+    ``ConversionError`` if the output would be longer than ``size_limit``.
+    """
+    try:
+        with zipfile.ZipFile(input_filename) as zip:
+            _check_zip_sizes(zip, ('content.xml', 'styles.xml'), size_limit)
+            styles = _OdtStyles()
+            if 'styles.xml' in zip.namelist():
+                with zip.open('styles.xml') as fp:
+                    for event, elem in _iter_xml(fp):
+                        if event != 'text':
+                            styles.feed(event, elem)
+            with zip.open('content.xml') as fp:
+                html = _odt_body(fp, styles, size_limit)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        raise _NativeUnsupported("invalid document: %s" % e)
+    return get_html_body(html, engine=engine)
+
+
+def _odt_body(fp, styles, size_limit=None):
+    writer = _HtmlWriter(size_limit)
+    in_body = False
+    formats = []  # Format for each level of paragraphs and spans
+    paragraphs = []  # Closing tag of each paragraph
+    links = []  # Whether each span is a link
+    lists = []  # Tag and style for each level of list
+    items = []  # Whether each list item has had a paragraph yet
+    frame_image = False
+    skip = None
+    for event, elem in _iter_xml(fp):
+        if skip is not None:
+            if event == 'end' and elem is skip:
+                skip = None
+            continue
+        if not in_body:
+            if event == 'start' and elem.tag == _OFFICE + 'body':
+                in_body = True
+            elif event != 'text':
+                styles.feed(event, elem)
+            continue
+        if event == 'text':
+            if formats:
+                writer.text(_odt_spaces_re.sub(' ', elem), formats[-1])
+            continue
+
+        tag = elem.tag
+        if event == 'start':
+            if tag in _ODT_UNSUPPORTED:
+                raise _NativeUnsupported(_ODT_UNSUPPORTED[tag])
+            elif tag in _ODT_SKIPPED:
+                skip = elem
+            elif tag == _TEXT + 'h':
+                level = elem.get(_TEXT + 'outline-level', '1')
+                level = min(max(int(level) if level.isdigit() else 1, 1), 5)
+                writer.tag('<h%d>' % level)
+                paragraphs.append((len(writer.output) - 1, '</h%d>\n' % level))
+                formats.append(())
+            elif tag == _TEXT + 'p':
+                if items and items[-1] is not None:
+                    # In a list item, separate paragraphs with line breaks
+                    if items[-1]:
+                        writer.tag('<br>')
+                    items[-1] = True
+                    paragraphs.append((None, ''))
+                else:
+                    writer.tag('<p>')
+                    paragraphs.append((len(writer.output) - 1, '</p>\n'))
+                formats.append(
+                    styles.format(elem.get(_TEXT + 'style-name'), ()),
+                )
+            elif tag in (_TEXT + 'span', _TEXT + 'a') and formats:
+                formats.append(styles.format(
+                    elem.get(_TEXT + 'style-name'), formats[-1],
+                ))
+                href = elem.get(_XLINK + 'href')
+                links.append(tag == _TEXT + 'a' and bool(href))
+                if links[-1]:
+                    writer.tag('<a href="%s">' % _quote_attribute(href))
+            elif tag == _TEXT + 's' and formats:
+                count = elem.get(_TEXT + 'c', '1')
+                writer.text(' ' * min(int(count) if count.isdigit() else 1,
+                                      100),
+                            formats[-1])
+            elif tag == _TEXT + 'tab' and formats:
+                writer.text('\t', formats[-1])
+            elif tag == _TEXT + 'line-break':
+                writer.tag('<br>')
+            elif tag == _DRAW + 'frame':
+                frame_image = False
+            elif tag == _DRAW + 'image':
+                # Frames can contain the same image in different formats
+                if not frame_image:
+                    writer.tag('<img>')
+                frame_image = True
+            elif tag == _TEXT + 'list':
+                name = elem.get(_TEXT + 'style-name')
+                if lists:
+                    name = lists[-1][1]
+                list_tag = styles.lists.get(name, {}).get(
+                    str(len(lists) + 1), 'ul',
+                )
+                lists.append((list_tag, name))
+                writer.tag('<%s>' % list_tag)
+            elif tag in (_TEXT + 'list-item', _TEXT + 'list-header'):
+                writer.tag('<li>')
+                items.append(False)
+            elif tag == _TABLE + 'table':
+                writer.tag('<table>')
+                # Paragraphs in tables are not part of the list
+                items.append(None)
+            elif tag == _TABLE + 'table-row':
+                writer.tag('<tr>')
+            elif tag == _TABLE + 'table-cell':
+                writer.tag('<td>')
+                items.append(None)
+        else:
+            if tag in (_TEXT + 'p', _TEXT + 'h'):
+                formats.pop()
+                start, end = paragraphs.pop()
+                writer.set_format(())
+                if start is not None and len(writer.output) == start + 1:
+                    writer.take(start)  # Drop empty paragraph
+                else:
+                    writer.tag(end)
+            elif tag in (_TEXT + 'span', _TEXT + 'a') and formats:
+                formats.pop()
+                if links.pop():
+                    writer.tag('</a>')
+            elif tag == _TEXT + 'list':
+                writer.tag('</%s>\n' % lists.pop()[0])
+            elif tag in (_TEXT + 'list-item', _TEXT + 'list-header'):
+                writer.tag('</li>')
+                items.pop()
+            elif tag == _TABLE + 'table':
+                writer.tag('</table>\n')
+                items.pop()
+            elif tag == _TABLE + 'table-row':
+                writer.tag('</tr>\n')
+            elif tag == _TABLE + 'table-cell':
+                writer.tag('</td>')
+                items.pop()
+    return writer.getvalue()
+
+
+OFFICE_CONVERTERS = {
+    '.docx': ('docx', docx_to_html),
+    '.odt': ('odt', odt_to_html),
+}
+
+
+@tracer.start_as_current_span('taguette/convert/office_to_html')
+async def office_to_html(input_filename, ext, config):
+    """Convert an office document without Calibre, if possible.
+
+    Returns None if the document needs to go through Calibre.
+    """
+    fmt, func = OFFICE_CONVERTERS[ext]
+    try:
+        with PROM_NATIVE_TOHTML_TIME.labels(fmt).time():
+            html = await pool.run(
+                func, input_filename,
+                engine=config['SANITIZE_ENGINE'],
+                size_limit=config['HTML_OUT_SIZE_LIMIT'],
+            )
+    except _NativeUnsupported as e:
+        logger.info("Can't convert %s file natively (%s), using Calibre",
+                    fmt, e)
+        PROM_OFFICE_TOHTML.labels(fmt, 'calibre').inc()
+        return None
+    PROM_OFFICE_TOHTML.labels(fmt, 'native').inc()
+    if len(html) > config['HTML_OUT_SIZE_LIMIT']:
+        logger.warning("Converted %s file is %d characters; aborting",
+                       fmt, len(html))
+        raise ConversionError("Output file is too long")
+    return html
 
 
 HTML_MIMETYPES = {'text/html', 'application/xhtml+xml'}
 
 
-async def to_html(body, content_type, filename, config):
+def _link_input(input_filename, directory, name):
+    """Make the input file available in a directory under the given name.
+
+    Converters use the extension to pick the input format.
+    """
+    path = os.path.join(directory, name)
+    try:
+        os.link(input_filename, path)
+    except OSError:
+        shutil.copyfile(input_filename, path)
+    return path
+
+
+async def to_html(input_filename, content_type, filename, config):
+    """Convert a file to HTML.
+
+    :param input_filename: Path to the file
+    :param filename: Name of the file as uploaded, which selects the converter
+    """
     logger.info("Converting file %r, type %r", filename, content_type)
 
     ext = os.path.splitext(filename)[1].lower()
     if ext in HTML_EXTENSIONS:
-        return get_html_body(body)
+        return await pool.run(
+            get_html_file_body, input_filename,
+            engine=config['SANITIZE_ENGINE'],
+        )
     elif not ext:
         raise ConversionError("This file doesn't have an extension!")
+    elif ext in NATIVE_CONVERTERS:
+        return await native_to_html(input_filename, ext, config)
     elif ext == '.doc':
         # Convert file to HTML using WV
         tmp = tempfile.mkdtemp(prefix='taguette_wv_')
         try:
-            # Write file to temporary directory
-            input_filename = os.path.join(tmp, sanitize_filename(filename))
-            with open(input_filename, 'wb') as fp:
-                fp.write(body)
-
-            # Run wvHtml
             return await wvware_to_html(input_filename, tmp, config)
         finally:
             shutil.rmtree(tmp)
@@ -493,33 +2446,29 @@ async def to_html(body, content_type, filename, config):
         else:
             parser_cls = subtitle_parser.SrtParser
 
-        # Detect encoding
-        charset = chardet.detect(body)['encoding'] or 'utf-8'
-        file = io.BytesIO(body)
-        try:
-            file = codecs.getreader(charset)(file)
-        except LookupError:
-            file = codecs.getreader('utf-8')(file)
-
         # Parse subtitle file
-        try:
-            parser = parser_cls(file)
-            parser.parse()
-        except subtitle_parser.SubtitleError as e:
-            raise ConversionError("Invalid subtitle file: %s" % (e,))
+        with _read_text(input_filename) as file:
+            try:
+                parser = parser_cls(file)
+                parser.parse()
+            except subtitle_parser.SubtitleError as e:
+                raise ConversionError("Invalid subtitle file: %s" % (e,))
 
         # Turn the result into HTML
         output = io.StringIO()
         subtitle_parser.render_html(parser.subtitles, output)
         return output.getvalue()
     else:
+        if ext in OFFICE_CONVERTERS:
+            html = await office_to_html(input_filename, ext, config)
+            if html is not None:
+                return html
+
         # Convert file to HTML using Calibre
         tmp = tempfile.mkdtemp(prefix='taguette_calibre_')
         try:
-            # Write file to temporary directory
-            input_filename = os.path.join(tmp, filename)
-            with open(input_filename, 'wb') as fp:
-                fp.write(body)
+            # Calibre reads the extension from the file name
+            input_filename = _link_input(input_filename, tmp, filename)
 
             # Run Calibre
             return await calibre_to_html(
@@ -531,26 +2480,104 @@ async def to_html(body, content_type, filename, config):
             shutil.rmtree(tmp)
 
 
-async def to_html_chunks(body, content_type, filename, config):
-    html = await to_html(body, content_type, filename, config)
-    # TODO: Do chunks
-    return html
+async def to_html_chunks(input_filename, content_type, filename, config,
+                         cache=None):
+    """Convert a file to HTML, and split it into chunks.
+
+    Returns the HTML, its text index (see ``extract.build_index()``), and its
+    chunks (see ``extract.split_chunks()``).
+
+    If a ``ConversionCache`` is passed, it is looked up before running any
+    converter, and the result of the conversion is stored into it.
+    """
+    key = html = None
+    if cache is not None and cache.enabled:
+        key = await asyncio.get_event_loop().run_in_executor(
+            None,
+            cache.file_key, input_filename, os.path.splitext(filename)[1],
+            '%s-%s' % (CONVERTER_VERSION, config['SANITIZE_ENGINE']),
+        )
+        html = cache.get(key, os.path.getsize(input_filename))
+        if html is not None:
+            logger.info("Using cached conversion of file %r", filename)
+    if html is None:
+        html = await to_html(input_filename, content_type, filename, config)
+        if key is not None:
+            cache.put(key, html)
+    text_index = await pool.run(extract.build_index, html)
+    chunks = await pool.run(extract.split_chunks, html, text_index)
+    return html, text_index, chunks
 
 
 # HTML to something
 
 
+class FileContents(object):
+    """Iterates over the chunks of a file, then closes it.
+
+    ``etag`` is set if the contents are identified by a hash.
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, fp, etag=None, cleanup=None):
+        self.fp = fp
+        self.etag = etag
+        self._cleanup = cleanup
+
+    def __iter__(self):
+        try:
+            chunk = self.fp.read(self.CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = self.fp.read(self.CHUNK_SIZE)
+        finally:
+            self.close()
+
+    def close(self):
+        self.fp.close()
+        if self._cleanup is not None:
+            self._cleanup()
+            self._cleanup = None
+
+
+# Part of the key of the export cache, bump this when the options passed to
+# Calibre change
+EXPORT_VERSION = '%s-1' % __version__
+
+
 @tracer.start_as_current_span('taguette/convert/calibre_from_html')
 @prom_async_time(PROM_CALIBRE_FROMHTML_TIME)
-async def calibre_from_html(html, extension, config):
+async def calibre_from_html(html, extension, config, cache=None):
+    """Convert HTML to another format using Calibre.
+
+    The HTML is either a string or an iterable of chunks of text, which are
+    written to Calibre's input file from a thread (so the iterable can't
+    depend on the event loop, e.g. be reading from the database).
+
+    If an ``ExportCache`` is passed, it is looked up before running Calibre,
+    and the result of the conversion is stored into it.
+    """
     PROM_CALIBRE_FROMHTML.labels(extension).inc()
 
-    # Convert file using Calibre
     tmp = tempfile.mkdtemp(prefix='taguette_calibre_')
     try:
+        # Write the input file, hashing it for the cache
         input_filename = os.path.join(tmp, 'input.html')
-        with open(input_filename, 'w', encoding='utf-8') as fp:
-            fp.write(html)
+        h = await asyncio.get_event_loop().run_in_executor(
+            None,
+            _write_html, html, input_filename,
+        )
+
+        key = None
+        if cache is not None and cache.enabled:
+            key = cache.hash_key(h, extension, EXPORT_VERSION)
+            fp = cache.open(key)
+            if fp is not None:
+                logger.info("Using cached export to %s", extension)
+                shutil.rmtree(tmp)
+                return FileContents(fp, etag=key)
+
+        # Convert file using Calibre
         output_filename = os.path.join(tmp, 'output.%s' % extension)
         convert = 'ebook-convert'
         if os.environ.get('CALIBRE'):
@@ -560,7 +2587,8 @@ async def calibre_from_html(html, extension, config):
         logger.info("Running: %s", ' '.join(cmd))
         try:
             await check_call(cmd, config['CONVERT_FROM_HTML_TIMEOUT'],
-                             env=dict(os.environ, TMPDIR=tmp))
+                             env=dict(os.environ, TMPDIR=tmp),
+                             priority=PRIORITY_BULK)
         except OSError:
             raise ConversionError("Calibre is not available")
         except CalledProcessError:
@@ -570,58 +2598,104 @@ async def calibre_from_html(html, extension, config):
         logger.info("ebook-convert successful")
         if not os.path.isfile(output_filename):
             raise RuntimeError("Output file does not exist")
-    except Exception:
+        if key is not None:
+            await cache.put_file(key, output_filename)
+        fp = open(output_filename, 'rb')
+    except BaseException:
         shutil.rmtree(tmp)
         raise
     else:
-        def reader():
-            try:
-                with open(output_filename, 'rb') as fp:
-                    chunk = fp.read(4096)
-                    yield chunk
-                    while len(chunk) == 4096:
-                        chunk = fp.read(4096)
-                        if chunk:
-                            yield chunk
-            finally:
-                shutil.rmtree(tmp)
+        return FileContents(
+            fp, etag=key,
+            cleanup=lambda: shutil.rmtree(tmp),
+        )
 
-        return reader()
 
+def _write_html(html, filename):
+    """Write HTML passed to ``html_to()`` to a file, returning its hash.
+    """
+    h = hashlib.sha256()
+    with open(filename, 'wb') as fp:
+        for chunk in _html_chunks(html):
+            chunk = chunk.encode('utf-8')
+            h.update(chunk)
+            fp.write(chunk)
+    return h
 
-def html_to_html(html, config):
-    _ = config
+
+def html_to_html(html, config, cache=None):
+    _ = config, cache
     future = asyncio.get_event_loop().create_future()
-    future.set_result([html])
+    future.set_result(_html_chunks(html))
     return future
 
 
+def _html_chunks(html):
+    """Get the chunks of an HTML document passed to ``html_to()``.
+    """
+    if isinstance(html, str):
+        return [html]
+    return html
+
+
+def _calibre_from_html_to(extension):
+    def func(html, config, cache):
+        return calibre_from_html(html, extension, config, cache)
+    return func
+
+
 html_to_extensions = {
     'html': (html_to_html,
              'text/html; charset=utf-8'),
-    'doc': (lambda html, config: calibre_from_html(html, 'docx', config),
+    'doc': (_calibre_from_html_to('docx'),
             'application/vnd.openxmlformats-officedocument.'
             'wordprocessingml.document; charset=utf-8'),
-    'docx': (lambda html, config: calibre_from_html(html, 'docx', config),
+    'docx': (_calibre_from_html_to('docx'),
              'application/vnd.openxmlformats-officedocument.'
              'wordprocessingml.document; charset=utf-8'),
-    'pdf': (lambda html, config: calibre_from_html(html, 'pdf', config),
+    'pdf': (_calibre_from_html_to('pdf'),
             'application/pdf'),
-    'rtf': (lambda html, config: calibre_from_html(html, 'rtf', config),
+    'rtf': (_calibre_from_html_to('rtf'),
             'application/rtf'),
 }
 for n in html_to_extensions:
     PROM_CALIBRE_FROMHTML.labels(n).inc(0)
 
 
-def html_to(html, extension, config):
+def html_to(html, extension, config, cache=None):
+    """Convert HTML to the given format.
+
+    The HTML is either a string, or an iterable of chunks of text so that the
+    whole document doesn't have to be in memory, such as a ``FileContents``.
+    It is iterated on from a thread.
+
+    Returns the mimetype, and a future for an iterable of chunks. If an
+    ``ExportCache`` is passed, it is used for the formats that need Calibre.
+    """
+    func, mimetype = _html_to_extension(extension)
+    return mimetype, asyncio.ensure_future(func(html, config, cache))
+
+
+def html_to_mimetype(extension):
+    """Get the mimetype of documents converted to the given format.
+    """
+    return _html_to_extension(extension)[1]
+
+
+def _html_to_extension(extension):
     try:
-        func, mimetype = html_to_extensions[extension.lower()]
+        return html_to_extensions[extension.lower()]
     except KeyError:
         raise UnsupportedFormat
-    return mimetype, asyncio.ensure_future(func(html, config))
 
 
 def html_to_plaintext(html):
     soup = bs4.BeautifulSoup(html, 'html5lib')
     return soup.get_text(' ', strip=True)
+
+
+def extract_snippet(html, start, end, index=None):
+    """Extract a snippet from a document, and get its plain-text version.
+    """
+    snippet = extract.extract(html, start, end, index)
+    return snippet, html_to_plaintext(snippet)
@@ -16,9 +16,9 @@ import sys
 import taguette
 from .base import PROM_DATABASE_VERSION
 from .copy import copy_project  # noqa: F401
-from .models import Base, JSON, User, Project, Privileges, ProjectMember, \
-    TextDirection, Document, Command, Highlight, Tag, \
-    highlight_tags  # noqa: F401
+from .models import Base, JSON, LongJSON, User, Project, Privileges, \
+    ProjectMember, TextDirection, Document, DocumentChunk, Command, \
+    Highlight, Tag, highlight_tags  # noqa: F401
 
 
 logger = logging.getLogger(__name__)
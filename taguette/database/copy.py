@@ -59,11 +59,14 @@ def copy_project(
     )
 
     # Copy documents
+    # The text index and chunks are not trusted, they will be rebuilt when
+    # needed
     mapping_document = copy(
         Document.__table__, 'id',
         dict(project_id=mapping_project),
         2,
         condition=Document.project_id == project_id,
+        transform=lambda row: dict(row, text_index=None),
         validators=dict(
             name=validate.document_name,
             description=validate.description,
@@ -85,11 +88,14 @@ def copy_project(
     )
 
     # Copy highlights
+    # The plain-text version of snippets is not trusted either, it will be
+    # computed from the snippet when needed
     mapping_highlights = copy(
         Highlight.__table__, 'id',
         dict(document_id=mapping_document),
         50,
         condition=Highlight.document_id.in_(mapping_document.keys()),
+        transform=lambda row: dict(row, snippet_text=None),
         validators=dict(
             start_offset=lambda v: isinstance(v, int) and v >= 0,
             end_offset=lambda v: isinstance(v, int) and v > 0,
@@ -125,13 +131,18 @@ def copy_project(
             | {'date', 'user_login', 'payload'}
         )
         expected_payload_fields = set(method.payload_fields) | {'type'}
+        optional_payload_fields = set(method.optional_payload_fields)
 
         # Check that the right columns are set
         if {k for k, v in cmd.items() if v is not None} != expected_columns:
             raise ValueError("Command doesn't have expected columns")
 
         # Check that the right JSON fields are set
-        if payload.keys() != expected_payload_fields:
+        if (
+            not expected_payload_fields <= payload.keys()
+            or payload.keys() - expected_payload_fields
+            - optional_payload_fields
+        ):
             raise ValueError("Command doesn't have expected fields")
 
         # Map an ID, using negative ID if it's unknown
@@ -157,6 +168,8 @@ def copy_project(
             dest_tag_id=lambda v: isinstance(v, int),
             member=validate.user_login,
             privileges=lambda v: v in Privileges.__members__,
+            job=lambda v: isinstance(v, str) and len(v) <= 64,
+            error=lambda v: isinstance(v, str),
         )
 
         field_transformers = dict(
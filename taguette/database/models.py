@@ -39,12 +39,26 @@ class JSON(TypeDecorator):
     impl = Text
 
     def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
         return json.dumps(value, sort_keys=True)
 
     def process_result_value(self, value, dialect):
+        if value is None:
+            return None
         return json.loads(value)
 
 
+class LongJSON(JSON):
+    """JSON type for large values.
+    """
+    def load_dialect_impl(self, dialect):
+        # MariaDB "text" is 65kB, "longtext" allows 4GB
+        if dialect.name in ('mysql', 'mariadb'):
+            return dialect.type_descriptor(mysql.LONGTEXT())
+        return dialect.type_descriptor(Text())
+
+
 SCRYPT_MAX_MEM = 64 << 20
 
 
@@ -320,6 +334,11 @@ class Document(Base):
         .with_variant(mysql.LONGTEXT(), "mariadb"),
         nullable=False,
     ))
+    # Index of the text nodes, see extract.build_index()
+    text_index = deferred(Column(LongJSON, nullable=True))
+    chunks = relationship('DocumentChunk', cascade='all,delete-orphan',
+                          passive_deletes=True,
+                          order_by='DocumentChunk.start_offset')
     highlights = relationship('Highlight', cascade='all,delete-orphan',
                               passive_deletes=True)
 
@@ -333,10 +352,37 @@ class Document(Base):
         )
 
 
-def command_fields(columns, payload_fields):
+class DocumentChunk(Base):
+    """Part of the contents of a document, see extract.split_chunks().
+    """
+    __tablename__ = 'document_chunks'
+
+    document_id = Column(Integer, ForeignKey('documents.id',
+                                             ondelete='CASCADE'),
+                         primary_key=True)
+    # Position of the chunk in the text of the document, in UTF-8 bytes
+    start_offset = Column(Integer, primary_key=True)
+    contents = Column(
+        Text()
+        .with_variant(mysql.LONGTEXT(), "mysql")
+        .with_variant(mysql.LONGTEXT(), "mariadb"),
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return '<%s.%s document_id=%r start_offset=%r>' % (
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.document_id,
+            self.start_offset,
+        )
+
+
+def command_fields(columns, payload_fields, optional_payload_fields=()):
     def wrapper(func):
         func.columns = columns
         func.payload_fields = payload_fields
+        func.optional_payload_fields = optional_payload_fields
         return func
     return wrapper
 
@@ -382,9 +428,10 @@ class Command(Base):
             cmd_json['tag_count_changes'] = self.tag_count_changes
         return cmd_json
 
-    TYPES = {'project_meta', 'document_add', 'document_delete',
-             'highlight_add', 'highlight_delete', 'tag_add', 'tag_delete',
-             'tag_merge', 'member_add', 'member_remove', 'project_import'}
+    TYPES = {'project_meta', 'document_add', 'document_import_failed',
+             'document_delete', 'highlight_add', 'highlight_delete',
+             'tag_add', 'tag_delete', 'tag_merge', 'member_add',
+             'member_remove', 'project_import'}
 
     for n in TYPES:
         PROM_COMMAND.labels(n).inc(0)
@@ -407,17 +454,36 @@ class Command(Base):
     @command_fields(
         columns=['project_id', 'document_id'],
         payload_fields=['document_name', 'description', 'text_direction'],
+        optional_payload_fields=['job'],
     )
-    def document_add(cls, user_login, document):
+    def document_add(cls, user_login, document, job=None):
         assert isinstance(document.id, int)
+        payload = {'type': 'document_add',  # keep in sync above
+                   'document_name': document.name,
+                   'description': document.description,
+                   'text_direction': document.text_direction.name}
+        if job is not None:
+            payload['job'] = job
         return cls(
             user_login=user_login,
             project=document.project,
             document_id=document.id,
-            payload={'type': 'document_add',  # keep in sync above
-                     'document_name': document.name,
-                     'description': document.description,
-                     'text_direction': document.text_direction.name},
+            payload=payload,
+        )
+
+    @classmethod
+    @command_fields(
+        columns=['project_id'],
+        payload_fields=['job', 'error'],
+    )
+    def document_import_failed(cls, user_login, project_id, job, error):
+        assert isinstance(project_id, int)
+        return cls(
+            user_login=user_login,
+            project_id=project_id,
+            payload={'type': 'document_import_failed',  # keep in sync above
+                     'job': job,
+                     'error': error},
         )
 
     @classmethod
@@ -601,9 +667,17 @@ class Highlight(Base):
     start_offset = Column(Integer, nullable=False)
     end_offset = Column(Integer, nullable=False)
     snippet = Column(Text, nullable=False)
+    # Plain-text version of the snippet, for exports. Can be NULL for
+    # highlights that were not backfilled, then the snippet gets converted
+    snippet_text = Column(Text, nullable=True)
     tags = relationship('Tag', secondary='highlight_tags',
                         back_populates='highlights')
 
+    __table_args__ = (
+        # Order of highlights in exports
+        Index('idx_document_offset', 'document_id', 'start_offset', 'id'),
+    ) + __table_args__
+
     def __repr__(self):
         return '<%s.%s %r document_id=%r tags=[%s]>' % (
             self.__class__.__module__,
@@ -1,14 +1,23 @@
 import asyncio
 import contextlib
 import csv
+import functools
 import importlib_resources
+import io
+import itertools
 import jinja2
+import logging
+import os
+import shutil
 import sqlalchemy
 from markupsafe import Markup
 import opentelemetry.trace
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import defer, joinedload
+import tempfile
+import time
 import uuid
 import xlsxwriter
+import zipfile
 from xml.sax.saxutils import XMLGenerator
 from xml.sax.xmlreader import AttributesNSImpl
 
@@ -16,8 +25,10 @@ from . import exact_version
 from . import convert
 from . import database
 from . import extract
+from . import pool
 
 
+logger = logging.getLogger(__name__)
 tracer = opentelemetry.trace.get_tracer(__name__)
 
 
@@ -30,11 +41,23 @@ template_env = jinja2.Environment(
 )
 
 
+# Number of characters in the chunks of streamed templates
+RENDER_CHUNK_SIZE = 65536
+
+
 def _render_string(template_name, locale, **kwargs):
+    return ''.join(_render_chunks(template_name, locale, **kwargs))
+
+
+def _render_chunks(template_name, locale, **kwargs):
+    """Render a template as it is iterated on, in chunks of text.
+
+    This way the whole document doesn't need to be in memory.
+    """
     translator = _Translator(locale)
 
     template = template_env.get_template(template_name)
-    return template.render(
+    fragments = template.generate(
         version=exact_version(),
         gettext=translator.gettext,
         ngettext=translator.ngettext,
@@ -42,6 +65,64 @@ def _render_string(template_name, locale, **kwargs):
         **kwargs,
     )
 
+    # Jinja generates many small fragments, join them
+    chunk = []
+    size = 0
+    for fragment in fragments:
+        chunk.append(fragment)
+        size += len(fragment)
+        if size >= RENDER_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+async def _render_file(template_name, locale, **kwargs):
+    """Render a template to a temporary file, from a thread.
+
+    Returns the chunks of text of the file. Iterables passed to the template
+    that can only be used from the event loop, like query results, have to be
+    wrapped with ``_iterate_from_loop()``.
+    """
+    loop = asyncio.get_event_loop()
+    fp = tempfile.TemporaryFile('w+', encoding='utf-8',
+                                prefix='taguette_export_')
+    try:
+        await loop.run_in_executor(
+            None,
+            _write_chunks, fp, _render_chunks(template_name, locale, **kwargs),
+        )
+        fp.seek(0, 0)
+    except BaseException:
+        fp.close()
+        raise
+    return convert.FileContents(fp)
+
+
+def _write_chunks(fp, chunks):
+    for chunk in chunks:
+        fp.write(chunk)
+
+
+def _iterate_from_loop(loop, iterable):
+    """Iterate, from a thread, on an iterable that has to be used from the
+    event loop.
+
+    The items are read on the event loop in batches of ``EXPORT_BATCH_SIZE``.
+    """
+    iterator = iter(iterable)
+
+    async def next_batch():
+        return list(itertools.islice(iterator, EXPORT_BATCH_SIZE))
+
+    while True:
+        batch = asyncio.run_coroutine_threadsafe(next_batch(), loop).result()
+        if not batch:
+            return
+        yield from batch
+
 
 class _Translator(object):
     def __init__(self, locale):
@@ -71,106 +152,124 @@ class _Translator(object):
         return trans
 
 
+# Number of rows read from the database at a time when exporting highlights,
+# and number of highlights per chunk of streamed output
+EXPORT_BATCH_SIZE = 1000
+
+
 def _get_highlights_for_export(db, project_id, path):
+    """Iterate on the highlights to export, grouping their tags.
+
+    This generates ``(id, snippet, snippet_text, document_name, tags)``
+    tuples, where ``snippet_text`` might be None (see ``_snippet_text()``).
+    Highlights are read from the database in pages of ``EXPORT_BATCH_SIZE``,
+    so that memory use doesn't depend on the size of the project. Each page
+    is read entirely before being yielded, so no cursor is left open (which
+    would keep SQLite locked while the caller sends the data).
+    """
+    t_highlight = database.Highlight.__table__
+    t_highlight_tag = database.highlight_tags
+    t_tag = database.Tag.__table__
+    t_document = database.Document.__table__
+    tables = (
+        t_highlight
+        .join(
+            t_highlight_tag,
+            t_highlight.c.id == t_highlight_tag.c.highlight_id,
+        )
+        .join(
+            t_tag,
+            t_tag.c.id == t_highlight_tag.c.tag_id,
+        )
+        .join(
+            t_document,
+            t_document.c.id == t_highlight.c.document_id,
+        )
+    )
+    # Highlights that have a tag, matching the path if given. Done as a
+    # subquery so that all the tags of those highlights can be returned
+    t_highlight_tag_m = database.highlight_tags.alias()
+    has_tag = (
+        sqlalchemy.select([t_highlight_tag_m.c.highlight_id])
+        .where(t_highlight_tag_m.c.highlight_id == t_highlight.c.id)
+    )
     if path:
-        t_highlight = database.Highlight.__table__
-        t_highlight_tag = database.highlight_tags
-        t_tag = database.Tag.__table__
-        t_document = database.Document.__table__
-        # Join with tags a second time to find highlights that match the
-        # given path, while returning all tags for those highlights
-        t_highlight_tag_m = database.highlight_tags.alias()
         t_tag_m = database.Tag.__table__.alias()
-        query = (
-            sqlalchemy.select([
-                t_highlight.c.id,
-                t_highlight.c.snippet,
-                t_document.c.name,
-                t_tag.c.path,
-            ])
-            .select_from(
-                t_highlight
-                .join(
-                    t_highlight_tag,
-                    t_highlight.c.id == t_highlight_tag.c.highlight_id,
-                )
-                .join(
-                    t_tag,
-                    t_tag.c.id == t_highlight_tag.c.tag_id,
-                )
-                .join(
-                    t_highlight_tag_m,
-                    t_highlight.c.id == t_highlight_tag_m.c.highlight_id,
-                )
-                .join(
-                    t_tag_m,
-                    t_tag_m.c.id == t_highlight_tag_m.c.tag_id,
-                )
-                .join(
-                    t_document,
-                    t_document.c.id == t_highlight.c.document_id,
-                )
-            )
+        has_tag = (
+            has_tag
+            .where(t_tag_m.c.id == t_highlight_tag_m.c.tag_id)
             .where(t_tag_m.c.path.startswith(path, autoescape=True))
+        )
+    conditions = [
+        t_highlight.c.document_id.in_(
+            sqlalchemy.select([t_document.c.id])
             .where(t_document.c.project_id == project_id)
-            .order_by(
-                t_highlight.c.document_id,
-                t_highlight.c.start_offset,
-                t_highlight.c.id,
-            )
+        ),
+        has_tag.exists(),
+    ]
+    order = [
+        t_highlight.c.document_id,
+        t_highlight.c.start_offset,
+        t_highlight.c.id,
+    ]
+
+    last = None
+    while True:
+        # Get the next page of highlights, starting after the last one
+        page = (
+            sqlalchemy.select(order)
+            .where(*conditions)
+            .order_by(*order)
+            .limit(EXPORT_BATCH_SIZE)
         )
-    else:
-        # Special case to select all highlights: we also need to select
-        # highlights that have no tag at all, so the startswith() condition
-        # would not work
-        t_highlight = database.Highlight.__table__
-        t_highlight_tag = database.highlight_tags
-        t_tag = database.Tag.__table__
-        t_document = database.Document.__table__
-        query = (
+        if last is not None:
+            page = page.where(
+                sqlalchemy.tuple_(*order) > sqlalchemy.tuple_(*last)
+            )
+        page = db.execute(page).fetchall()
+        if not page:
+            break
+        last = page[-1]
+
+        # Get those highlights with their tags
+        rows = db.execute(
             sqlalchemy.select([
                 t_highlight.c.id,
                 t_highlight.c.snippet,
+                t_highlight.c.snippet_text,
                 t_document.c.name,
                 t_tag.c.path,
             ])
-            .select_from(
-                t_highlight
-                .join(
-                    t_highlight_tag,
-                    t_highlight.c.id == t_highlight_tag.c.highlight_id,
+            .select_from(tables)
+            .where(t_highlight.c.id.in_([key[2] for key in page]))
+            .order_by(*order)
+        ).fetchall()
+        del page
+
+        current = None
+        for highlight_id, snippet, snippet_text, document, tag_path in rows:
+            if current is not None and current[0] == highlight_id:
+                current[4].append(tag_path)
+            else:
+                if current is not None:
+                    yield current
+                current = (
+                    highlight_id,
+                    snippet,
+                    snippet_text,
+                    document,
+                    [tag_path],
                 )
-                .join(
-                    t_tag,
-                    t_tag.c.id == t_highlight_tag.c.tag_id,
-                )
-                .join(
-                    t_document,
-                    t_document.c.id == t_highlight.c.document_id,
-                )
-            )
-            .where(t_document.c.project_id == project_id)
-            .order_by(
-                t_highlight.c.document_id,
-                t_highlight.c.start_offset,
-                t_highlight.c.id,
-            )
-        )
+        if current is not None:
+            yield current
 
-    highlights = []
-    for row in db.execute(query).fetchall():
-        highlight_id, snippet, document, tag_path = row
-        if highlights and highlights[-1][0] == highlight_id:
-            highlights[-1][3].append(tag_path)
-        else:
-            highlights.append((
-                highlight_id,
-                snippet,
-                document,
-                [] if tag_path is None else [tag_path],
-            ))
 
-    return highlights
+def _snippet_text(snippet, snippet_text):
+    # The plain-text version is stored with highlights, only convert the
+    # snippet if it is missing
+    if snippet_text is None:
+        return convert.html_to_plaintext(snippet)
+    return snippet_text
 
 
 def get_filename_for_highlights_export(path):
@@ -182,30 +281,55 @@ def get_filename_for_highlights_export(path):
         return 'all_tags'
 
 
-@tracer.start_as_current_span('taguette/export/highlights_csv')
-def highlights_csv(db, project_id, path, file):
-    """Export highlights to a CSV file.
+def highlights_csv(db, project_id, path):
+    """Export highlights to CSV.
+
+    This generates the CSV file in chunks of ``EXPORT_BATCH_SIZE``
+    highlights, so the caller can send each one before reading more.
     """
-    highlights = _get_highlights_for_export(db, project_id, path)
-    writer = csv.writer(file)
-    writer.writerow(['id', 'document', 'tag', 'content'])
-    for id, snippet, document, tags in highlights:
-        if not tags:
-            tags = ['']
-        for tag_path in tags:
-            writer.writerow([
-                id, document, tag_path,
-                convert.html_to_plaintext(snippet),
-            ])
+    span = tracer.start_span('taguette/export/highlights_csv')
+    try:
+        highlights = _get_highlights_for_export(db, project_id, path)
+        file = io.StringIO()
+        writer = csv.writer(file)
+        writer.writerow(['id', 'document', 'tag', 'content'])
+        for i, highlight in enumerate(highlights, 1):
+            id, snippet, snippet_text, document, tags = highlight
+            snippet_text = _snippet_text(snippet, snippet_text)
+            if not tags:
+                tags = ['']
+            for tag_path in tags:
+                writer.writerow([id, document, tag_path, snippet_text])
+            if i % EXPORT_BATCH_SIZE == 0:
+                yield file.getvalue()
+                file.seek(0)
+                file.truncate()
+        yield file.getvalue()
+    finally:
+        span.end()
+
+
+def _open_workbook(filename):
+    # Rows have to be written in order, but are flushed to a temporary file
+    # next to the output instead of being kept in memory
+    return xlsxwriter.Workbook(filename, {
+        'constant_memory': True,
+        'tmpdir': os.path.dirname(os.path.abspath(filename)),
+    })
 
 
 @tracer.start_as_current_span('taguette/export/highlights_xlsx')
-def highlights_xslx(db, project_id, path, filename):
+async def highlights_xslx(db, project_id, path, filename):
     """Export highlights to an Excel file.
+
+    Highlights are read from the database in batches, and each batch is
+    written out from a thread (using xlsxwriter's constant memory mode, rows
+    go to disk rather than staying in memory).
     """
+    loop = asyncio.get_event_loop()
     highlights = _get_highlights_for_export(db, project_id, path)
 
-    workbook = xlsxwriter.Workbook(filename)
+    workbook = _open_workbook(filename)
     sheet = workbook.add_worksheet('highlights')
 
     header = workbook.add_format({'bold': True})
@@ -219,40 +343,65 @@ def highlights_xslx(db, project_id, path, filename):
     sheet.set_column(2, 2, 15.0)
     sheet.set_column(3, 3, 80.0)
     row = 1
-    for id, snippet, document, tags in highlights:
+    batch = list(itertools.islice(highlights, EXPORT_BATCH_SIZE))
+    while batch:
+        row = await loop.run_in_executor(
+            None,
+            _write_highlights_rows, sheet, row, batch,
+        )
+        batch = list(itertools.islice(highlights, EXPORT_BATCH_SIZE))
+    await loop.run_in_executor(None, workbook.close)
+
+
+def _write_highlights_rows(sheet, row, highlights):
+    for id, snippet, snippet_text, document, tags in highlights:
+        snippet_text = _snippet_text(snippet, snippet_text)
         if not tags:
             tags = ['']
         for tag_path in tags:
             sheet.write(row, 0, str(id))
             sheet.write(row, 1, document)
             sheet.write(row, 2, tag_path)
-            sheet.write(row, 3, convert.html_to_plaintext(snippet))
+            sheet.write(row, 3, snippet_text)
             row += 1
-    workbook.close()
+    return row
 
 
 @tracer.start_as_current_span('taguette/export/highlights_doc')
-def highlights_doc(db, project_id, path, ext, *, config, locale):
+async def highlights_doc(db, project_id, path, ext, *, config, locale,
+                         cache=None):
     """Export highlights to a text document.
+
+    The highlights are rendered to a temporary file first, the database
+    session is closed before converting it.
+
+    :param cache: ``ExportCache`` to use if converting with Calibre
     """
     highlights = _get_highlights_for_export(db, project_id, path)
 
-    html = _render_string(
+    html = await _render_file(
         'export_highlights.html',
         locale,
         path=path,
-        highlights=highlights,
+        highlights=_iterate_from_loop(asyncio.get_event_loop(), highlights),
     )
 
-    mimetype, contents = convert.html_to(html, ext, config)
+    # Close DB connection to not overflow the connection pool
+    db.close()
+
+    mimetype, contents = convert.html_to(html, ext, config, cache)
+    contents = await contents
     return mimetype, contents
 
 
 @tracer.start_as_current_span('taguette/export/highlighted_document')
-async def highlighted_document(db, document, ext, *, config, locale):
+async def highlighted_document(db, document, ext, *, config, locale,
+                               cache=None):
     """Export a document annotated with highlights.
 
     Each highlight is followed by its tags in brackets.
+
+    :param cache: ``ExportCache`` to use if converting with Calibre
     """
     highlights = (
         db.query(database.Highlight)
@@ -266,29 +415,200 @@ async def highlighted_document(db, document, ext, *, config, locale):
         for hl in highlights
     ]
 
-    html = await asyncio.get_event_loop().run_in_executor(
-        None,
-        lambda: extract.highlight(
-            document.contents, highlights,
-            show_tags=True,
-        ),
-    )
+    name, contents = document.name, document.contents
 
-    html = _render_string(
-        'export_document.html',
-        locale,
-        name=document.name,
-        contents=Markup(html),
+    # Close DB connection to not overflow the connection pool
+    db.close()
+
+    html = await _highlighted_document_html(
+        name, contents, highlights,
+        config=config, locale=locale,
     )
 
     mimetype, contents = convert.html_to(
         html, ext,
-        config,
+        config, cache,
     )
     contents = await contents
     return mimetype, contents
 
 
+async def _highlighted_document_html(name, contents, highlights, *,
+                                     config, locale):
+    html = await pool.run(
+        extract.highlight,
+        contents, highlights,
+        show_tags=True,
+        engine=config['HIGHLIGHT_ENGINE'],
+    )
+
+    return await asyncio.get_event_loop().run_in_executor(
+        None,
+        functools.partial(
+            _render_string,
+            'export_document.html',
+            locale,
+            name=name,
+            contents=Markup(html),
+        ),
+    )
+
+
+class _ZipOutput(object):
+    """Non-seekable file collecting what ``zipfile`` writes, see ``take()``.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """Get what was written since the last call.
+        """
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _zip_member_name(name, ext, used):
+    name = name.replace('/', '_').replace('\\', '_').strip() or 'document'
+    filename = '%s.%s' % (name, ext)
+    i = 1
+    while filename in used:
+        i += 1
+        filename = '%s (%d).%s' % (name, i, ext)
+    used.add(filename)
+    return filename
+
+
+async def documents_zip(db, project_id, ext, *, config, locale, cache=None,
+                        errors=None):
+    """Export all the documents of a project, with highlights, to a ZIP file.
+
+    This is an asynchronous generator of chunks of the archive. The documents
+    are rendered concurrently, as many at once as the process pool has
+    workers, and each one is added to the archive as soon as it is done, in
+    no particular order. A document that can't be exported is
+    replaced by a text file with the error.
+
+    The database session is closed whenever it is not being read from, so
+    that the connection is not held during conversions.
+
+    :param cache: ``ExportCache`` to use if converting with Calibre
+    :param errors: Optional list, the names of the documents that couldn't
+        be exported are appended to it
+    """
+    convert.html_to_mimetype(ext)  # Raises UnsupportedFormat
+
+    documents = (
+        db.query(database.Document.id, database.Document.name)
+        .filter(database.Document.project_id == project_id)
+        .order_by(database.Document.id)
+    ).all()
+
+    # Get all the highlights in one query
+    highlights = {}
+    query = (
+        db.query(database.Highlight)
+        .join(database.Highlight.document)
+        .filter(database.Document.project_id == project_id)
+        .order_by(database.Highlight.document_id,
+                  database.Highlight.start_offset)
+        .options(defer('snippet'),
+                 defer('snippet_text'),
+                 joinedload(database.Highlight.tags))
+    )
+    for hl in query:
+        highlights.setdefault(hl.document_id, []).append(
+            (hl.start_offset, hl.end_offset, [t.path for t in hl.tags]),
+        )
+    db.close()
+
+    # Don't queue more highlighting than the pool has workers for, which
+    # also bounds how many documents are in memory at once
+    window = max(pool.size(), 1)
+
+    async def render(document_id, name):
+        try:
+            contents = (
+                db.query(database.Document.contents)
+                .filter(database.Document.id == document_id)
+            ).scalar()
+            db.close()
+            html = await _highlighted_document_html(
+                name, contents, highlights.pop(document_id, []),
+                config=config, locale=locale,
+            )
+            del contents
+            _, chunks = convert.html_to(html, ext, config, cache)
+            return name, await chunks, None
+        except convert.ConversionError as e:
+            error = "Conversion error: %s" % e
+        except pool.PoolFull:
+            error = "The server is busy, try again later"
+        except pool.PoolTimeout:
+            error = "The document took too long to process"
+        logger.warning("Can't export document %d to %s: %s",
+                       document_id, ext, error)
+        return name, None, error
+
+    compression = zipfile.ZIP_DEFLATED if ext == 'html' else zipfile.ZIP_STORED
+    output = _ZipOutput()
+    used_names = set()
+    documents = iter(documents)
+    pending = set()
+    try:
+        with zipfile.ZipFile(output, 'w', compression) as archive:
+            while True:
+                while len(pending) < window:
+                    document = next(documents, None)
+                    if document is None:
+                        break
+                    pending.add(asyncio.ensure_future(render(*document)))
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    name, chunks, error = task.result()
+                    if error is not None:
+                        if errors is not None:
+                            errors.append(name)
+                        filename = _zip_member_name(
+                            name, 'error.txt', used_names,
+                        )
+                        archive.writestr(filename, error + '\n')
+                        yield output.take()
+                        continue
+                    filename = _zip_member_name(name, ext, used_names)
+                    # The size is not known in advance, and the output can't
+                    # be seeked to fix the header of a big entry afterwards
+                    with archive.open(filename, 'w', force_zip64=True) as fp:
+                        for chunk in chunks:
+                            if isinstance(chunk, str):
+                                chunk = chunk.encode('utf-8')
+                            fp.write(chunk)
+                            data = output.take()
+                            if data:
+                                yield data
+                    data = output.take()
+                    if data:
+                        yield data
+        yield output.take()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
 TAGUETTE_NAMESPACE = uuid.UUID('51B2B2B7-27EB-4ECB-9D56-E75B0A0496C2')
 
 
@@ -371,7 +691,7 @@ def codebook_csv(tags, file):
 def codebook_xlsx(tags, filename):
     """Export a codebook in Excel format for the given tags.
     """
-    workbook = xlsxwriter.Workbook(filename)
+    workbook = _open_workbook(filename)
     sheet = workbook.add_worksheet('codebook')
 
     header = workbook.add_format({'bold': True})
@@ -391,10 +711,12 @@ def codebook_xlsx(tags, filename):
 
 
 @tracer.start_as_current_span('taguette/export/codebook_document')
-async def codebook_document(tags, ext, *, config, locale):
+async def codebook_document(tags, ext, *, config, locale, cache=None):
     """Export a codebook as a text document for the given tags.
+
+    :param cache: ``ExportCache`` to use if converting with Calibre
     """
-    html = _render_string(
+    html = await _render_file(
         'export_codebook.html',
         locale,
         tags=tags,
@@ -402,7 +724,116 @@ async def codebook_document(tags, ext, *, config, locale):
 
     mimetype, contents = convert.html_to(
         html, ext,
-        config,
+        config, cache,
     )
     contents = await contents
     return mimetype, contents
+
+
+class TooManyExportJobs(Exception):
+    """The user has too many exports running already.
+    """
+
+
+class ExportJob(object):
+    """An export running in the background, see ``ExportJobs``.
+
+    ``status`` is one of 'running', 'done', 'failed'. Once done, the result
+    is in the file ``filename``, and ``name`` and ``mimetype`` are set.
+    """
+    def __init__(self, key, project_id, extension, user_login, directory):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.project_id = project_id
+        self.user_login = user_login
+        self.extension = extension
+        self.filename = os.path.join(directory, self.id)
+        self.status = 'running'
+        self.error = None
+        self.name = None
+        self.mimetype = None
+        self.finished = None
+
+    def done(self, name, mimetype):
+        self.status = 'done'
+        self.name = name
+        self.mimetype = mimetype
+        self.finished = time.time()
+
+    def failed(self, error):
+        self.status = 'failed'
+        self.error = error
+        self.finished = time.time()
+
+
+class ExportJobs(object):
+    """Exports running in the background, and their results.
+
+    Jobs are looked up by the key of the export, so asking for the same
+    export again while it is running, or after it is done, gets the same job
+    rather than starting over. Finished jobs and their files are kept for
+    ``ttl`` seconds. A user can have at most ``max_running`` jobs running.
+    """
+    def __init__(self, ttl, max_running):
+        self.ttl = ttl
+        self.max_running = max_running
+        self.directory = None
+        self._jobs = {}
+        self._by_key = {}
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def get(self, job_id):
+        self.expire()
+        return self._jobs.get(job_id)
+
+    def add(self, key, project_id, extension, user_login):
+        """Get the job for an export, creating it if needed.
+
+        Returns the job, and whether it was created (in which case the
+        caller should run it). Raises ``TooManyExportJobs`` if a job would
+        have to be created but the user has too many running.
+        """
+        self.expire()
+        job = self._jobs.get(self._by_key.get(key))
+        if job is not None and job.status != 'failed':
+            return job, False
+
+        running = sum(
+            1 for other in self._jobs.values()
+            if other.status == 'running' and other.user_login == user_login
+        )
+        if running >= self.max_running:
+            raise TooManyExportJobs()
+
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='taguette_export_jobs_')
+        job = ExportJob(key, project_id, extension, user_login,
+                        self.directory)
+        self._jobs[job.id] = job
+        self._by_key[key] = job.id
+        return job, True
+
+    def expire(self):
+        """Remove the jobs that finished more than ``ttl`` seconds ago.
+        """
+        limit = time.time() - self.ttl
+        for job in list(self._jobs.values()):
+            if job.finished is not None and job.finished < limit:
+                del self._jobs[job.id]
+                if self._by_key.get(job.key) == job.id:
+                    del self._by_key[job.key]
+                try:
+                    os.remove(job.filename)
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """Forget all the jobs and remove their files, when shutting down.
+        """
+        self._jobs.clear()
+        self._by_key.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
@@ -1,8 +1,20 @@
+import array
+import bisect
 from bs4 import BeautifulSoup, NavigableString
+from bs4.builder import HTMLTreeBuilder
+from bs4.formatter import HTMLFormatter
+import copy
+import html as html_module
+import itertools
+import logging
 import opentelemetry.trace
 import prometheus_client
+import re
 
+from . import pool
 
+
+logger = logging.getLogger(__name__)
 tracer = opentelemetry.trace.get_tracer(__name__)
 
 
@@ -15,11 +27,100 @@ PROM_EXTRACT_TIME = prometheus_client.Histogram(
     "Time to extract part of an HTML document (extract.extract())",
     buckets=BUCKETS,
 )
+PROM_EXTRACT_MANY_TIME = prometheus_client.Histogram(
+    'html_extract_many_seconds',
+    "Time to extract many parts of an HTML document (extract.extract_many())",
+    buckets=BUCKETS + [2.0, 5.0, 10.0],
+)
 PROM_HIGHLIGHT_TIME = prometheus_client.Histogram(
     'html_highlight_seconds',
     "Time to add highlight tags to an HTML document (extract.highlight())",
     buckets=BUCKETS,
 )
+PROM_INDEX_TIME = prometheus_client.Histogram(
+    'html_index_seconds',
+    "Time to build the text index of an HTML document (extract.build_index())",
+    buckets=BUCKETS + [2.0, 5.0, 10.0],
+)
+PROM_INDEX = prometheus_client.Counter(
+    'html_index_total',
+    "Text indexes built for HTML documents (extract.build_index())",
+    ['result'],
+)
+PROM_INDEX.labels('indexed').inc(0)
+PROM_INDEX.labels('unsupported').inc(0)
+PROM_HIGHLIGHT_ENGINE = prometheus_client.Counter(
+    'html_highlight_engine_total',
+    "Documents highlighted by each engine (extract.highlight())",
+    ['engine'],
+)
+PROM_HIGHLIGHT_ENGINE.labels('soup').inc(0)
+PROM_HIGHLIGHT_ENGINE.labels('stream').inc(0)
+pool.forward_metrics(
+    PROM_EXTRACT_TIME, PROM_EXTRACT_MANY_TIME, PROM_HIGHLIGHT_TIME,
+    PROM_INDEX_TIME, PROM_INDEX, PROM_HIGHLIGHT_ENGINE,
+)
+
+
+def _utf8_size(char):
+    code = ord(char)
+    if code < 0x80:
+        return 1
+    elif code < 0x800:
+        return 2
+    elif code < 0x10000:
+        return 3
+    else:
+        return 4
+
+
+class Utf8Offsets(object):
+    """Converts UTF-8 byte offsets in a string into codepoint indexes.
+
+    The table of the byte offset of each codepoint is built once, and each
+    conversion is then a binary search (or nothing at all for ASCII).
+    """
+    __slots__ = ('length', 'prefix')
+
+    def __init__(self, string):
+        self.length = len(string)
+        if string.isascii():
+            self.prefix = None
+        else:
+            self.prefix = array.array(
+                'L',
+                itertools.accumulate(map(_utf8_size, string), initial=0),
+            )
+
+    def byte_size(self):
+        """The size of the whole string in UTF-8.
+        """
+        if self.prefix is None:
+            return self.length
+        return self.prefix[-1]
+
+    def byte_offset(self, str_index):
+        """Converts a codepoint index into a byte offset.
+        """
+        if self.prefix is None:
+            return str_index
+        return self.prefix[str_index]
+
+    def str_index(self, byte_index, round_up=False):
+        """Converts a byte offset into a codepoint index.
+
+        If the offset falls inside of a codepoint, it is rounded down, or up
+        if ``round_up`` is set. Offsets past the end give the length.
+        """
+        if byte_index <= 0:
+            return 0
+        elif self.prefix is None:
+            return min(byte_index, self.length)
+        elif round_up:
+            idx = bisect.bisect_left(self.prefix, byte_index)
+        else:
+            idx = bisect.bisect_right(self.prefix, byte_index) - 1
+        return min(idx, self.length)
 
 
 def split_utf8(s, pos):
@@ -28,10 +129,8 @@ def split_utf8(s, pos):
     If the position falls inside of a codepoint, the string will be split after
     that codepoint.
     """
-    s = s.encode('utf-8')
-    while pos < len(s) and 0x80 <= s[pos] <= 0xBF:
-        pos += 1
-    return s[:pos].decode('utf-8'), s[pos:].decode('utf-8')
+    idx = Utf8Offsets(s).str_index(pos, round_up=True)
+    return s[:idx], s[idx:]
 
 
 def find_pos(node, offset, after):
@@ -74,9 +173,230 @@ def delete_right(node, indices):
         node = node.contents[idx]
 
 
+def _body_contents(soup):
+    """Serialize the contents of the body of a parsed document.
+    """
+    # Remove everything but body
+    body = soup.body
+    soup.clear()
+    soup.append(body)
+
+    # Remove the body tag itself to only have the contents
+    soup.body.unwrap()
+
+    # Back to text
+    return str(soup)
+
+
+# Parsing a large document with html5lib is slow, so we keep an index of the
+# text nodes of each document. It maps their position in the text (in UTF-8
+# bytes, like highlights) to their position in the HTML source, so that a
+# snippet can be extracted by slicing the source and only parsing the result.
+
+INDEX_VERSION = 1
+
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+    'meta', 'param', 'source', 'track', 'wbr',
+])
+
+# Elements which content is not parsed as HTML, or which drop a leading
+# newline; we leave those to html5lib
+SPECIAL_ELEMENTS = frozenset([
+    'iframe', 'listing', 'noembed', 'noframes', 'noscript', 'plaintext',
+    'pre', 'script', 'style', 'template', 'textarea', 'title', 'xmp',
+])
+
+TOKEN_TEXT, TOKEN_START, TOKEN_END, TOKEN_VOID = range(4)
+
+_token_re = re.compile(
+    r'(<!--.*?-->|<![^>]*>)'  # comment, doctype
+    r'|</([a-zA-Z][^\s/>]*)\s*>'  # end tag
+    r'|<([a-zA-Z][^\s/>]*)(?:[^>"\']|"[^"]*"|\'[^\']*\')*>'  # start tag
+    r'|([^<]+)',  # text
+    re.DOTALL,
+)
+
+# Character references, as found by html.unescape()
+_charref_re = re.compile(
+    r'&(#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[^\t\n\f <&#;]{1,32};?)',
+)
+
+
+class UnsupportedHTML(ValueError):
+    """This HTML can't be processed without a full parser.
+    """
+
+
+def tokenize(html):
+    """Split an HTML document into tokens, without building a tree.
+
+    Yields ``(kind, start, end, tag_name)`` tuples, where ``start`` and
+    ``end`` are positions in the HTML source.
+
+    This only supports the regular HTML that we store (as output by
+    ``convert.get_html_body()``), and raises ``UnsupportedHTML`` on anything
+    else (comments, unbalanced tags, ...).
+    """
+    stack = []
+    pos = 0
+    length = len(html)
+    while pos < length:
+        m = _token_re.match(html, pos)
+        if m is None or m.group(1) is not None:
+            raise UnsupportedHTML("Unsupported markup at position %d" % pos)
+        end = m.end()
+        if m.group(4) is not None:
+            yield TOKEN_TEXT, pos, end, None
+        elif m.group(3) is not None:
+            name = m.group(3).lower()
+            if name in SPECIAL_ELEMENTS:
+                raise UnsupportedHTML("Unsupported element %r" % name)
+            elif name in VOID_ELEMENTS:
+                yield TOKEN_VOID, pos, end, name
+            else:
+                stack.append(name)
+                yield TOKEN_START, pos, end, name
+        else:
+            name = m.group(2).lower()
+            if not stack or stack.pop() != name:
+                raise UnsupportedHTML("Unbalanced tag at position %d" % pos)
+            yield TOKEN_END, pos, end, name
+        pos = end
+    if stack:
+        raise UnsupportedHTML("Unclosed elements at end of document")
+
+
+def unescape(text):
+    """Decode the character references in a text token.
+    """
+    if '&' in text:
+        return html_module.unescape(text)
+    else:
+        return text
+
+
+@tracer.start_as_current_span('taguette/build_index')
+@PROM_INDEX_TIME.time()
+def build_index(html):
+    """Build the text index of an HTML document.
+
+    The index lists the text nodes, with their position in the text (in UTF-8
+    bytes), their position in the HTML source, and the position of the start
+    tags of the elements containing them.
+
+    The result is checked against html5lib. If the document can't be indexed,
+    the index has no nodes, and ``extract()`` will do a full parse.
+    """
+    nodes = []
+    texts = []
+    stack = []
+    offset = 0
+    try:
+        for kind, start, end, _ in tokenize(html):
+            if kind == TOKEN_TEXT:
+                text = unescape(html[start:end])
+                texts.append(text)
+                nodes.append([offset, start, end, list(stack)])
+                offset += len(text.encode('utf-8'))
+            elif kind == TOKEN_START:
+                stack.append(start)
+            elif kind == TOKEN_END:
+                stack.pop()
+    except UnsupportedHTML as e:
+        logger.info("Can't index document: %s", e)
+        nodes = None
+    else:
+        # Check that html5lib sees the same text
+        soup = BeautifulSoup(html, 'html5lib')
+        expected = [
+            str(node) for node in soup.descendants
+            if isinstance(node, NavigableString)
+        ]
+        if ''.join(expected) != ''.join(texts):
+            logger.info("Can't index document: text differs from html5lib")
+            nodes = None
+
+    if nodes is None:
+        PROM_INDEX.labels('unsupported').inc()
+        return {'version': INDEX_VERSION, 'length': None, 'nodes': None}
+    else:
+        PROM_INDEX.labels('indexed').inc()
+        return {'version': INDEX_VERSION, 'length': offset, 'nodes': nodes}
+
+
+def is_index_usable(index):
+    """Check whether an index from ``build_index()`` can be used.
+    """
+    return (
+        index is not None
+        and index.get('version') == INDEX_VERSION
+        and bool(index['nodes'])
+    )
+
+
+def _source_position(html, node, offset):
+    """Find the position in the HTML source of an offset in a text node.
+    """
+    _, pos, end, _ = node
+    for m in _charref_re.finditer(html, pos, end):
+        plain = Utf8Offsets(html[pos:m.start()])
+        size = plain.byte_size()
+        if offset <= size:
+            return pos + plain.str_index(offset, round_up=True)
+        offset -= size
+        # If the offset falls inside of a reference, round up
+        offset -= len(unescape(m.group(0)).encode('utf-8'))
+        pos = m.end()
+        if offset <= 0:
+            return pos
+    return pos + Utf8Offsets(html[pos:end]).str_index(offset, round_up=True)
+
+
+def _node_offset(node):
+    return node[0]
+
+
+def _extract_indexed(html, index, start, end):
+    nodes = index['nodes']
+
+    # Find the text nodes, the same way find_pos() does
+    if start is None:
+        first = 0
+        src_start = nodes[0][1]
+    else:
+        first = bisect.bisect_right(nodes, start, key=_node_offset) - 1
+        first = max(first, 0)
+        src_start = _source_position(
+            html, nodes[first], start - nodes[first][0],
+        )
+    if end is None:
+        last = len(nodes) - 1
+        src_end = nodes[last][2]
+    else:
+        last = bisect.bisect_left(nodes, end, key=_node_offset) - 1
+        last = max(last, 0)
+        src_end = _source_position(
+            html, nodes[last], end - nodes[last][0],
+        )
+
+    # Re-open the elements containing the start, slice, and close the
+    # elements containing the end
+    parts = [_token_re.match(html, pos).group(0) for pos in nodes[first][3]]
+    parts.append(html[src_start:src_end])
+    for pos in reversed(nodes[last][3]):
+        parts.append('</%s>' % _token_re.match(html, pos).group(3))
+
+    # Parse that small fragment, to output it the same way as a full parse
+    # (in the body, so leading whitespace is not dropped)
+    return _body_contents(
+        BeautifulSoup('<body>' + ''.join(parts), 'html5lib'),
+    )
+
+
 @tracer.start_as_current_span('taguette/extract')
 @PROM_EXTRACT_TIME.time()
-def extract(html, start, end):
+def extract(html, start, end, index=None):
     """Extract a snippet out of an HTML document.
 
     Locations are computed over UTF-8 bytes, and doesn't count HTML tags.
@@ -87,9 +407,17 @@ def extract(html, start, end):
     'here <i>Wo'
     >>> extract('<p><u>Hello</u> there <i>World</i></p>', 7, 14)
     '<p>here <i>Wo</i></p>'
+
+    :param index: The text index of the document, from ``build_index()``. If
+        provided, the document will not be fully parsed.
     """
-    soup = BeautifulSoup(html, 'html5lib')
+    if is_index_usable(index):
+        return _extract_indexed(html, index, start, end)
 
+    return _extract_soup(BeautifulSoup(html, 'html5lib'), start, end)
+
+
+def _extract_soup(soup, start, end):
     # Trim the right side first, because that doesn't mess our start position
     if end is not None:
         e = find_pos(soup, end, False)
@@ -102,40 +430,144 @@ def extract(html, start, end):
         s[0].replace_with(NavigableString(split_utf8(s[0].string, s[1])[1]))
         delete_left(soup, s[2])
 
-    # Remove everything but body
-    body = soup.body
-    soup.clear()
-    soup.append(body)
+    return _body_contents(soup)
 
-    # Remove the body tag itself to only have the contents
-    soup.body.unwrap()
 
-    # Back to text
-    return str(soup)
+def _copy_soup(soup):
+    # copy.copy() doesn't work on a BeautifulSoup object from html5lib
+    new = BeautifulSoup('', 'html.parser')
+    for element in soup.contents:
+        new.append(copy.copy(element))
+    return new
+
+
+@tracer.start_as_current_span('taguette/extract_many')
+@PROM_EXTRACT_MANY_TIME.time()
+def extract_many(html, ranges, index=None):
+    """Extract several snippets out of an HTML document.
+
+    This returns the same as calling ``extract()`` for each ``(start, end)``
+    range, but the document is parsed at most once.
+
+    :param index: The text index of the document, from ``build_index()``.
+    """
+    ranges = list(ranges)
+    if not is_index_usable(index):
+        soup = BeautifulSoup(html, 'html5lib')
+        if len(ranges) <= 1:
+            return [_extract_soup(soup, start, end) for start, end in ranges]
+
+        # Index the serialized tree, which html5lib would parse the same way
+        html = soup.body.decode_contents()
+        index = build_index(html)
+        if not is_index_usable(index):
+            return [
+                _extract_soup(_copy_soup(soup), start, end)
+                for start, end in ranges
+            ]
+
+    return [
+        _extract_indexed(html, index, start, end)
+        for start, end in ranges
+    ]
+
+
+# Documents are sent to the browser in chunks of about this many characters
+# of HTML, split between top-level elements
+CHUNK_SIZE = 100000
+
+
+@tracer.start_as_current_span('taguette/split_chunks')
+def split_chunks(html, index=None, chunk_size=CHUNK_SIZE):
+    """Split an HTML document into chunks, between top-level elements.
+
+    Returns a list of ``(offset, contents)`` pairs, where ``offset`` is the
+    position of the chunk in the text (in UTF-8 bytes, like highlights). Each
+    chunk is valid HTML on its own, so they can be displayed separately.
+
+    :param index: The text index of the document, from ``build_index()``.
+    """
+    if index is None:
+        index = build_index(html)
+    if not is_index_usable(index):
+        return _split_chunks_soup(html, chunk_size)
+
+    chunks = []
+    chunk_start = 0
+    chunk_offset = 0
+    for offset, src_start, _, ancestors in index['nodes']:
+        # Start of the top-level element containing this text node
+        top = ancestors[0] if ancestors else src_start
+        if top - chunk_start >= chunk_size:
+            chunks.append((chunk_offset, html[chunk_start:top]))
+            chunk_start = top
+            chunk_offset = offset
+    chunks.append((chunk_offset, html[chunk_start:]))
+    return chunks
+
+
+def _text_size(node):
+    if isinstance(node, NavigableString):
+        return len(node.encode('utf-8'))
+    return sum(
+        len(child.encode('utf-8'))
+        for child in node.descendants
+        if isinstance(child, NavigableString)
+    )
+
+
+def _split_chunks_soup(html, chunk_size):
+    soup = BeautifulSoup(html, 'html5lib')
+
+    # Text in the head counts, like in find_pos()
+    offset = _text_size(soup.head) if soup.head is not None else 0
+
+    chunks = []
+    parts = []
+    size = 0
+    chunk_offset = offset
+    for node in soup.body.contents:
+        if parts and size >= chunk_size:
+            chunks.append((chunk_offset, ''.join(parts)))
+            parts = []
+            size = 0
+            chunk_offset = offset
+        if isinstance(node, NavigableString):
+            part = node.output_ready()
+        else:
+            part = node.decode()
+        parts.append(part)
+        size += len(part)
+        offset += _text_size(node)
+    chunks.append((chunk_offset, ''.join(parts)))
+    return chunks
 
 
 def byte_to_str_index(string, byte_index):
     """Converts a byte index in the UTF-8 string into a codepoint index.
 
     If the index falls inside of a codepoint unit, it will be rounded down.
+
+    Use ``Utf8Offsets`` directly to convert many offsets in the same string.
     """
-    for idx, char in enumerate(string):
-        char_size = len(char.encode('utf-8'))
-        if char_size > byte_index:
-            return idx
-        byte_index -= char_size
-    return len(string)
+    return Utf8Offsets(string).str_index(byte_index)
+
+
+HIGHLIGHT_ENGINES = ('soup', 'stream')
 
 
 @tracer.start_as_current_span('taguette/highlight')
 @PROM_HIGHLIGHT_TIME.time()
-def highlight(html, highlights, show_tags=False):
+def highlight(html, highlights, show_tags=False, engine='soup'):
     """Highlight part of an HTML documents.
 
     :param highlights: Iterable of (start, end, tags) triples, which are
         computed over UTF-8 bytes and don't count HTML tags
     :param show_tags: Whether to show the tag names within brackets after each
         highlight
+    :param engine: 'soup' to parse the document with html5lib, or 'stream' to
+        go through it in a single pass without building a tree. The output is
+        the same; 'stream' falls back to 'soup' if it can't handle the document
     """
     # Build a list of starting points and ending points
     starts = []
@@ -149,6 +581,24 @@ def highlight(html, highlights, show_tags=False):
     # This relies on the fact that 'end' < 'start'
     events = sorted(ends + starts)
 
+    if engine == 'stream':
+        try:
+            result = ''.join(_highlight_stream(html, events, show_tags))
+        except UnsupportedHTML as e:
+            logger.info("Can't highlight document in stream: %s", e)
+            PROM_HIGHLIGHT_ENGINE.labels('soup').inc()
+        else:
+            PROM_HIGHLIGHT_ENGINE.labels('stream').inc()
+            return result
+    elif engine == 'soup':
+        PROM_HIGHLIGHT_ENGINE.labels('soup').inc()
+    else:
+        raise ValueError("Unknown highlight engine %r" % engine)
+
+    return _highlight_soup(html, events, show_tags)
+
+
+def _highlight_soup(html, events, show_tags):
     events = iter(events)
     soup = BeautifulSoup(html, 'html5lib')
 
@@ -168,7 +618,10 @@ def highlight(html, highlights, show_tags=False):
 
         if isinstance(node, NavigableString):
             # Move through text
-            nb = len(node.string.encode('utf-8'))
+            text = node.string
+            offsets = Utf8Offsets(text)
+            consumed = 0  # Characters split off already
+            nb = offsets.byte_size()
             while event_pos is not None:
                 if event_pos == pos and event_type == 'start':
                     # Start highlighting at beginning of text node
@@ -191,16 +644,16 @@ def highlight(html, highlights, show_tags=False):
                         highlighting -= 1
                     else:  # 'end' and (show_tags or highlighting becomes 0)
                         # Split it
-                        char_idx = byte_to_str_index(
-                            node.string,
-                            event_pos - pos,
+                        char_idx = offsets.str_index(
+                            offsets.byte_offset(consumed) + event_pos - pos,
                         )
-                        left = node.string[:char_idx]
-                        right = node.string[char_idx:]
+                        left = text[consumed:char_idx]
+                        right = text[char_idx:]
+                        consumed = char_idx
 
                         # Left part
                         newnode = NavigableString(left)
-                        if highlighting:
+                        if highlighting and left:
                             # Optionally highlight left part
                             span = soup.new_tag(
                                 'span',
@@ -238,14 +691,15 @@ def highlight(html, highlights, show_tags=False):
                     except StopIteration:
                         event_pos = None
                 elif highlighting:  # and pos + nb <= event_pos:
-                    # Highlight whole text node
-                    newnode = soup.new_tag(
-                        'span',
-                        attrs={'class': 'highlight'},
-                    )
-                    node.replace_with(newnode)
-                    newnode.append(node)
-                    node = newnode
+                    # Highlight whole text node, unless it's empty
+                    if node.string:
+                        newnode = soup.new_tag(
+                            'span',
+                            attrs={'class': 'highlight'},
+                        )
+                        node.replace_with(newnode)
+                        newnode.append(node)
+                        node = newnode
                     if pos + nb == event_pos and event_type == 'end':
                         if show_tags:
                             comment = soup.new_tag(
@@ -253,7 +707,7 @@ def highlight(html, highlights, show_tags=False):
                                 attrs={'class': 'taglist'},
                             )
                             comment.string = ' [%s]' % ', '.join(tags)
-                            newnode.insert_after(comment)
+                            node.insert_after(comment)
                             node = comment
                         highlighting -= 1
                         try:
@@ -275,13 +729,159 @@ def highlight(html, highlights, show_tags=False):
         # Move to next node
         node = node.next_sibling
 
-    # Remove everything but body
-    body = soup.body
-    soup.clear()
-    soup.append(body)
+    return _body_contents(soup)
 
-    # Remove the body tag itself to only have the contents
-    soup.body.unwrap()
 
-    # Back to text
-    return str(soup)
+# The stream engine serializes its output the way BeautifulSoup does
+_formatter = HTMLFormatter.REGISTRY['minimal']
+
+_attribute_re = re.compile(
+    r'([^\s"\'>/=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+)))?',
+)
+
+# Elements that html5lib creates implicitly if they are missing
+_IMPLIED_PARENTS = {
+    'tr': {'tbody', 'thead', 'tfoot'},
+    'col': {'colgroup'},
+}
+
+_CDATA_LIST_ATTRIBUTES = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+
+_HTML_SPACES = '\t\n\x0c \r'
+
+
+def _serialize_start_tag(html, start, end, name):
+    """Serialize a start tag the way BeautifulSoup would.
+    """
+    attrs = {}
+    pos = start + 1 + len(name)
+    for m in _attribute_re.finditer(html, pos, end - 1):
+        key = m.group(1).lower()
+        if key in attrs:  # html5lib keeps the first one
+            continue
+        value = next((v for v in m.group(2, 3, 4) if v is not None), '')
+        value = unescape(value)
+        if (
+            key in _CDATA_LIST_ATTRIBUTES['*']
+            or key in _CDATA_LIST_ATTRIBUTES.get(name, ())
+        ):
+            value = ' '.join(value.split())
+        attrs[key] = value
+    parts = ['<', name]
+    for key, value in sorted(attrs.items()):
+        parts.append(' %s=%s' % (
+            key,
+            _formatter.quoted_attribute_value(
+                _formatter.attribute_value(value),
+            ),
+        ))
+    if name in VOID_ELEMENTS:
+        parts.append('/')
+    parts.append('>')
+    return ''.join(parts)
+
+
+def _highlight_text(text, offsets, pos, events, state, show_tags):
+    """Highlight a text node, consuming the events that fall inside of it.
+
+    This follows the same steps as ``_highlight_soup()``, so the output is
+    the same.
+    """
+    highlight_start = '<span class="highlight">'
+    consumed = 0  # Characters output already
+    nb = offsets.byte_size()
+    while state['event'] is not None:
+        event_pos, event_type, tags = state['event']
+        if event_pos == pos and event_type == 'start':
+            # Start highlighting at beginning of text node
+            state['highlighting'] += 1
+            state['event'] = next(events, None)
+        elif pos + nb > event_pos:
+            # Next event falls inside of this text node
+            if event_type == 'start' and state['highlighting']:
+                state['highlighting'] += 1
+            elif (
+                event_type == 'end'
+                and not show_tags
+                and state['highlighting'] > 1
+            ):
+                state['highlighting'] -= 1
+            else:
+                # Split it
+                char_idx = offsets.str_index(
+                    offsets.byte_offset(consumed) + event_pos - pos,
+                )
+                left = _formatter.substitute(text[consumed:char_idx])
+                if state['highlighting'] and left:
+                    yield highlight_start + left + '</span>'
+                else:
+                    yield left
+                if event_type == 'start':
+                    state['highlighting'] += 1
+                else:
+                    state['highlighting'] -= 1
+                    if show_tags:
+                        yield '<span class="taglist">%s</span>' % (
+                            _formatter.substitute(' [%s]' % ', '.join(tags))
+                        )
+                consumed = char_idx
+                nb -= event_pos - pos
+                pos = event_pos
+            state['event'] = next(events, None)
+        elif state['highlighting']:
+            # Highlight whole text node, unless it's empty
+            if consumed < len(text):
+                yield (
+                    highlight_start
+                    + _formatter.substitute(text[consumed:])
+                    + '</span>'
+                )
+            if pos + nb == event_pos and event_type == 'end':
+                if show_tags:
+                    yield '<span class="taglist">%s</span>' % (
+                        _formatter.substitute(' [%s]' % ', '.join(tags))
+                    )
+                state['highlighting'] -= 1
+                state['event'] = next(events, None)
+            return
+        else:
+            break
+    yield _formatter.substitute(text[consumed:])
+
+
+def _highlight_stream(html, events, show_tags):
+    """Highlight a document in a single pass over its tokens.
+
+    This only supports documents that html5lib would not restructure, which
+    is the case of what we store (bleach serializes an html5lib tree).
+    """
+    if '\r' in html or '\x00' in html:
+        raise UnsupportedHTML("Document needs preprocessing")
+    events = iter(events)
+    state = {'event': next(events, None), 'highlighting': 0}
+    stack = []
+    pos = 0
+    for kind, start, end, name in tokenize(html):
+        if kind == TOKEN_TEXT:
+            text = html[start:end]
+            if start == 0:
+                # html5lib drops whitespace at the start of the document
+                text = text.lstrip(_HTML_SPACES)
+                if not text:
+                    continue
+            text = unescape(text)
+            offsets = Utf8Offsets(text)
+            yield from _highlight_text(
+                text, offsets, pos, events, state, show_tags,
+            )
+            pos += offsets.byte_size()
+        elif kind == TOKEN_END:
+            stack.pop()
+            yield '</%s>' % name
+        else:
+            implied = _IMPLIED_PARENTS.get(name)
+            if implied is not None and (not stack or stack[-1] not in implied):
+                raise UnsupportedHTML("Missing implied parent for %r" % name)
+            if kind == TOKEN_START:
+                stack.append(name)
+            yield _serialize_start_tag(html, start, end, name)
@@ -133,6 +133,11 @@ REGISTRATION_ENABLED = True
 # Whether users can import projects from SQLite3 files
 SQLITE3_IMPORT_ENABLED = True
 
+# Maximum size of uploaded files. Uploads are written to a temporary file as
+# they are received, so this limits disk use rather than memory use
+UPLOAD_SIZE_LIMIT = 100000000  # 100 MB
+PROJECT_IMPORT_SIZE_LIMIT = 100000000  # 100 MB for SQLite3 files
+
 # Set this to true if you are behind a reverse proxy that sets the
 # X-Forwarded-For header.
 # Leave this at False if users are connecting to Taguette directly
@@ -142,6 +147,59 @@ X_HEADERS = False
 CONVERT_TO_HTML_TIMEOUT = 3 * 60  # 3min for importing document into Taguette
 CONVERT_FROM_HTML_TIMEOUT = 3 * 60  # 3min for exporting from Taguette
 
+# Maximum number of conversion processes (Calibre, wvHtml) running at once
+# By default, this is picked from the number of CPUs and available memory
+#CONVERT_MAX_PROCESSES = 4
+# Memory needed by a conversion process. No more processes are started while
+# less than this is available
+CONVERT_PROCESS_MEMORY = 500000000  # 500 MB
+
+# Calibre is run with heuristics first, then without if that takes too long.
+# For kinds of files where heuristics often fail, both are run at once if
+# there are idle conversion processes, and the first result is used
+#CALIBRE_SPECULATIVE = True
+
+# How to add highlights to documents when exporting them
+# 'stream' goes through the document in one pass (faster), 'soup' builds a
+# full tree with html5lib. Documents that can't be streamed use 'soup'
+#HIGHLIGHT_ENGINE = 'stream'
+
+# How to sanitize uploaded HTML
+# 'bleach' serializes the parsed document and has bleach parse it again,
+# 'single' walks the parsed document once (faster), and uses 'bleach' for
+# documents with SVG or MathML
+#SANITIZE_ENGINE = 'single'
+
+# Memory used to keep recently-highlighted documents, in bytes
+DOCUMENT_CACHE_SIZE = 50000000  # 50 MB
+
+# Worker processes for HTML processing (reading uploaded documents, getting
+# snippets, highlighting documents for export), so that big documents don't
+# block the server. Requests get an error 503 if more tasks are waiting, or if
+# a task takes more than the timeout (in seconds)
+PROCESS_POOL_SIZE = 2
+PROCESS_POOL_QUEUE = 50
+PROCESS_POOL_TIMEOUT = 3 * 60  # 3 minutes
+
+# Directory where converted documents are kept, so that uploading the same
+# file again doesn't need to convert it again. Set to None to disable
+#CONVERT_CACHE_DIR = '/var/cache/taguette/conversions'
+CONVERT_CACHE_SIZE = 1000000000  # 1 GB
+
+# Directory where exported documents are kept, so that downloading the same
+# export again doesn't need to generate it again. Set to None to disable
+#EXPORT_CACHE_DIR = '/var/cache/taguette/exports'
+EXPORT_CACHE_SIZE = 1000000000  # 1 GB
+EXPORT_CACHE_MAX_AGE = 604800  # 7 days
+
+# How long the result of an export run in the background is kept, in seconds
+EXPORT_JOBS_TTL = 3600  # 1 hour
+# Maximum number of exports a user can have running in the background at once
+EXPORT_JOBS_PER_USER = 5
+
+# Maximum number of documents a user can have importing at once
+IMPORT_JOBS_PER_USER = 5
+
 # If you want to export metrics using Prometheus, set a port number here
 #PROMETHEUS_LISTEN = "0.0.0.0:9101"
 
@@ -160,11 +218,30 @@ DEFAULT_CONFIG = {
     'REGISTRATION_ENABLED': True,
     'REDIS_SERVER': None,
     'SQLITE3_IMPORT_ENABLED': True,
+    'UPLOAD_SIZE_LIMIT': 100000000,  # 100 MB
+    'PROJECT_IMPORT_SIZE_LIMIT': 100000000,  # 100 MB
     'DEFAULT_LANGUAGE': 'en_US',
     'CONVERT_FROM_HTML_TIMEOUT': 3 * 60,
     'CONVERT_TO_HTML_TIMEOUT': 3 * 60,
     'OPF_OUT_SIZE_LIMIT': 5000000,  # 5 MB
     'HTML_OUT_SIZE_LIMIT': 2000000,  # 2 MB
+    'HIGHLIGHT_ENGINE': 'stream',
+    'SANITIZE_ENGINE': 'single',
+    'DOCUMENT_CACHE_SIZE': 50000000,  # 50 MB
+    'PROCESS_POOL_SIZE': 2,
+    'PROCESS_POOL_QUEUE': 50,
+    'PROCESS_POOL_TIMEOUT': 3 * 60,
+    'CONVERT_CACHE_DIR': None,
+    'CONVERT_CACHE_SIZE': 1000000000,  # 1 GB
+    'EXPORT_CACHE_DIR': None,
+    'EXPORT_CACHE_SIZE': 1000000000,  # 1 GB
+    'EXPORT_CACHE_MAX_AGE': 604800,  # 7 days
+    'EXPORT_JOBS_TTL': 3600,  # 1 hour
+    'EXPORT_JOBS_PER_USER': 5,
+    'IMPORT_JOBS_PER_USER': 5,
+    'CONVERT_MAX_PROCESSES': None,
+    'CONVERT_PROCESS_MEMORY': 500000000,  # 500 MB
+    'CALIBRE_SPECULATIVE': True,
 }
 
 REQUIRED_CONFIG = [
@@ -446,7 +523,10 @@ def main():
     if args.browser and not args.debug:
         loop.call_later(0.01, webbrowser.open, url)
 
-    loop.start()
+    try:
+        loop.start()
+    finally:
+        app.export_jobs.close()
 
 
 if __name__ == '__main__':
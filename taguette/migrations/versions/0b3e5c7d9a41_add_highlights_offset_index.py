@@ -0,0 +1,29 @@
+"""add highlights offset index
+
+Revision ID: 0b3e5c7d9a41
+Revises: 874ef0710389
+Create Date: 2026-10-18 11:02:13.519804
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0b3e5c7d9a41'
+down_revision = '874ef0710389'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('highlights', schema=None) as batch_op:
+        batch_op.create_index(
+            'idx_document_offset',
+            ['document_id', 'start_offset', 'id'],
+            unique=False,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('highlights', schema=None) as batch_op:
+        batch_op.drop_index('idx_document_offset')
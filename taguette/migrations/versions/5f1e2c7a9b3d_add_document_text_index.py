@@ -0,0 +1,34 @@
+"""add document text index
+
+Revision ID: 5f1e2c7a9b3d
+Revises: db5e31a0233d
+Create Date: 2026-10-18 09:12:41.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '5f1e2c7a9b3d'
+down_revision = 'db5e31a0233d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing documents get indexed the next time they are highlighted
+    with op.batch_alter_table('documents') as batch_op:
+        batch_op.add_column(sa.Column(
+            'text_index',
+            sa.Text()
+            .with_variant(mysql.LONGTEXT(), 'mysql')
+            .with_variant(mysql.LONGTEXT(), 'mariadb'),
+            nullable=True,
+        ))
+
+
+def downgrade():
+    with op.batch_alter_table('documents') as batch_op:
+        batch_op.drop_column('text_index')
@@ -0,0 +1,83 @@
+"""add highlight text
+
+Revision ID: 874ef0710389
+Revises: a3c81f6d2e94
+Create Date: 2026-10-18 10:21:36.803146
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sys
+
+from taguette.convert import html_to_plaintext
+
+
+# revision identifiers, used by Alembic.
+revision = '874ef0710389'
+down_revision = 'a3c81f6d2e94'
+branch_labels = None
+depends_on = None
+
+
+BATCH_SIZE = 500
+
+
+highlights = sa.Table(
+    'highlights',
+    sa.MetaData(),
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('snippet', sa.Text, nullable=False),
+    sa.Column('snippet_text', sa.Text, nullable=True),
+)
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # The column might exist if a previous attempt got interrupted
+    columns = sa.inspect(bind).get_columns('highlights')
+    if not any(column['name'] == 'snippet_text' for column in columns):
+        with op.batch_alter_table('highlights') as batch_op:
+            batch_op.add_column(
+                sa.Column('snippet_text', sa.Text(), nullable=True),
+            )
+
+    # Fill it in, in batches, each one committed on its own. Only rows that
+    # are still NULL are selected, so this picks up where it stopped if it is
+    # interrupted
+    update = (
+        highlights.update()
+        .where(highlights.c.id == sa.bindparam('highlight_id'))
+        .values(snippet_text=sa.bindparam('text'))
+    )
+    last_id = None
+    count = 0
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        while True:
+            query = (
+                sa.select([highlights.c.id, highlights.c.snippet])
+                .where(highlights.c.snippet_text.is_(None))
+                .order_by(highlights.c.id)
+                .limit(BATCH_SIZE)
+            )
+            if last_id is not None:
+                query = query.where(highlights.c.id > last_id)
+            rows = bind.execute(query).fetchall()
+            if not rows:
+                break
+            bind.execute(
+                update,
+                [
+                    dict(highlight_id=id, text=html_to_plaintext(snippet))
+                    for id, snippet in rows
+                ],
+            )
+            last_id = rows[-1][0]
+            count += len(rows)
+            print("%d highlights converted to text" % count, file=sys.stderr)
+
+
+def downgrade():
+    with op.batch_alter_table('highlights') as batch_op:
+        batch_op.drop_column('snippet_text')
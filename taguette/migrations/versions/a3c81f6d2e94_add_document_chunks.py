@@ -0,0 +1,47 @@
+"""add document chunks
+
+Revision ID: a3c81f6d2e94
+Revises: 5f1e2c7a9b3d
+Create Date: 2026-10-18 11:02:17.204519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c81f6d2e94'
+down_revision = '5f1e2c7a9b3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing documents get split on the fly when they are loaded
+    op.create_table(
+        'document_chunks',
+        sa.Column('document_id', sa.INTEGER(), nullable=False),
+        sa.Column('start_offset', sa.INTEGER(), nullable=False),
+        sa.Column(
+            'contents',
+            sa.Text()
+            .with_variant(mysql.LONGTEXT(), 'mysql')
+            .with_variant(mysql.LONGTEXT(), 'mariadb'),
+            nullable=False,
+        ),
+        sa.ForeignKeyConstraint(
+            ['document_id'],
+            ['documents.id'],
+            name='fk_document_chunks_document_id_documents',
+            ondelete='CASCADE',
+        ),
+        sa.PrimaryKeyConstraint(
+            'document_id', 'start_offset',
+            name='pk_document_chunks',
+        ),
+    )
+
+
+def downgrade():
+    op.drop_table('document_chunks')
@@ -0,0 +1,284 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import opentelemetry.trace
+import prometheus_client
+import time
+
+
+logger = logging.getLogger(__name__)
+tracer = opentelemetry.trace.get_tracer(__name__)
+
+
+BUCKETS = [0.001, 0.002, 0.005, 0.010, 0.020, 0.050, 0.1, 0.2, 0.5,
+           1.0, 2.0, 5.0, 10.0, 20.0, 60.0]
+PROM_POOL_QUEUE = prometheus_client.Gauge(
+    'process_pool_queue',
+    "Tasks waiting for a worker of the HTML processing pool",
+)
+PROM_POOL_WAIT_TIME = prometheus_client.Histogram(
+    'process_pool_wait_seconds',
+    "Time tasks waited for a worker of the HTML processing pool",
+    buckets=BUCKETS,
+)
+PROM_POOL_RUN_TIME = prometheus_client.Histogram(
+    'process_pool_run_seconds',
+    "Time to run a task in the HTML processing pool",
+    ['function'],
+    buckets=BUCKETS,
+)
+PROM_POOL_REJECTED = prometheus_client.Counter(
+    'process_pool_rejected_total',
+    "Tasks rejected because the queue of the HTML processing pool was full",
+)
+
+
+PROM_POOL_TIMEOUT = prometheus_client.Counter(
+    'process_pool_timeout_total',
+    "Tasks that took too long in the HTML processing pool",
+)
+
+
+class PoolFull(Exception):
+    """Too many tasks are waiting for the pool already.
+    """
+
+
+class PoolTimeout(Exception):
+    """A task took too long in the pool.
+    """
+
+
+# Metrics updated by functions that run in the pool. Worker processes have
+# their own copies, so their changes are sent back with the results and
+# replayed here, see ``forward_metrics()``
+_forwarded_metrics = {}
+
+
+def forward_metrics(*metrics):
+    """Count the changes made to these metrics by worker processes.
+
+    Counters and histograms are supported. Observations made to histograms
+    during a task are replayed with their mean value.
+    """
+    for metric in metrics:
+        _forwarded_metrics[metric.describe()[0].name] = metric
+
+
+def _metric_samples():
+    samples = {}
+    for name, metric in _forwarded_metrics.items():
+        for family in metric.collect():
+            for sample in family.samples:
+                if sample.name.endswith(('_total', '_sum', '_count')):
+                    key = (
+                        name, sample.name,
+                        tuple(sorted(sample.labels.items())),
+                    )
+                    samples[key] = sample.value
+    return samples
+
+
+def _call_forwarding_metrics(call):
+    """Run a task in a worker process, returning the changes to metrics.
+    """
+    before = _metric_samples()
+    result = call()
+    changes = {
+        key: value - before.get(key, 0)
+        for key, value in _metric_samples().items()
+        if value != before.get(key, 0)
+    }
+    return result, changes
+
+
+def _apply_metric_changes(changes):
+    for (name, sample, labels), change in changes.items():
+        metric = _forwarded_metrics[name]
+        if labels:
+            metric = metric.labels(**dict(labels))
+        if sample.endswith('_total'):
+            metric.inc(change)
+        elif sample.endswith('_count'):
+            total = changes.get((name, name + '_sum', labels), 0)
+            for _ in range(int(change)):
+                metric.observe(total / change)
+
+
+class ProcessPool(object):
+    """Runs CPU-heavy functions in worker processes, with a bounded queue.
+
+    With a size of 0, functions run in this process instead, on the default
+    executor.
+
+    Waiting on a task stops after ``timeout`` seconds. The worker running it
+    can't be interrupted, so it is counted as lost: its slot is freed and
+    new tasks go to new worker processes. The old processes are killed once
+    the other tasks they were running are done.
+    """
+    def __init__(self, size, max_queue, timeout=None):
+        self.size = size
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._waiting = 0
+        # Number of tasks that can still finish, by executor
+        self._running = {}
+        # Executors replaced after a timeout, waiting for their other tasks
+        self._retired = set()
+        if size:
+            self._executor = self._new_executor()
+            self._slots = asyncio.Semaphore(size)
+        else:
+            self._executor = self._slots = None
+
+    def _new_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            self.size,
+            # Don't fork the server with its threads and connections
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+
+    async def run(self, func, *args, **kwargs):
+        """Run a function (which has to be picklable) with the given arguments.
+
+        Raises ``PoolFull`` if the queue is full, ``PoolTimeout`` if it takes
+        more than ``timeout`` seconds.
+        """
+        call = functools.partial(func, *args, **kwargs)
+        loop = asyncio.get_event_loop()
+
+        if self._executor is None:
+            with PROM_POOL_RUN_TIME.labels(func.__name__).time():
+                return await self._wait(
+                    func,
+                    loop.run_in_executor(None, call),
+                )
+
+        # Wait for a worker
+        if self._slots.locked() and self._waiting >= self.max_queue:
+            logger.warning("Process pool is full, rejecting %s",
+                           func.__name__)
+            PROM_POOL_REJECTED.inc()
+            raise PoolFull()
+        self._waiting += 1
+        PROM_POOL_QUEUE.inc()
+        start = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+            PROM_POOL_QUEUE.dec()
+        PROM_POOL_WAIT_TIME.observe(time.perf_counter() - start)
+
+        # The slot is released when the worker is done, even if we stop
+        # waiting on it, or when the worker is given up on
+        executor = self._executor
+        try:
+            future = loop.run_in_executor(
+                executor,
+                functools.partial(_call_forwarding_metrics, call),
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        self._running[executor] = self._running.get(executor, 0) + 1
+        holding = True
+
+        def finished(future=None):
+            nonlocal holding
+            if holding:
+                holding = False
+                self._slots.release()
+                self._task_finished(executor)
+
+        future.add_done_callback(finished)
+
+        with tracer.start_as_current_span(
+            'taguette/pool/run',
+            attributes={'function': func.__name__},
+        ):
+            with PROM_POOL_RUN_TIME.labels(func.__name__).time():
+                try:
+                    result, changes = await self._wait(func, future)
+                except PoolTimeout:
+                    # Fails when the process gets killed, nobody will look
+                    future.add_done_callback(
+                        lambda f: f.cancelled() or f.exception(),
+                    )
+                    finished()
+                    self._retire(executor)
+                    raise
+        _apply_metric_changes(changes)
+        return result
+
+    async def _wait(self, func, future):
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(future),
+                self.timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("%s took more than %s seconds in the pool",
+                           func.__name__, self.timeout)
+            PROM_POOL_TIMEOUT.inc()
+            raise PoolTimeout()
+
+    def _task_finished(self, executor):
+        self._running[executor] -= 1
+        if executor in self._retired and not self._running[executor]:
+            self._kill(executor)
+
+    def _retire(self, executor):
+        """Stop giving tasks to an executor with a worker that is stuck.
+        """
+        if executor is self._executor:
+            logger.warning("Replacing the process pool's workers")
+            self._executor = self._new_executor()
+        self._retired.add(executor)
+        if not self._running[executor]:
+            self._kill(executor)
+
+    def _kill(self, executor):
+        self._retired.discard(executor)
+        self._running.pop(executor, None)
+        # There is no public API to stop a worker that is running a task
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        for executor in list(self._retired):
+            self._kill(executor)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool = ProcessPool(0, 0)
+
+
+def configure(size, max_queue, timeout=None):
+    """Set up the pool used by ``run()``.
+    """
+    global _pool
+
+    _pool.shutdown()
+    if size:
+        logger.info("Starting process pool with %d workers", size)
+    _pool = ProcessPool(size, max_queue, timeout)
+
+
+def size():
+    """Number of worker processes, 0 if functions run in this process.
+    """
+    return _pool.size
+
+
+async def run(func, *args, **kwargs):
+    """Run a function in the HTML processing pool.
+
+    Raises ``PoolFull`` if the queue is full, ``PoolTimeout`` if the function
+    takes too long. The web handlers turn those into HTTP 503 errors.
+    """
+    return await _pool.run(func, *args, **kwargs)
@@ -327,6 +327,8 @@ function hideSpinner() {
  */
 
 var chunk_offsets = [];
+// Chunks that have been requested (false) or loaded (true)
+var chunk_loaded = {};
 
 // Get the document offset from a position
 function describePos(node, offset) {
@@ -632,6 +634,41 @@ function basename(filename) {
   return filename;
 }
 
+// Import jobs started from this page, by job id
+var pending_imports = {};
+// Outcome of import jobs we don't know about (yet), by job id. The event can
+// arrive before the response to the upload, so they are kept while uploads
+// are in progress
+var finished_imports = {};
+var uploads_in_progress = 0;
+
+function importFinished(job, doc_id, error) {
+  if(!pending_imports[job]) {
+    if(uploads_in_progress > 0) {
+      finished_imports[job] = {doc_id: doc_id, error: error};
+    }
+    return;
+  }
+  delete pending_imports[job];
+  hideSpinner();
+  if(error) {
+    console.error("Document import failed:", error);
+    alert(gettext("Error uploading file!") + "\n\n" + error);
+  } else {
+    console.log("Document import complete");
+    var url = base_path + '/project/' + project_id + '/document/' + doc_id;
+    window.history.pushState({document_id: doc_id}, "Document " + doc_id, url);
+    loadDocument(doc_id);
+  }
+}
+
+function uploadDone() {
+  uploads_in_progress -= 1;
+  if(uploads_in_progress === 0) {
+    finished_imports = {};
+  }
+}
+
 document.getElementById('document-add-form').addEventListener('submit', function(e) {
   e.preventDefault();
   console.log("Uploading document...");
@@ -649,21 +686,30 @@ document.getElementById('document-add-form').addEventListener('submit', function
                    document.getElementById('document-add-file').files[0]);
   form_data.append('text_direction',
                    document.getElementById('document-add-form').elements['document-add-direction'].value);
-  form_data.append('_xsrf', getCookie('_xsrf'));
 
   var xhr = new XMLHttpRequest();
   xhr.responseType = 'json';
   xhr.open('POST', base_path + '/api/project/' + project_id + '/document/new');
+  // Send the token in a header, so it is checked before the file is uploaded
+  xhr.setRequestHeader('X-Xsrftoken', getCookie('_xsrf'));
   showSpinner();
   xhr.onload = function() {
-    if(xhr.status == 200) {
+    if(xhr.status == 202) {
       $(document_add_modal).modal('hide');
       document.getElementById('document-add-form').reset();
-      console.log("Document upload complete");
-      var doc_id = xhr.response.created;
-      var url = base_path + '/project/' + project_id + '/document/' + doc_id;
-      window.history.pushState({document_id: doc_id}, "Document " + doc_id, url);
-      loadDocument(doc_id);
+      console.log("Document upload complete, import job", xhr.response.job);
+      // The spinner stays until we get the outcome of the job as an event
+      var job = xhr.response.job;
+      pending_imports[job] = true;
+      var finished = finished_imports[job];
+      uploadDone();
+      if(finished) {
+        // The event already arrived
+        importFinished(job, finished.doc_id, finished.error);
+      } else {
+        maybeResumePolling();
+      }
+      return;
     } else {
       console.error("Document upload failed: status", xhr.status);
       var error = null;
@@ -676,13 +722,16 @@ document.getElementById('document-add-form').addEventListener('submit', function
       }
       alert(gettext("Error uploading file!") + "\n\n" + error);
     }
+    uploadDone();
     hideSpinner();
   };
   xhr.onerror = function(e) {
     console.log("Document upload failed:", e);
     alert(gettext("Error uploading file!"));
+    uploadDone();
     hideSpinner();
   }
+  uploads_in_progress += 1;
   xhr.send(form_data);
 });
 
@@ -1203,14 +1252,36 @@ function setHighlight(highlight) {
   var tag_names = highlight.tags.map(function(id) { return tags[id].path; });
   sortByKey(tag_names, function(path) { return path; });
   tag_names = tag_names.join(", ");
-  try {
-    highlightSelection([highlight.start_offset, highlight.end_offset], id, editHighlight, tag_names);
-    console.log("Highlight set:", highlight);
-  } catch(error) {
-    console.error(
-      "Error setting highlight ", highlight.id, " ", [highlight.start_offset, highlight.end_offset],
-      ":", error,
-    );
+  showHighlight(highlight, tag_names);
+}
+
+// Show a highlight in the chunks that are loaded (or only the one given)
+function showHighlight(highlight, tag_names, only_chunk) {
+  var id = '' + highlight.id;
+  for(var i = 0; i < chunk_offsets.length; ++i) {
+    var chunk_start = chunk_offsets[i];
+    if(chunk_loaded[chunk_start] !== true
+     || (only_chunk !== undefined && only_chunk !== chunk_start)) {
+      continue;
+    }
+    var chunk_end = Infinity;
+    if(i + 1 < chunk_offsets.length) {
+      chunk_end = chunk_offsets[i + 1];
+    }
+    var start = Math.max(highlight.start_offset, chunk_start);
+    var end = Math.min(highlight.end_offset, chunk_end);
+    if(start >= end) {
+      continue;
+    }
+    try {
+      highlightSelection([start, end], id, editHighlight, tag_names);
+      console.log("Highlight set:", highlight, "in chunk", chunk_start);
+    } catch(error) {
+      console.error(
+        "Error setting highlight ", highlight.id, " ", [start, end],
+        ":", error,
+      );
+    }
   }
 }
 
@@ -1568,33 +1639,121 @@ document.getElementById('members-current').addEventListener('submit', function(e
 var document_contents = document.getElementById('document-contents');
 var export_button = document.getElementById('export-button');
 
+// Slow exports run in the background, download them once they are done
+function waitExportJob(job) {
+  if(job.status == 'done') {
+    hideSpinner();
+    window.location = job.url;
+  } else if(job.status == 'failed') {
+    hideSpinner();
+    alert(gettext("Couldn't export!") + "\n\n" + job.error);
+  } else {
+    window.setTimeout(function() {
+      getJSON('/api/project/' + project_id + '/export/' + job.job)
+      .then(waitExportJob)
+      .catch(function(error) {
+        hideSpinner();
+        alert(gettext("Couldn't export!") + "\n\n" + error);
+      });
+    }, 2000);
+  }
+}
+
+document.addEventListener('click', function(e) {
+  var link = e.target.closest('[data-export-job]');
+  if(!link) {
+    return;
+  }
+  e.preventDefault();
+  showSpinner();
+  postJSON(
+    '/api/project/' + project_id + '/export',
+    JSON.parse(link.getAttribute('data-export-job')),
+  )
+  .then(waitExportJob)
+  .catch(function(error) {
+    hideSpinner();
+    alert(gettext("Couldn't export!") + "\n\n" + error);
+  });
+});
+
+// Chunks of the document are loaded when they get close to the viewport
+var chunk_observer = new IntersectionObserver(
+  function(entries) {
+    for(var i = 0; i < entries.length; ++i) {
+      if(entries[i].isIntersecting) {
+        loadChunk(parseInt(entries[i].target.id.substring(11)));
+      }
+    }
+  },
+  {rootMargin: '100% 0px'},
+);
+
+function loadChunk(offset) {
+  if(chunk_loaded[offset] !== undefined) {
+    return;
+  }
+  chunk_loaded[offset] = false;
+  var loaded = chunk_loaded;
+  getJSON(
+    '/api/project/' + project_id + '/document/' + current_document + '/contents',
+    {from: offset, limit: 1},
+  )
+  .then(function(result) {
+    if(loaded !== chunk_loaded) {
+      return; // Another document was loaded since
+    }
+    var elem = document.getElementById('doc-offset-' + offset);
+    chunk_observer.unobserve(elem);
+    elem.innerHTML = result.contents[0].contents;
+    elem.style.minHeight = '';
+    chunk_loaded[offset] = true;
+    console.log("Loaded chunk", offset);
+
+    // Show the highlights in that chunk
+    var hl_entries = Object.values(highlights);
+    for(var i = 0; i < hl_entries.length; ++i) {
+      var tag_names = hl_entries[i].tags.map(function(id) { return tags[id].path; });
+      sortByKey(tag_names, function(path) { return path; });
+      showHighlight(hl_entries[i], tag_names.join(", "), offset);
+    }
+  })
+  .catch(function(error) {
+    console.error("Failed to load chunk:", error);
+    if(loaded === chunk_loaded) {
+      delete chunk_loaded[offset];
+    }
+  });
+}
+
+function clearChunks() {
+  chunk_observer.disconnect();
+  chunk_offsets = [];
+  chunk_loaded = {};
+}
+
 function loadDocument(document_id) {
+  clearChunks();
   if(document_id === null) {
     document_contents.style.direction = 'ltr';
     document_contents.innerHTML = '<p style="font-style: oblique; text-align: center;">' + gettext("Load a document on the left") + '</p>';
     return;
   }
   showSpinner();
-  var info = getJSON(
+  getJSON(
     '/api/project/' + project_id + '/document/' + document_id
-  );
-  var contents = getJSON(
-    '/api/project/' + project_id + '/document/' + document_id + '/contents'
-  );
-  Promise.all([info, contents])
-  .then(function(results) {
-    var info = results[0];
-    var contents = results[1];
+  )
+  .then(function(info) {
     document_contents.innerHTML = '';
     highlights = {};
-    chunk_offsets = [];
-    for(var i = 0; i < contents.contents.length; ++i) {
-      var chunk = contents.contents[i];
+    clearChunks();
+    chunk_offsets = info.chunk_offsets;
+    for(var i = 0; i < chunk_offsets.length; ++i) {
       var elem = document.createElement('div');
-      elem.setAttribute('id', 'doc-offset-' + chunk.offset);
-      elem.innerHTML = chunk.contents;
+      elem.setAttribute('id', 'doc-offset-' + chunk_offsets[i]);
+      // Placeholder until the chunk is loaded
+      elem.style.minHeight = '100vh';
       document_contents.appendChild(elem);
-      chunk_offsets.push(chunk.offset);
     }
     if(info.text_direction === 'RIGHT_TO_LEFT') {
       document_contents.style.direction = 'rtl';
@@ -1618,7 +1777,8 @@ function loadDocument(document_id) {
     for(var i = tag_links.length - 1; i >= 0; --i) {
       tag_links[i].classList.remove('tag-current');
     }
-    console.log("Loaded document", document_id);
+    console.log("Loaded document", document_id, "with", chunk_offsets.length, "chunks");
+    // Highlights get shown as the chunks load
     for(var i = 0; i < info.highlights.length; ++i) {
       setHighlight(info.highlights[i]);
     }
@@ -1634,14 +1794,25 @@ function loadDocument(document_id) {
           'href',
           base_path + '/project/' + project_id + '/export/document/' + document_id + '.' + ext,
         );
+        if(items[i].getAttribute('data-background') === 'true') {
+          items[i].setAttribute(
+            'data-export-job',
+            JSON.stringify({kind: 'document', document_id: document_id, extension: ext}),
+          );
+        }
         items[i].style.display = '';
       } else {
         items[i].style.display = 'none';
       }
     }
 
-    // Scroll up
-    window.setTimeout(function() { window.scrollTo(0, 0); }, 0);
+    // Scroll up, then load the chunks close to the viewport
+    window.setTimeout(function() {
+      window.scrollTo(0, 0);
+      for(var i = 0; i < chunk_offsets.length; ++i) {
+        chunk_observer.observe(document.getElementById('doc-offset-' + chunk_offsets[i]));
+      }
+    }, 0);
   })
   .catch(function(error) {
     console.error("Failed to load document:", error);
@@ -1670,6 +1841,7 @@ function loadTag(tag_path, page) {
     // No need to clear the 'tag-current', we are calling updateTagsList() below
     document_contents.innerHTML = '';
     highlights = {};
+    clearChunks();
     for(var i = 0; i < result.highlights.length; ++i) {
       var hl = result.highlights[i];
       var content = document.createElement('div');
@@ -1785,6 +1957,12 @@ function loadTag(tag_path, page) {
           'href',
           base_path + '/project/' + project_id + '/export/highlights/' + encodeURIComponent(tag_path) + '.' + ext,
         );
+        if(items[i].getAttribute('data-background') === 'true') {
+          items[i].setAttribute(
+            'data-export-job',
+            JSON.stringify({kind: 'highlights', path: tag_path, extension: ext}),
+          );
+        }
         items[i].style.display = '';
       } else {
         items[i].style.display = 'none';
@@ -1908,6 +2086,11 @@ function longPollForEvents() {
           description: event.description,
           text_direction: event.text_direction
         });
+        if(event.job) {
+          importFinished(event.job, event.document_id, null);
+        }
+      } else if(event.type === 'document_import_failed') {
+        importFinished(event.job, null, event.error);
       } else if(event.type === 'document_delete') {
         removeDocument(event.document_id);
       } else if(event.type === 'highlight_add') {
@@ -99,6 +99,27 @@ def tag_path(path):
     return True
 
 
+def export_job(obj):
+    if not isinstance(obj, dict):
+        raise InvalidFormat(_f("Invalid export"))
+    if not isinstance(obj.get('kind'), str):
+        raise InvalidFormat(_f("Invalid export"))
+    if not isinstance(obj.get('extension', ''), str):
+        raise InvalidFormat(_f("Unsupported format"))
+    if obj['kind'] == 'highlights':
+        if not isinstance(obj.get('path', ''), str):
+            raise InvalidFormat(_f("Invalid tag path"))
+        if len(obj.get('path', '')) > 200:
+            raise InvalidFormat(_f("Tag path is too long"))
+    elif obj['kind'] == 'document':
+        if 'document_id' not in obj:
+            raise InvalidFormat(_f("Missing document"))
+        document_id = obj['document_id']
+        if not isinstance(document_id, int) or isinstance(document_id, bool):
+            raise InvalidFormat(_f("Invalid document"))
+    return True
+
+
 def filename(name):
     if not isinstance(name, str):
         raise ValueError("File name is not a string")
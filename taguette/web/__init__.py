@@ -150,6 +150,9 @@ def make_app(config, debug=False, xsrf_cookies=True):
         UnbakedURLSpec('/project/([0-9]+)/export/document/'
                        '([^/]+)\\.([a-z0-9]{2,4})',
                        export.ExportDocument, name='export_document'),
+        UnbakedURLSpec('/project/([0-9]+)/export/documents\\.zip',
+                       export.ExportDocumentsZip,
+                       name='export_documents_zip'),
         UnbakedURLSpec('/project/([0-9]+)/export/highlights/(.*)\\.csv',
                        export.ExportHighlightsCsv),
         UnbakedURLSpec('/project/([0-9]+)/export/highlights/(.*)\\.xlsx',
@@ -158,6 +161,8 @@ def make_app(config, debug=False, xsrf_cookies=True):
                        '(.*)\\.([a-z0-3]{2,4})',
                        export.ExportHighlightsDoc,
                        name='export_highlights_doc'),
+        UnbakedURLSpec('/project/([0-9]+)/export/job/([0-9a-f]+)',
+                       export.ExportJobDownload, name='export_job'),
 
         # API
         UnbakedURLSpec('/api/check_user', api.CheckUser),
@@ -180,6 +185,9 @@ def make_app(config, debug=False, xsrf_cookies=True):
         UnbakedURLSpec('/api/project/([0-9]+)/tag/merge', api.TagMerge),
         UnbakedURLSpec('/api/project/([0-9]+)/members', api.MembersUpdate),
         UnbakedURLSpec('/api/project/([0-9]+)/events', api.ProjectEvents),
+        UnbakedURLSpec('/api/project/([0-9]+)/export', api.ExportJobAdd),
+        UnbakedURLSpec('/api/project/([0-9]+)/export/([0-9a-f]+)',
+                       api.ExportJobStatus),
 
         # Translation catalog and functions
         UnbakedURLSpec('/trans\\.js', TranslationJs, name='trans.js'),
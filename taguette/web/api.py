@@ -4,23 +4,28 @@ import functools
 import json
 import logging
 import math
-import os
 import prometheus_client
+import shutil
 from sqlalchemy import and_
 from sqlalchemy.exc import IntegrityError, DatabaseError, NoSuchTableError
 from sqlalchemy.orm import aliased, defer, joinedload
-import tempfile
+from sqlalchemy.sql import functions
 from tornado.concurrent import Future
 import tornado.log
 from tornado.web import MissingArgumentError, HTTPError
 from urllib.parse import unquote
+import uuid
 
 from .. import exact_version
 from .. import convert
 from .. import database
-from .. import extract
+from .. import pool
 from .. import validate
-from .base import BaseHandler, PromMeasureRequest
+from ..export import TooManyExportJobs
+from ..utils import background_task
+from .base import BaseHandler, PromMeasureRequest, UploadHandler
+from .export import codebook_document, export_key, highlighted_document, \
+    highlights_doc, run_export_job
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +36,11 @@ PROM_POLLING_CLIENTS = prometheus_client.Gauge(
     "Number of current polling clients",
 )
 
+PROM_IMPORT_JOBS = prometheus_client.Gauge(
+    'document_import_jobs',
+    "Number of documents being imported in the background",
+)
+
 PROM_REQUESTS = PromMeasureRequest(
     count=prometheus_client.Counter(
         'api_total',
@@ -104,10 +114,122 @@ class ProjectMeta(BaseHandler):
             return self.send_error_json(400, self.gettext(e.message))
 
 
-class DocumentAdd(BaseHandler):
+async def import_document(application, job, user_login, project_id,
+                          name, description, text_direction,
+                          filename, content_type, input_filename, upload_dir):
+    """Convert an uploaded file and add it to a project.
+
+    This runs in the background, so it doesn't matter if the client goes away.
+    The outcome is sent as an event: either 'document_add' or
+    'document_import_failed', both with the job's id.
+
+    The upload directory, containing the file, is deleted once it has been
+    converted. The caller counts the job in ``application.import_jobs``, it is
+    removed from there when done.
+    """
+    PROM_IMPORT_JOBS.inc()
+    try:
+        try:
+            with convert.conversion_owner(user_login, project_id):
+                html, text_index, chunks = await convert.to_html_chunks(
+                    input_filename, content_type, filename,
+                    application.config,
+                    cache=application.conversion_cache,
+                )
+        except convert.ConversionError as err:
+            logger.warning(
+                "Error converting document %r %s: %s",
+                filename, content_type, err,
+            )
+            error = str(err)
+        except pool.PoolFull:
+            logger.warning("Pool full converting document %r %s",
+                           filename, content_type)
+            error = "The server is busy, try again later"
+        except pool.PoolTimeout:
+            logger.warning("Pool timeout converting document %r %s",
+                           filename, content_type)
+            error = "The document took too long to process"
+        except Exception:
+            _document_import_failed(
+                application, job, user_login, project_id,
+                "Internal error converting the document",
+            )
+            raise
+        else:
+            error = None
+        finally:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+        if error is not None:
+            _document_import_failed(
+                application, job, user_login, project_id, error,
+            )
+            return
+
+        db = application.DBSession()
+        try:
+            project = db.query(database.Project).get(project_id)
+            if project is None:
+                logger.warning("Project %r went away during import job %s",
+                               project_id, job)
+                return
+            doc = database.Document(
+                name=name,
+                description=description,
+                filename=filename,
+                project=project,
+                text_direction=text_direction,
+                contents=html,
+                text_index=text_index,
+                chunks=[
+                    database.DocumentChunk(
+                        start_offset=offset,
+                        contents=chunk,
+                    )
+                    for offset, chunk in chunks
+                ],
+            )
+            db.add(doc)
+            db.flush()  # Need to flush to get doc.id
+            cmd = database.Command.document_add(user_login, doc, job=job)
+            db.add(cmd)
+            logger.info("Document added to project %r: %r %r (%d bytes)",
+                        project.id, doc.id, doc.name, len(doc.contents))
+            db.commit()
+            db.refresh(cmd)
+            application.notify_project(project.id, cmd)
+        finally:
+            db.close()
+    finally:
+        PROM_IMPORT_JOBS.dec()
+        application.import_jobs[user_login] -= 1
+        if not application.import_jobs[user_login]:
+            del application.import_jobs[user_login]
+
+
+def _document_import_failed(application, job, user_login, project_id, error):
+    db = application.DBSession()
+    try:
+        cmd = database.Command.document_import_failed(
+            user_login, project_id, job, error,
+        )
+        db.add(cmd)
+        db.commit()
+        db.refresh(cmd)
+        application.notify_project(project_id, cmd)
+    except IntegrityError:
+        # The project went away
+        logger.warning("Can't report failure of import job %s", job)
+    finally:
+        db.close()
+
+
+class DocumentAdd(UploadHandler):
     @api_auth
     @PROM_REQUESTS.async_('document_add')
     async def post(self, project_id):
+        files = self.read_upload()
         project, privileges = self.get_project(project_id)
         if not privileges.can_add_document():
             return await self.send_error_json(403, self.gettext(
@@ -119,7 +241,7 @@ class DocumentAdd(BaseHandler):
             description = self.get_body_argument('description')
             validate.description(description)
             try:
-                file = self.request.files['file'][0]
+                file = files['file'][0]
             except (KeyError, IndexError):
                 raise MissingArgumentError('file')
             content_type = file.content_type
@@ -133,52 +255,35 @@ class DocumentAdd(BaseHandler):
                     400,
                     "Invalid text direction",
                 )
-
-            # Close DB connection to not overflow the connection pool
-            self.close_db_connection()
-
-            try:
-                body = await convert.to_html_chunks(
-                    file.body, content_type, filename,
-                    self.application.config,
-                )
-            except convert.ConversionError as err:
-                logger.warning(
-                    "Error converting document %r %s: %s",
-                    filename, content_type, err,
-                )
-                return await self.send_error_json(400, str(err))
-            else:
-                doc = database.Document(
-                    name=name,
-                    description=description,
-                    filename=filename,
-                    project=project,
-                    text_direction=direction,
-                    contents=body,
-                )
-                self.db.add(doc)
-                self.db.flush()  # Need to flush to get doc.id
-                cmd = database.Command.document_add(
-                    self.current_user,
-                    doc,
-                )
-                self.db.add(cmd)
-                logger.info("Document added to project %r: %r %r (%d bytes)",
-                            project.id, doc.id, doc.name, len(doc.contents))
-                self.db.commit()
-                self.db.refresh(cmd)
-                self.application.notify_project(project.id, cmd)
-                return await self.send_json({'created': doc.id})
         except validate.InvalidFormat as e:
             logger.info("Error validating DocumentAdd: %r", e)
             return await self.send_error_json(400, self.gettext(e.message))
 
+        running = self.application.import_jobs.get(self.current_user, 0)
+        if running >= self.application.config['IMPORT_JOBS_PER_USER']:
+            return await self.send_error_json(429, self.gettext(
+                "Too many documents are being imported, wait for them to "
+                "finish",
+            ))
+
+        # Convert in the background, the result will be sent as an event
+        job = uuid.uuid4().hex
+        logger.info("Starting import job %s for project %r: %r %s",
+                    job, project.id, filename, content_type)
+        self.application.import_jobs[self.current_user] = running + 1
+        background_task(import_document(
+            self.application, job, self.current_user, project.id,
+            name, description, direction,
+            filename, content_type, file.path, self.keep_upload(),
+        ))
+        self.set_status(202)
+        return await self.send_json({'job': job})
+
 
 class Document(BaseHandler):
     @api_auth
-    @PROM_REQUESTS.sync('document_info')
-    def get(self, project_id, document_id):
+    @PROM_REQUESTS.async_('document_info')
+    async def get(self, project_id, document_id):
         document, _ = self.get_document(project_id, document_id)
 
         highlights = (
@@ -189,8 +294,9 @@ class Document(BaseHandler):
             .options(joinedload(database.Highlight.tags))
             .options(defer('tags.highlights_count'))
         ).all()
-        return self.send_json({
+        return await self.send_json({
             'text_direction': document.text_direction.name,
+            'chunk_offsets': await self.get_chunk_offsets(document),
             'highlights': [
                 {'id': hl.id,
                  'start_offset': hl.start_offset,
@@ -246,6 +352,7 @@ class Document(BaseHandler):
         if not privileges.can_delete_document():
             return self.send_error_json(403, self.gettext("Unauthorized"))
         self.db.delete(document)
+        self.application.document_cache.invalidate(document.id)
         cmd = database.Command.document_delete(
             self.current_user,
             document,
@@ -259,14 +366,48 @@ class Document(BaseHandler):
         return self.finish()
 
 
+def _chunk_range(chunks, start, limit):
+    """Select chunks, starting with the one containing offset ``start``.
+
+    Chunks are added until they total ``limit`` characters (but at least one
+    chunk is returned).
+    """
+    selected = []
+    size = 0
+    for offset, contents in chunks:
+        if offset <= start:
+            selected = []
+            size = 0
+        elif limit is not None and size >= limit:
+            break
+        selected.append((offset, contents))
+        size += len(contents)
+    return selected
+
+
 class DocumentContents(BaseHandler):
     @api_auth
-    @PROM_REQUESTS.sync('document_contents')
-    def get(self, project_id, document_id):
+    @PROM_REQUESTS.async_('document_contents')
+    async def get(self, project_id, document_id):
         # Document contents are immutable. If we ever make a change to the
         # format of this response, change this constant
         version = 1
 
+        # Clients can ask for a range of chunks
+        ranged = (
+            self.get_query_argument('from', None) is not None
+            or self.get_query_argument('limit', None) is not None
+        )
+        try:
+            start = int(self.get_query_argument('from', 0))
+            limit = self.get_query_argument('limit', None)
+            if limit is not None:
+                limit = int(limit)
+        except ValueError:
+            start = limit = -1
+        if start < 0 or (limit is not None and limit < 1):
+            return await self.send_error_json(400, "Invalid range")
+
         # Still, don't do it in desktop mode, because people might re-create
         # their Taguette database sooner than their browser profile
         if self.application.config['MULTIUSER']:
@@ -281,7 +422,12 @@ class DocumentContents(BaseHandler):
                 document_id = int(document_id)
             except ValueError:
                 raise HTTPError(404)
-            self.set_header('Etag', '"doc-%d-%d"' % (document_id, version))
+            if ranged:
+                self.set_header('Etag', '"doc-%d-%d-%d-%d"' % (
+                    document_id, version, start, limit or 0,
+                ))
+            else:
+                self.set_header('Etag', '"doc-%d-%d"' % (document_id, version))
 
             # Always return 304 if the client has a copy cached
             # This means that access control is not enforced, however:
@@ -293,12 +439,38 @@ class DocumentContents(BaseHandler):
                     'Content-Type',
                     'application/json; charset=utf-8',
                 )
-                return self.finish()
+                return await self.finish()
 
-        document, _ = self.get_document(project_id, document_id, True)
-        return self.send_json({
+        document, _ = self.get_document(project_id, document_id)
+
+        # Only load the chunks from the one containing the start
+        first = (
+            self.db.query(functions.max(database.DocumentChunk.start_offset))
+            .filter(database.DocumentChunk.document_id == document.id)
+            .filter(database.DocumentChunk.start_offset <= start)
+        ).scalar()
+        if first is not None:
+            query = (
+                self.db.query(
+                    database.DocumentChunk.start_offset,
+                    database.DocumentChunk.contents,
+                )
+                .filter(database.DocumentChunk.document_id == document.id)
+                .filter(database.DocumentChunk.start_offset >= first)
+                .order_by(database.DocumentChunk.start_offset)
+            )
+            chunks = _chunk_range(query.yield_per(4), start, limit)
+        else:
+            # Documents added before chunks existed get split on the fly
+            chunks = _chunk_range(
+                await self.split_document(document),
+                start, limit,
+            )
+
+        return await self.send_json({
             'contents': [
-                {'offset': 0, 'contents': document.contents},
+                {'offset': offset, 'contents': contents}
+                for offset, contents in chunks
             ],
         })
 
@@ -457,11 +629,13 @@ class TagMerge(BaseHandler):
 
 class HighlightAdd(BaseHandler):
     @api_auth
-    @PROM_REQUESTS.sync('highlight_add')
-    def post(self, project_id, document_id):
-        document, privileges = self.get_document(project_id, document_id, True)
+    @PROM_REQUESTS.async_('highlight_add')
+    async def post(self, project_id, document_id):
+        document, privileges = self.get_document(project_id, document_id)
         if not privileges.can_add_highlight():
-            return self.send_error_json(403, self.gettext("Unauthorized"))
+            return await self.send_error_json(403, self.gettext(
+                "Unauthorized",
+            ))
         obj = self.get_json()
         start, end = obj['start_offset'], obj['end_offset']
         new_tags = set(obj.get('tags', []))
@@ -474,16 +648,19 @@ class HighlightAdd(BaseHandler):
             .all()
         )
         if set(tag.id for tag in tags) != new_tags:
-            return self.send_error_json(400, self.gettext("No such tag"))
+            return await self.send_error_json(400, self.gettext("No such tag"))
 
-        snippet = extract.extract(document.contents, start, end)
+        snippet, snippet_text = await self.get_snippet(document, start, end)
         if all(c in '\r\n\t' for c in snippet):
-            return self.send_error_json(400, self.gettext("Empty highlight"))
+            return await self.send_error_json(400, self.gettext(
+                "Empty highlight",
+            ))
 
         hl = database.Highlight(document=document,
                                 start_offset=start,
                                 end_offset=end,
-                                snippet=snippet)
+                                snippet=snippet,
+                                snippet_text=snippet_text)
         self.db.add(hl)
         self.db.flush()  # Need to flush to get hl.id
 
@@ -511,25 +688,40 @@ class HighlightAdd(BaseHandler):
         self.db.refresh(cmd)
         self.application.notify_project(document.project_id, cmd)
 
-        return self.send_json({'id': hl.id})
+        return await self.send_json({'id': hl.id})
 
 
 class HighlightUpdate(BaseHandler):
     @api_auth
-    @PROM_REQUESTS.sync('highlight_update')
-    def post(self, project_id, document_id, highlight_id):
+    @PROM_REQUESTS.async_('highlight_update')
+    async def post(self, project_id, document_id, highlight_id):
         document, privileges = self.get_document(project_id, document_id)
         if not privileges.can_add_highlight():
-            return self.send_error_json(403, self.gettext("Unauthorized"))
+            return await self.send_error_json(403, self.gettext(
+                "Unauthorized",
+            ))
         obj = self.get_json()
         hl = self.db.query(database.Highlight).get(int(highlight_id))
         if hl is None or hl.document_id != document.id:
-            return self.send_error_json(404, self.gettext("No such highlight"))
+            return await self.send_error_json(404, self.gettext(
+                "No such highlight",
+            ))
         if obj:
-            if 'start_offset' in obj:
-                hl.start_offset = obj['start_offset']
-            if 'end_offset' in obj:
-                hl.end_offset = obj['end_offset']
+            if 'start_offset' in obj or 'end_offset' in obj:
+                if 'start_offset' in obj:
+                    hl.start_offset = obj['start_offset']
+                if 'end_offset' in obj:
+                    hl.end_offset = obj['end_offset']
+
+                # Recompute the snippet
+                hl.snippet, hl.snippet_text = await self.get_snippet(
+                    document, hl.start_offset, hl.end_offset,
+                )
+                if all(c in '\r\n\t' for c in hl.snippet):
+                    return await self.send_error_json(
+                        400,
+                        self.gettext("Empty highlight"),
+                    )
             if 'tags' in obj:
                 # Obtain old tags from database
                 old_tags = set(
@@ -548,7 +740,7 @@ class HighlightUpdate(BaseHandler):
                         .all()
                 )
                 if set(tag.id for tag in tags) != new_tags:
-                    return self.send_error_json(
+                    return await self.send_error_json(
                         400,
                         self.gettext("No such tag"),
                     )
@@ -599,7 +791,7 @@ class HighlightUpdate(BaseHandler):
             self.db.refresh(cmd)
             self.application.notify_project(document.project_id, cmd)
 
-        return self.send_json({'id': hl.id})
+        return await self.send_json({'id': hl.id})
 
     @api_auth
     @PROM_REQUESTS.sync('highlight_delete')
@@ -787,40 +979,38 @@ class MembersUpdate(BaseHandler):
         return self.finish()
 
 
-class ProjectImport(BaseHandler):
+class ProjectImport(UploadHandler):
+    SIZE_LIMIT_CONFIG = 'PROJECT_IMPORT_SIZE_LIMIT'
+
     def prepare(self):
         if not self.application.config['SQLITE3_IMPORT_ENABLED']:
             raise HTTPError(403)
+        return super(ProjectImport, self).prepare()
 
     @api_auth
     @PROM_REQUESTS.async_('project_import')
     async def post(self):
+        files = self.read_upload()
         try:
-            file = self.request.files['file'][0]
+            file = files['file'][0]
         except (KeyError, IndexError):
             raise MissingArgumentError('file')
 
-        with tempfile.TemporaryDirectory(
-            prefix='taguette_export_',
-        ) as tmp_dir:
-            filename = os.path.join(tmp_dir, 'db.sqlite3')
+        # The database was written to the upload directory
+        filename = file.path
 
-            # Write the database to temporary file
-            with open(filename, 'wb') as fp:
-                fp.write(file.body)
-
-            project_id = self.get_body_argument('project_id', None)
-            if project_id is None:
-                return await self._list_projects(filename)
-            else:
-                try:
-                    project_id = int(project_id)
-                except ValueError:
-                    self.set_status(400)
-                    return await self.send_json({
-                        'error': "Invalid project ID",
-                    })
-                return await self._import_project(filename, project_id)
+        project_id = self.get_body_argument('project_id', None)
+        if project_id is None:
+            return await self._list_projects(filename)
+        else:
+            try:
+                project_id = int(project_id)
+            except ValueError:
+                self.set_status(400)
+                return await self.send_json({
+                    'error': "Invalid project ID",
+                })
+            return await self._import_project(filename, project_id)
 
     async def _list_projects(self, filename):
         # Connect to the database
@@ -895,6 +1085,99 @@ class ProjectImport(BaseHandler):
         return await self.send_json({'project_id': new_project_id})
 
 
+def export_job_json(handler, job):
+    obj = {'job': job.id, 'status': job.status}
+    if job.status == 'done':
+        obj['url'] = handler.reverse_url(
+            'export_job', job.project_id, job.id,
+        )
+    elif job.status == 'failed':
+        obj['error'] = handler.gettext(job.error)
+    return obj
+
+
+class ExportJobAdd(BaseHandler):
+    """Start exporting a document in the background.
+
+    Converting to some formats (docx, pdf) goes through Calibre and can take
+    a while. Instead of waiting on the download, clients can start a job,
+    poll its status, and download the result once it is done.
+    """
+    @api_auth
+    @PROM_REQUESTS.async_('export_job_add')
+    async def post(self, project_id):
+        project, _ = self.get_project(project_id)
+        obj = self.get_json()
+        try:
+            validate.export_job(obj)
+        except validate.InvalidFormat as e:
+            logger.info("Error validating ExportJobAdd: %r", e)
+            return await self.send_error_json(400, self.gettext(e.message))
+        kind = obj['kind']
+        ext = obj.get('extension', '').lower()
+        if ext not in convert.html_to_extensions:
+            return await self.send_error_json(400, self.gettext(
+                "Unsupported format",
+            ))
+
+        if kind == 'highlights':
+            path = obj.get('path', '')
+            key = export_key(project, 'highlights', (path, ext), self.locale)
+            generate = functools.partial(highlights_doc, path=path)
+        elif kind == 'document':
+            document, _ = self.get_document(project.id, obj['document_id'])
+            key = export_key(project, 'document', (document.id, ext),
+                             self.locale)
+            generate = functools.partial(
+                highlighted_document,
+                document_id=document.id,
+            )
+        elif kind == 'codebook':
+            key = export_key(project, 'codebook', (ext,), self.locale)
+            generate = codebook_document
+        else:
+            return await self.send_error_json(400, self.gettext(
+                "Invalid export",
+            ))
+
+        try:
+            job, created = self.application.export_jobs.add(
+                key, project.id, ext, self.current_user,
+            )
+        except TooManyExportJobs:
+            return await self.send_error_json(429, self.gettext(
+                "Too many exports are running, wait for them to finish",
+            ))
+        if created:
+            logger.info("Starting export job %s for project %r: %s %s",
+                        job.id, project.id, kind, ext)
+            background_task(run_export_job(
+                self.application, job,
+                functools.partial(
+                    generate,
+                    self.application,
+                    user_login=self.current_user,
+                    locale=self.locale,
+                    project_id=project.id,
+                    ext=ext,
+                ),
+            ))
+        return await self.send_json(export_job_json(self, job))
+
+
+class ExportJobStatus(BaseHandler):
+    @api_auth
+    @PROM_REQUESTS.async_('export_job_status')
+    async def get(self, project_id, job_id):
+        project, _ = self.get_project(project_id)
+        job = self.application.export_jobs.get(job_id)
+        if job is None or job.project_id != project.id:
+            return await self.send_error_json(404, self.gettext(
+                "No such export",
+            ))
+        return await self.send_json(export_job_json(self, job))
+
+
 class TooManyCommands(Exception):
     """There are too many commands, have the client reload instead.
     """
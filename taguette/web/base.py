@@ -1,6 +1,8 @@
 import asyncio
 import bleach
 import contextlib
+import email.message
+import email.utils
 import functools
 import hashlib
 import hmac
@@ -15,19 +17,27 @@ from prometheus_async.aio import time as prom_async_time
 import prometheus_client
 import re
 import redis.asyncio as aioredis
+import shutil
 import signal
 import smtplib
 from sqlalchemy.orm import joinedload, undefer
 import ssl
+import tempfile
 import tornado.ioloop
 from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import HTTPHeaders, HTTPInputError
 import tornado.locale
 import tornado.iostream
-from tornado.web import HTTPError, RequestHandler
+from tornado.web import HTTPError, RequestHandler, stream_request_body
 from urllib.parse import urlencode
 
 from .. import __version__, exact_version
+from .. import convert
 from .. import database
+from .. import extract
+from .. import pool
+from ..cache import ConversionCache, DocumentCache, ExportCache
+from ..export import ExportJobs
 from ..utils import background_task
 
 
@@ -48,6 +58,20 @@ PROM_EMAILS = prometheus_client.Counter(
 
 PROM_EMAILS.labels('password_reset').inc(0)
 
+PROM_UPLOAD_REJECTED = prometheus_client.Counter(
+    'upload_rejected_total',
+    "Uploads rejected before being handled",
+    labelnames=['reason'],
+)
+
+PROM_UPLOAD_REJECTED.labels('too_big').inc(0)
+PROM_UPLOAD_REJECTED.labels('invalid').inc(0)
+PROM_UPLOAD_REJECTED.labels('xsrf').inc(0)
+
+
+# Snippets longer than this are converted to plain text in the process pool
+INLINE_SNIPPET_SIZE = 10000
+
 
 class PseudoLocale(tornado.locale.Locale):
     def __init__(self):
@@ -167,6 +191,36 @@ class Application(GracefulExitApplication):
 
         self.DBSession = database.connect(config['DATABASE'])
         self.event_waiters = {}
+        self.document_cache = DocumentCache(config['DOCUMENT_CACHE_SIZE'])
+        self.conversion_cache = ConversionCache(
+            config['CONVERT_CACHE_DIR'],
+            config['CONVERT_CACHE_SIZE'],
+        )
+        self.export_cache = ExportCache(
+            config['EXPORT_CACHE_DIR'],
+            config['EXPORT_CACHE_SIZE'],
+            config['EXPORT_CACHE_MAX_AGE'],
+        )
+        self.export_jobs = ExportJobs(
+            config['EXPORT_JOBS_TTL'],
+            config['EXPORT_JOBS_PER_USER'],
+        )
+        self.import_jobs = {}  # Number of running import jobs by user
+
+        convert.configure_scheduler(
+            config['CONVERT_MAX_PROCESSES'],
+            config['CONVERT_PROCESS_MEMORY'],
+        )
+
+        # Desktop mode does the work in-process
+        if config['MULTIUSER']:
+            pool.configure(
+                config['PROCESS_POOL_SIZE'],
+                config['PROCESS_POOL_QUEUE'],
+                config['PROCESS_POOL_TIMEOUT'],
+            )
+        else:
+            pool.configure(0, 0)
 
         if config['REDIS_SERVER'] is not None:
             self.redis = aioredis.Redis.from_url(config['REDIS_SERVER'])
@@ -578,6 +632,72 @@ class BaseHandler(HandleStreamClosed, RequestHandler):
         member, document = res
         return document, member.privileges
 
+    async def get_document_text(self, document):
+        """Get the contents and text index of a document.
+
+        They are kept in the application's ``DocumentCache``.
+        """
+        cache = self.application.document_cache
+        cached = cache.get(document.id)
+        if cached is not None:
+            return cached
+
+        contents, text_index = (
+            self.db.query(
+                database.Document.contents,
+                database.Document.text_index,
+            )
+            .filter(database.Document.id == document.id)
+        ).one()
+
+        # Documents added before the index existed get indexed now
+        if text_index is None:
+            text_index = await pool.run(extract.build_index, contents)
+            document.text_index = text_index
+
+        cache.put(document.id, document.project_id, contents, text_index)
+        return contents, text_index
+
+    async def split_document(self, document):
+        """Split a document that has no stored chunks.
+        """
+        contents, text_index = await self.get_document_text(document)
+        return await pool.run(extract.split_chunks, contents, text_index)
+
+    async def get_snippet(self, document, start, end):
+        """Extract a snippet of a document, and get its plain-text version.
+
+        With a text index, extracting only slices the document, and is done
+        here. The document is only sent to the process pool if it has to be
+        parsed.
+        """
+        contents, text_index = await self.get_document_text(document)
+        if not extract.is_index_usable(text_index):
+            return await pool.run(
+                convert.extract_snippet,
+                contents, start, end,
+            )
+        snippet = extract.extract(contents, start, end, text_index)
+        if len(snippet) > INLINE_SNIPPET_SIZE:
+            return snippet, await pool.run(convert.html_to_plaintext, snippet)
+        return snippet, convert.html_to_plaintext(snippet)
+
+    async def get_chunk_offsets(self, document):
+        """Get the offsets of the chunks of a document.
+        """
+        offsets = [
+            row[0]
+            for row in self.db.query(database.DocumentChunk.start_offset)
+            .filter(database.DocumentChunk.document_id == document.id)
+            .order_by(database.DocumentChunk.start_offset)
+        ]
+        if not offsets:
+            offsets = [
+                offset
+                for offset, _ in await self.split_document(document)
+            ]
+        return offsets
+
     def redirect(self, url, permanent=False, status=None):
         if status is None:
             if permanent:
@@ -609,6 +729,22 @@ class BaseHandler(HandleStreamClosed, RequestHandler):
         self.set_status(status, reason)
         return self.send_json({'error': message})
 
+    def log_exception(self, typ, value, tb):
+        # The pool has logged a warning already
+        if isinstance(value, (pool.PoolFull, pool.PoolTimeout)):
+            return
+        super(BaseHandler, self).log_exception(typ, value, tb)
+
+    def send_error(self, status_code=500, **kwargs):
+        # The process pool is overloaded
+        if 'exc_info' in kwargs and isinstance(
+            kwargs['exc_info'][1],
+            (pool.PoolFull, pool.PoolTimeout),
+        ):
+            status_code = 503
+            kwargs['reason'] = "Server is busy"
+        super(BaseHandler, self).send_error(status_code, **kwargs)
+
     def write_error(self, status_code, **kwargs):
         # If database session has failed, can't use it to render the error
         self.close_db_connection()
@@ -633,6 +769,295 @@ class BaseHandler(HandleStreamClosed, RequestHandler):
             )
 
 
+class UploadedFile(object):
+    """A file from a multipart request body, spooled to disk.
+    """
+    def __init__(self, filename, content_type, path):
+        self.filename = filename
+        self.content_type = content_type
+        self.path = path
+        self.size = 0
+
+    def __repr__(self):
+        return '<UploadedFile %r %s, %d bytes>' % (
+            self.filename, self.content_type, self.size,
+        )
+
+
+def _parse_content_disposition(value):
+    """Parse a Content-Disposition header into its type and parameters.
+    """
+    msg = email.message.Message()
+    msg['Content-Disposition'] = value
+    params = {}
+    for key, param in msg.get_params([], header='Content-Disposition')[1:]:
+        params[key] = email.utils.collapse_rfc2231_value(param)
+    return msg.get_content_disposition(), params
+
+
+class MultipartParser(object):
+    """Incremental parser for ``multipart/form-data`` request bodies.
+
+    Data is fed as it is received. Files are written to ``directory`` as they
+    arrive, so the body is never held in memory; other fields are collected
+    in ``arguments``, up to ``FIELD_SIZE_LIMIT`` bytes each.
+    """
+    HEADER_SIZE_LIMIT = 16384
+    FIELD_SIZE_LIMIT = 1000000  # 1 MB
+    MAX_PARTS = 100
+
+    def __init__(self, boundary, directory):
+        if boundary.startswith(b'"') and boundary.endswith(b'"'):
+            boundary = boundary[1:-1]
+        if not boundary:
+            raise HTTPError(400, "Invalid multipart/form-data: no boundary")
+        # The CRLF before a delimiter belongs to the delimiter. The first one
+        # might not have it, so start with one
+        self.delimiter = b'\r\n--' + boundary
+        self.directory = directory
+        self.arguments = {}
+        self.files = {}
+        self._buffer = b'\r\n'
+        self._state = 'preamble'
+        self._parts = 0
+        self._field = None
+        self._file = None
+        self._fp = None
+
+    def feed(self, data):
+        self._buffer += data
+        while True:
+            if self._state in ('preamble', 'body'):
+                pos = self._buffer.find(self.delimiter)
+                if pos == -1:
+                    # Keep what could be the beginning of a delimiter
+                    keep = len(self.delimiter) - 1
+                    if len(self._buffer) > keep:
+                        self._write(self._buffer[:-keep])
+                        self._buffer = self._buffer[-keep:]
+                    return
+                self._write(self._buffer[:pos])
+                self._end_part()
+                self._buffer = self._buffer[pos + len(self.delimiter):]
+                self._state = 'delimiter'
+            elif self._state == 'delimiter':
+                if len(self._buffer) < 2:
+                    return
+                if self._buffer[:2] == b'--':
+                    self._state = 'epilogue'
+                elif self._buffer[:2] == b'\r\n':
+                    self._state = 'headers'
+                else:
+                    raise HTTPError(400, "Invalid multipart/form-data")
+                self._buffer = self._buffer[2:]
+            elif self._state == 'headers':
+                pos = self._buffer.find(b'\r\n\r\n')
+                if pos == -1:
+                    if len(self._buffer) > self.HEADER_SIZE_LIMIT:
+                        raise HTTPError(
+                            400,
+                            "multipart/form-data part header too large",
+                        )
+                    return
+                self._start_part(self._buffer[:pos])
+                self._buffer = self._buffer[pos + 4:]
+                self._state = 'body'
+            else:  # epilogue
+                self._buffer = b''
+                return
+
+    def _start_part(self, headers):
+        self._parts += 1
+        if self._parts > self.MAX_PARTS:
+            raise HTTPError(400, "multipart/form-data has too many parts")
+        try:
+            headers = HTTPHeaders.parse(headers.decode('utf-8'))
+        except (UnicodeDecodeError, HTTPInputError):
+            raise HTTPError(400, "Invalid multipart/form-data")
+        disposition, params = _parse_content_disposition(
+            headers.get('Content-Disposition', ''),
+        )
+        name = params.get('name')
+        if disposition != 'form-data' or not name:
+            raise HTTPError(400, "Invalid multipart/form-data")
+        if params.get('filename'):
+            file = UploadedFile(
+                params['filename'],
+                headers.get('Content-Type', 'application/unknown'),
+                os.path.join(self.directory, 'file%d' % self._parts),
+            )
+            self.files.setdefault(name, []).append(file)
+            self._file = file
+            self._fp = open(file.path, 'wb')
+        else:
+            self._field = name, bytearray()
+
+    def _write(self, data):
+        if not data:
+            return
+        if self._fp is not None:
+            self._fp.write(data)
+            self._file.size += len(data)
+        elif self._field is not None:
+            value = self._field[1]
+            if len(value) + len(data) > self.FIELD_SIZE_LIMIT:
+                raise HTTPError(400, "multipart/form-data field too large")
+            value.extend(data)
+
+    def _end_part(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = self._file = None
+        elif self._field is not None:
+            name, value = self._field
+            self.arguments.setdefault(name, []).append(bytes(value))
+            self._field = None
+
+    def close_files(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = self._file = None
+
+    def close(self):
+        """Close the files, and check that the whole body was received.
+        """
+        self.close_files()
+        if self._state != 'epilogue':
+            raise HTTPError(
+                400,
+                "Invalid multipart/form-data: no final boundary found",
+            )
+
+
+@stream_request_body
+class UploadHandler(BaseHandler):
+    """Base class for handlers receiving files.
+
+    The request body is parsed as it is received, and files are written to a
+    temporary directory instead of being kept in memory. The body size is
+    limited by the configuration key named in ``SIZE_LIMIT_CONFIG``.
+
+    The XSRF token has to be in the headers or the query string, so it can be
+    checked before the body is received. The method handling the request has
+    to call ``read_upload()`` before using the files or body arguments.
+    """
+    SIZE_LIMIT_CONFIG = 'UPLOAD_SIZE_LIMIT'
+
+    def __init__(self, application, request, **kwargs):
+        super(UploadHandler, self).__init__(application, request, **kwargs)
+        self.upload_dir = None
+        self._upload = None
+        self._upload_error = None
+        self._xsrf_missing = False
+
+    def check_xsrf_cookie(self):
+        # This is called before the body is received, so a token in the body
+        # can't be used. prepare() rejects the request without reading it
+        if (
+            self.get_query_argument('_xsrf', None) is None
+            and 'X-Xsrftoken' not in self.request.headers
+            and 'X-Csrftoken' not in self.request.headers
+        ):
+            self._xsrf_missing = True
+        else:
+            super(UploadHandler, self).check_xsrf_cookie()
+
+    def prepare(self):
+        if self._xsrf_missing:
+            PROM_UPLOAD_REJECTED.labels('xsrf').inc()
+            return self._reject_upload(
+                403,
+                "'_xsrf' argument missing from headers or query string",
+            )
+        if not self.current_user:
+            return self._reject_upload(403, self.gettext("Not logged in"))
+
+        limit = self.application.config[self.SIZE_LIMIT_CONFIG]
+        try:
+            length = int(self.request.headers.get('Content-Length', 0))
+        except ValueError:
+            raise HTTPError(400)
+        if length > limit:
+            PROM_UPLOAD_REJECTED.labels('too_big').inc()
+            logger.info("Rejecting upload of %d bytes", length)
+            return self._reject_upload(413, self.gettext(
+                "This file is too big",
+            ))
+        # Also applies if the body is sent without a Content-Length
+        self.request.connection.set_max_body_size(limit)
+
+        boundary = None
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            for field in content_type.split(';'):
+                key, _, value = field.strip().partition('=')
+                if key == 'boundary':
+                    boundary = value.encode('latin1')
+        if boundary is None:
+            PROM_UPLOAD_REJECTED.labels('invalid').inc()
+            return self._reject_upload(400, "Expected multipart/form-data")
+
+        self.upload_dir = tempfile.mkdtemp(prefix='taguette_upload_')
+        self._upload = MultipartParser(boundary, self.upload_dir)
+
+    def _reject_upload(self, status, message):
+        # The body is not going to be read, so the connection will be closed.
+        # Tell the client, so it doesn't try to send another request on it
+        self.set_header('Connection', 'close')
+        return self.send_error_json(status, message)
+
+    def data_received(self, chunk):
+        if self._upload is None or self._upload_error is not None:
+            return
+        try:
+            self._upload.feed(chunk)
+        except HTTPError as e:
+            # Raised from read_upload(), Tornado would drop the connection
+            self._upload_error = e
+            self._upload.close_files()
+
+    def read_upload(self):
+        """Finish reading the body.
+
+        Returns a dict mapping field names to lists of ``UploadedFile``.
+        """
+        if self._upload_error is None:
+            try:
+                self._upload.close()
+            except HTTPError as e:
+                self._upload_error = e
+        if self._upload_error is not None:
+            PROM_UPLOAD_REJECTED.labels('invalid').inc()
+            raise self._upload_error
+        for name, values in self._upload.arguments.items():
+            self.request.body_arguments.setdefault(name, []).extend(values)
+            self.request.arguments.setdefault(name, []).extend(values)
+        return self._upload.files
+
+    def keep_upload(self):
+        """Take ownership of the upload directory.
+
+        It is otherwise deleted when the request finishes. Returns its path.
+        """
+        directory, self.upload_dir = self.upload_dir, None
+        return directory
+
+    def remove_upload(self):
+        if self._upload is not None:
+            self._upload.close_files()
+        if self.upload_dir is not None:
+            shutil.rmtree(self.upload_dir, ignore_errors=True)
+            self.upload_dir = None
+
+    def on_finish(self):
+        super(UploadHandler, self).on_finish()
+        self.remove_upload()
+
+    def on_connection_close(self):
+        super(UploadHandler, self).on_connection_close()
+        self.remove_upload()
+
+
 class PromMeasureRequest(object):
     def __init__(self, count, time):
         self.count = count
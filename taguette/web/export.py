@@ -1,15 +1,18 @@
+import asyncio
 from datetime import datetime, timezone
 import logging
 import os
 import prometheus_client
-import shutil
 import string
 import tempfile
-from tornado.web import authenticated
+from tornado.web import HTTPError, authenticated
 
 from .. import convert
 from .. import database
 from .. import export
+from .. import pool
+from ..cache import ExportCache
+from ..utils import _f
 from .base import BaseHandler
 
 
@@ -29,6 +32,10 @@ PROM_EXPORT = prometheus_client.Counter(
     "Export",
     ['what', 'extension'],
 )
+PROM_EXPORT_JOBS = prometheus_client.Gauge(
+    'export_jobs',
+    "Number of exports running in the background",
+)
 
 
 def init_PROM_EXPORT(w):
@@ -36,6 +43,167 @@ def init_PROM_EXPORT(w):
         PROM_EXPORT.labels(w, e).inc(0)
 
 
+def export_key(project, kind, params, locale):
+    return ExportCache.project_key(
+        project.id, project.last_event,
+        kind, params, locale.code,
+        convert.EXPORT_VERSION,
+    )
+
+
+class ExportHandler(BaseHandler):
+    """Base class for export handlers.
+
+    Exports only depend on the state of the project, identified by its last
+    event, and on the parameters of the request. This makes them cacheable,
+    and their cache key is used as the ETag.
+    """
+    def export_key(self, project, kind, *params):
+        return export_key(project, kind, params, self.locale)
+
+    def get_cached_export(self, key):
+        """Set the ETag of an export, and get it from the cache.
+
+        Returns an iterable over the chunks of the export, or None if it has
+        to be generated. If the client already has it, the status is set to
+        304 and the iterable is empty.
+        """
+        self.set_header('Etag', '"%s"' % key)
+        if self.check_etag_header():
+            self.set_status(304)
+            return []
+        fp = self.application.export_cache.open(key)
+        if fp is None:
+            return None
+        return convert.FileContents(fp)
+
+    def cache_export(self, key, chunks):
+        """Store an export in the cache while it is being sent.
+        """
+        return self.application.export_cache.tee(key, chunks)
+
+    async def send_chunks(self, chunks):
+        """Send chunks, waiting for each one to be sent.
+        """
+        try:
+            for chunk in chunks:
+                self.write(chunk)
+                await self.flush()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        return await self.finish()
+
+    async def send_file(self, key, filename):
+        """Send a file, storing it in the cache.
+        """
+        contents = convert.FileContents(open(filename, 'rb'))
+        try:
+            return await self.send_chunks(self.cache_export(key, contents))
+        finally:
+            contents.close()
+
+
+# Exports converted to text documents, which can be slow and can be run as
+# background jobs (see run_export_job())
+
+
+async def highlights_doc(application, db, user_login, locale,
+                         project_id, path, ext):
+    name = export.get_filename_for_highlights_export(path)
+    with convert.conversion_owner(user_login, project_id):
+        mimetype, contents = await export.highlights_doc(
+            db,
+            project_id,
+            path,
+            ext,
+            config=application.config,
+            locale=locale,
+            cache=application.export_cache,
+        )
+    return name, mimetype, contents
+
+
+async def highlighted_document(application, db, user_login, locale,
+                               project_id, document_id, ext):
+    doc = db.query(database.Document).get(document_id)
+    name = safe_filename(doc.name)
+    with convert.conversion_owner(user_login, project_id):
+        mimetype, contents = await export.highlighted_document(
+            db,
+            doc,
+            ext,
+            config=application.config,
+            locale=locale,
+            cache=application.export_cache,
+        )
+    return name, mimetype, contents
+
+
+async def codebook_document(application, db, user_login, locale,
+                            project_id, ext):
+    tags = list(db.query(database.Project).get(project_id).tags)
+
+    # Close DB connection to not overflow the connection pool
+    db.close()
+
+    with convert.conversion_owner(user_login, project_id):
+        mimetype, contents = await export.codebook_document(
+            tags,
+            ext,
+            config=application.config,
+            locale=locale,
+            cache=application.export_cache,
+        )
+    return 'codebook', mimetype, contents
+
+
+async def run_export_job(application, job, generate):
+    """Run an export in the background, writing it to the job's file.
+
+    :param generate: Function generating the export from a database session,
+        e.g. a partial application of ``highlights_doc()``
+    """
+    PROM_EXPORT_JOBS.inc()
+    db = application.DBSession()
+    loop = asyncio.get_event_loop()
+    try:
+        name, mimetype, contents = await generate(db)
+        db.close()
+        await loop.run_in_executor(
+            None,
+            _write_job_file, job.filename, contents,
+        )
+    except convert.ConversionError as e:
+        logger.warning("Export job %s failed: %s", job.id, e)
+        job.failed(str(e))
+    except pool.PoolFull:
+        logger.warning("Pool full running export job %s", job.id)
+        job.failed(_f("The server is busy, try again later"))
+    except pool.PoolTimeout:
+        logger.warning("Pool timeout running export job %s", job.id)
+        job.failed(_f("The export took too long"))
+    except Exception:
+        job.failed(_f("Internal error exporting the document"))
+        raise
+    else:
+        logger.info("Export job %s done", job.id)
+        await application.export_cache.put_file(job.key, job.filename)
+        job.done(name, mimetype)
+    finally:
+        db.close()
+        PROM_EXPORT_JOBS.dec()
+
+
+def _write_job_file(filename, contents):
+    with open(filename, 'wb') as fp:
+        for chunk in contents:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            fp.write(chunk)
+
+
 def return_doc(wrapped):
     """Decorator for returning a file, or a conversion error.
     """
@@ -44,10 +212,12 @@ def return_doc(wrapped):
         try:
             name, mimetype, contents = await wrapped(self, *args)
         except convert.UnsupportedFormat:
+            self.clear_header('Etag')
             self.set_status(404)
             self.set_header('Content-Type', 'text/plain')
             return await self.finish("Unsupported format: %s" % ext)
         except convert.ConversionError as e:
+            self.clear_header('Etag')
             self.set_status(500)
             self.set_header('Content-Type', 'text/plain')
             return await self.finish("Conversion error: %s" % e)
@@ -60,18 +230,16 @@ def return_doc(wrapped):
         else:
             self.set_header('Content-Disposition', 'attachment')
 
-        for chunk in contents:
-            self.write(chunk)
-        return await self.finish()
+        return await self.send_chunks(contents)
 
     return wrapper
 
 
-class ExportHighlightsCsv(BaseHandler):
+class ExportHighlightsCsv(ExportHandler):
     PROM_EXPORT.labels('highlights_doc', 'csv').inc(0)
 
     @authenticated
-    def get(self, project_id, path):
+    async def get(self, project_id, path):
         PROM_EXPORT.labels('highlights_doc', 'csv').inc()
 
         project, _ = self.get_project(project_id)
@@ -84,20 +252,22 @@ class ExportHighlightsCsv(BaseHandler):
         else:
             self.set_header('Content-Disposition', 'attachment')
 
-        export.highlights_csv(
-            self.db,
-            project.id,
-            path,
-            WriteAdapter(self.write),
-        )
-        return self.finish()
+        key = self.export_key(project, 'highlights', path, 'csv')
+        contents = self.get_cached_export(key)
+        if contents is None:
+            # Send each batch before reading more from the database
+            contents = self.cache_export(
+                key,
+                export.highlights_csv(self.db, project.id, path),
+            )
+        return await self.send_chunks(contents)
 
 
-class ExportHighlightsXlsx(BaseHandler):
+class ExportHighlightsXlsx(ExportHandler):
     PROM_EXPORT.labels('highlights_doc', 'xls').inc(0)
 
     @authenticated
-    def get(self, project_id, path):
+    async def get(self, project_id, path):
         PROM_EXPORT.labels('highlights_doc', 'xls').inc()
 
         project, _ = self.get_project(project_id)
@@ -112,23 +282,19 @@ class ExportHighlightsXlsx(BaseHandler):
         else:
             self.set_header('Content-Disposition', 'attachment')
 
-        tmp = tempfile.mkdtemp(prefix='taguette_xlsx_')
-        try:
+        key = self.export_key(project, 'highlights', path, 'xlsx')
+        contents = self.get_cached_export(key)
+        if contents is not None:
+            return await self.send_chunks(contents)
+
+        with tempfile.TemporaryDirectory(prefix='taguette_xlsx_') as tmp:
             filename = os.path.join(tmp, 'highlights.xlsx')
-            export.highlights_xslx(self.db, project.id, path, filename)
-            with open(filename, 'rb') as fp:
-                chunk = fp.read(4096)
-                self.write(chunk)
-                while len(chunk) == 4096:
-                    chunk = fp.read(4096)
-                    if chunk:
-                        self.write(chunk)
-            return self.finish()
-        finally:
-            shutil.rmtree(tmp)
+            await export.highlights_xslx(self.db, project.id, path, filename)
+            self.close_db_connection()
+            return await self.send_file(key, filename)
 
 
-class ExportHighlightsDoc(BaseHandler):
+class ExportHighlightsDoc(ExportHandler):
     init_PROM_EXPORT('highlights_doc')
 
     @authenticated
@@ -139,20 +305,19 @@ class ExportHighlightsDoc(BaseHandler):
 
         project, _ = self.get_project(project_id)
 
-        # Close DB connection to not overflow the connection pool
-        self.close_db_connection()
-
         name = export.get_filename_for_highlights_export(path)
-        mimetype, contents = export.highlights_doc(
-            self.db,
-            project.id,
-            path,
-            ext,
-            config=self.application.config,
-            locale=self.locale,
+        mimetype = convert.html_to_mimetype(ext)
+        key = self.export_key(project, 'highlights', path, ext)
+        contents = self.get_cached_export(key)
+        if contents is not None:
+            return name, mimetype, contents
+
+        # The DB connection is closed once the highlights have been rendered
+        name, mimetype, contents = await highlights_doc(
+            self.application, self.db, self.current_user, self.locale,
+            project.id, path, ext,
         )
-        contents = await contents
-        return name, mimetype, contents
+        return name, mimetype, self.cache_export(key, contents)
 
 
 _safe_filename_chars = set(
@@ -166,7 +331,7 @@ def safe_filename(name):
     return ''.join(c for c in name if c in _safe_filename_chars)
 
 
-class ExportDocument(BaseHandler):
+class ExportDocument(ExportHandler):
     init_PROM_EXPORT('document')
 
     @authenticated
@@ -175,84 +340,146 @@ class ExportDocument(BaseHandler):
         PROM_EXPORT.labels('document', ext.lower()).inc()
         doc, _ = self.get_document(project_id, document_id, True)
 
+        name = safe_filename(doc.name)
+        mimetype = convert.html_to_mimetype(ext)
+        key = self.export_key(doc.project, 'document', doc.id, ext.lower())
+        contents = self.get_cached_export(key)
+        if contents is not None:
+            return name, mimetype, contents
+
         # Close DB connection to not overflow the connection pool
         self.close_db_connection()
 
-        name = safe_filename(doc.name)
-
-        mimetype, contents = await export.highlighted_document(
-            self.db,
-            doc,
-            ext,
-            config=self.application.config,
-            locale=self.locale,
+        name, mimetype, contents = await highlighted_document(
+            self.application, self.db, self.current_user, self.locale,
+            doc.project_id, doc.id, ext,
         )
-        return name, mimetype, contents
+        return name, mimetype, self.cache_export(key, contents)
+
+
+class ExportDocumentsZip(ExportHandler):
+    init_PROM_EXPORT('documents_zip')
+
+    @authenticated
+    async def get(self, project_id):
+        ext = self.get_query_argument('format', 'html').lower()
+        if ext not in convert.html_to_extensions:
+            self.set_status(404)
+            self.set_header('Content-Type', 'text/plain')
+            return await self.finish("Unsupported format: %s" % ext)
+        PROM_EXPORT.labels('documents_zip', ext).inc()
+        project, _ = self.get_project(project_id)
+
+        self.set_header('Content-Type', 'application/zip')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="%s_documents.zip"' % (
+                            safe_filename(project.name),
+                        ))
+
+        key = self.export_key(project, 'documents', ext)
+        contents = self.get_cached_export(key)
+        if contents is not None:
+            return await self.send_chunks(contents)
+
+        # Send each document as soon as it is ready, don't cache the
+        # archive if some of them failed
+        errors = []
+        with convert.conversion_owner(self.current_user, project.id):
+            contents = self.application.export_cache.atee(
+                key,
+                export.documents_zip(
+                    self.db,
+                    project.id,
+                    ext,
+                    config=self.application.config,
+                    locale=self.locale,
+                    cache=self.application.export_cache,
+                    errors=errors,
+                ),
+                cacheable=lambda: not errors,
+            )
+            async for chunk in contents:
+                self.write(chunk)
+                await self.flush()
+        return await self.finish()
 
 
-class ExportCodebookXml(BaseHandler):
+class ExportCodebookXml(ExportHandler):
     PROM_EXPORT.labels('codebook', 'qdc').inc(0)
 
     @authenticated
-    def get(self, project_id):
+    async def get(self, project_id):
         PROM_EXPORT.labels('codebook', 'qdc').inc()
         project, _ = self.get_project(project_id)
-        tags = list(project.tags)
         self.set_header('Content-Type', 'text/xml; charset=utf-8')
         self.set_header('Content-Disposition',
                         'attachment; filename="codebook.qdc"')
 
-        export.codebook_xml(tags, WriteAdapter(self.write))
-        return self.finish()
+        key = self.export_key(project, 'codebook', 'qdc')
+        contents = self.get_cached_export(key)
+        if contents is None:
+            contents = []
+            export.codebook_xml(
+                list(project.tags),
+                WriteAdapter(contents.append),
+            )
+            contents = self.cache_export(key, contents)
+        return await self.send_chunks(contents)
 
 
-class ExportCodebookCsv(BaseHandler):
+class ExportCodebookCsv(ExportHandler):
     PROM_EXPORT.labels('codebook', 'csv').inc(0)
 
     @authenticated
-    def get(self, project_id):
+    async def get(self, project_id):
         PROM_EXPORT.labels('codebook', 'csv').inc()
         project, _ = self.get_project(project_id)
-        tags = list(project.tags)
         self.set_header('Content-Type', 'text/csv; charset=utf-8')
         self.set_header('Content-Disposition',
                         'attachment; filename="codebook.csv"')
-        export.codebook_csv(tags, WriteAdapter(self.write))
-        return self.finish()
+
+        key = self.export_key(project, 'codebook', 'csv')
+        contents = self.get_cached_export(key)
+        if contents is None:
+            contents = []
+            export.codebook_csv(
+                list(project.tags),
+                WriteAdapter(contents.append),
+            )
+            contents = self.cache_export(key, contents)
+        return await self.send_chunks(contents)
 
 
-class ExportCodebookXlsx(BaseHandler):
+class ExportCodebookXlsx(ExportHandler):
     PROM_EXPORT.labels('codebook', 'xls').inc(0)
 
     @authenticated
-    def get(self, project_id):
+    async def get(self, project_id):
         PROM_EXPORT.labels('codebook', 'xls').inc()
         project, _ = self.get_project(project_id)
-        tags = list(project.tags)
         self.set_header('Content-Type',
                         ('application/vnd.openxmlformats-officedocument.'
                          'spreadsheetml.sheet'))
         self.set_header('Content-Disposition',
                         'attachment; filename="codebook.xlsx"')
-        tmp = tempfile.mkdtemp(prefix='taguette_xlsx_')
-        try:
-            filename = os.path.join(tmp, 'codebook.xlsx')
 
-            export.codebook_xlsx(tags, filename)
+        key = self.export_key(project, 'codebook', 'xlsx')
+        contents = self.get_cached_export(key)
+        if contents is not None:
+            return await self.send_chunks(contents)
 
-            with open(filename, 'rb') as fp:
-                chunk = fp.read(4096)
-                self.write(chunk)
-                while len(chunk) == 4096:
-                    chunk = fp.read(4096)
-                    if chunk:
-                        self.write(chunk)
-            return self.finish()
-        finally:
-            shutil.rmtree(tmp)
+        tags = list(project.tags)
+        with tempfile.TemporaryDirectory(prefix='taguette_xlsx_') as tmp:
+            filename = os.path.join(tmp, 'codebook.xlsx')
+
+            await asyncio.get_event_loop().run_in_executor(
+                None,
+                export.codebook_xlsx, tags, filename,
+            )
+            return await self.send_file(key, filename)
 
 
-class ExportCodebookDoc(BaseHandler):
+class ExportCodebookDoc(ExportHandler):
     init_PROM_EXPORT('codebook')
 
     @authenticated
@@ -261,21 +488,21 @@ class ExportCodebookDoc(BaseHandler):
         ext = ext.lower()
         PROM_EXPORT.labels('codebook', ext).inc()
         project, _ = self.get_project(project_id)
-        tags = list(project.tags)
 
-        # Close DB connection to not overflow the connection pool
-        self.close_db_connection()
+        mimetype = convert.html_to_mimetype(ext)
+        key = self.export_key(project, 'codebook', ext)
+        contents = self.get_cached_export(key)
+        if contents is not None:
+            return 'codebook', mimetype, contents
 
-        mimetype, contents = await export.codebook_document(
-            tags,
-            ext,
-            config=self.application.config,
-            locale=self.locale,
+        name, mimetype, contents = await codebook_document(
+            self.application, self.db, self.current_user, self.locale,
+            project.id, ext,
         )
-        return 'codebook', mimetype, contents
+        return name, mimetype, self.cache_export(key, contents)
 
 
-class ExportSqlite(BaseHandler):
+class ExportSqlite(ExportHandler):
     PROM_EXPORT.labels('project', 'sqlite3').inc(0)
 
     @authenticated
@@ -288,6 +515,14 @@ class ExportSqlite(BaseHandler):
             datetime.now(timezone.utc).strftime('%Y-%m-%d'),
             safe_filename(project.name),
         )
+        self.set_header('Content-Type', 'application/vnd.sqlite3')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="%s"' % export_name)
+
+        key = self.export_key(project, 'project', 'sqlite3')
+        contents = self.get_cached_export(key)
+        if contents is not None:
+            return await self.send_chunks(contents)
 
         with tempfile.TemporaryDirectory(
             prefix='taguette_export_',
@@ -313,14 +548,35 @@ class ExportSqlite(BaseHandler):
             self.close_db_connection()
 
             # Send the file
-            self.set_header('Content-Type', 'application/vnd.sqlite3')
+            return await self.send_file(key, filename)
+
+
+class ExportJobDownload(ExportHandler):
+    """Download the result of an export job.
+    """
+    @authenticated
+    async def get(self, project_id, job_id):
+        project, _ = self.get_project(project_id)
+        job = self.application.export_jobs.get(job_id)
+        if job is None or job.project_id != project.id:
+            raise HTTPError(404)
+        if job.status != 'done':
+            raise HTTPError(404)
+        self.close_db_connection()
+
+        self.set_header('Content-Type', job.mimetype)
+        if job.name:
             self.set_header('Content-Disposition',
-                            'attachment; filename="%s"' % export_name)
-            with open(filename, 'rb') as fp:
-                while True:
-                    chunk = fp.read(4096)
-                    self.write(chunk)
-                    if len(chunk) != 4096:
-                        break
-                    await self.flush()
-                return await self.finish()
+                            'attachment; filename="%s.%s"' % (
+                                job.name, job.extension,
+                            ))
+        else:
+            self.set_header('Content-Disposition', 'attachment')
+        self.set_header('Etag', '"%s"' % job.key)
+        if self.check_etag_header():
+            self.set_status(304)
+            return await self.finish()
+
+        return await self.send_chunks(
+            convert.FileContents(open(job.filename, 'rb')),
+        )
@@ -519,6 +519,7 @@ class ProjectDelete(BaseHandler):
         logger.warning("Deleting project %d %r user=%r",
                        project.id, project.name, self.current_user)
         self.db.delete(project)
+        self.application.document_cache.invalidate_project(project.id)
         self.db.commit()
         return self.redirect(self.reverse_url('index'))
 
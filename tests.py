@@ -1,6 +1,8 @@
 import aiohttp
 import asyncio
+import bs4
 import concurrent.futures
+import csv
 from datetime import datetime
 import functools
 import io
@@ -8,25 +10,33 @@ import itertools
 import json
 import logging
 import os
+import prometheus_client
 import random
 import re
+import shutil
 import sqlalchemy
 from sqlalchemy.orm import close_all_sessions
 import string
+import struct
 import tempfile
 import textwrap
 import time
+import tornado.locale
 from tornado.testing import AsyncTestCase, gen_test, AsyncHTTPTestCase
+from tornado.web import HTTPError
 import unittest
 from unittest import mock
 from urllib.parse import urlencode, urlparse
 import uuid
 from xml.etree import ElementTree
+import zipfile
 
 from taguette import exact_version
-from taguette import convert, database, extract, import_codebook, main, \
-    validate, web
-from taguette.web.base import is_next_url_safe
+from taguette import convert, database, export, extract, import_codebook, \
+    main, pool, validate, web
+from taguette.cache import ConversionCache, DocumentCache, ExportCache, \
+    PROM_EXPORT_CACHE
+from taguette.web.base import MultipartParser, is_next_url_safe
 from taguette.utils import sanitize_filename
 
 
@@ -103,8 +113,20 @@ class TestMain(unittest.TestCase):
 class TestConvert(AsyncTestCase):
     config = dict(
         CONVERT_TO_HTML_TIMEOUT=60,
+        HTML_OUT_SIZE_LIMIT=2000000,
+        SANITIZE_ENGINE='single',
     )
 
+    @staticmethod
+    async def to_html(body, content_type, filename, config):
+        with tempfile.TemporaryDirectory(prefix='taguette_test_') as tmp:
+            input_filename = os.path.join(tmp, 'upload')
+            with open(input_filename, 'wb') as fp:
+                fp.write(body)
+            return await convert.to_html(
+                input_filename, content_type, filename, config,
+            )
+
     @gen_test
     async def test_convert_html(self):
         """Tests converting HTML, using BeautifulSoup and Bleach"""
@@ -125,26 +147,435 @@ class TestConvert(AsyncTestCase):
             b'</tbody></table>'
             b'</body></html>\n'
         )
+        for engine in convert.SANITIZE_ENGINES:
+            with mock.patch('tornado.process.Subprocess', object()):
+                html = await self.to_html(
+                    body, 'text/html', 'test.html',
+                    dict(self.config, SANITIZE_ENGINE=engine),
+                )
+            self.assertEqual(
+                html,
+                '<h1>Example</h1><p>This is an example text document.\n'
+                'It should be converted.</p>\n\n'
+                '<p>It has another paragraph <strong>here</strong>, '
+                'images: <img src="/static/missing.png"> '
+                '<img src="/static/missing.png"> '
+                '<img src="/static/missing.png">, and '
+                'links: <a title="here">1</a> '
+                '<a title="/over/there">2</a> '
+                '<a href="http://last/one">3</a></p>\n'
+                '<table><thead><tr><th>Header1</th><th>Another</th></tr>'
+                '</thead><tbody><tr><td>1</td><td>34.9</td><td>2</td>'
+                '<td>98.1</td></tr></tbody></table>'
+            )
+
+            self.assertTrue(convert.is_html_safe(html))
+
+    def test_sanitize_engines(self):
+        """Tests that both sanitize engines give the same output"""
+        documents = [
+            '<p>One &amp; <b>two</b> &lt;three&gt;\r\nfour\rfive</p>',
+            '<div>Block</div><span>inline</span><section><p>x</p></section>',
+            '<p title="a&amp;b">t</p><font color="red">red</font><hr>next',
+            '<pre>\nkept</pre><pre><span>\ndropped</span></pre>',
+            '<pre><!-- c -->\nkept</pre><pre><div>\nkept</div></pre>',
+            '<pre><a>\nlink</a></pre><textarea>\nt</textarea>',
+            '<a href="http://x.org/?a=1&amp;b=2" title="t">1</a>'
+            '<a href="javascript:alert(1)">2</a><a href="rel">3</a>'
+            '<a title=\'say "hi" it\\\'s\' href="mailto:a@b">4</a>'
+            '<a HREF="HTTP://[bad">5</a><a>6<script>x</script></a>',
+            '<img src="x.png" width="3"><br/><table><td>cell<col></table>',
+            '<head><title>T</title><style>p {}</style></head>'
+            '<body onload="x"><script>var a = "<b>";</script>body</body>',
+            '<svg><a xlink:href="y">s</a><style>x</style></svg>'
+            '<math><mi>x</mi></math>',
+            '<ul><li>one<li>two</ul><dl><dt>t<dd>d</dl><q>q</q><del>d</del>',
+            '<select><option>o</select><xmp><b>x</b></xmp>',
+            '&nbsp;\xE9\U0001F600',
+        ]
+        for document in documents:
+            # bleach's output doesn't always parse back the same, 'single'
+            # gives the stable form
+            expected = convert.get_html_body(document, engine='bleach')
+            expected = convert._reparse(expected) or expected
+            html = convert.get_html_body(document, engine='single')
+            self.assertEqual(html, expected)
+            self.assertTrue(convert.is_html_safe(html), html)
+
+        self.assertEqual(
+            convert.get_html_body(
+                '<pre>\na</pre><pre><span>\nb</span></pre>'
+                '<pre><!---->\nc</pre><div>d</div>',
+                engine='single',
+            ),
+            '<pre>a</pre><pre>b</pre><pre>c</pre>\nd',
+        )
+
+        # Documents where bleach's second parse restructures the tree, or
+        # that parse back differently
+        self.assertEqual(
+            convert.get_html_body('<p>a<table><td>b</table>', 'bleach'),
+            '<p>a</p><table><tbody><tr><td>b</td></tr></tbody></table><p></p>',
+        )
+        html = convert.get_html_body('<p>a<table><td>b</table>', 'single')
+        self.assertEqual(
+            html,
+            '<p>a<table><tbody><tr><td>b</td></tr></tbody></table></p>',
+        )
+        self.assertTrue(convert.is_html_safe(html))
+        for document, expected in [
+            ('<h1><font>x<h1><font>', '<h1>x</h1><h1></h1>'),
+            ('<p><li>x', '<p></p><li>x</li>'),
+            ('<svg></svg><pre>\n\nx</pre>', '<pre>x</pre>'),
+        ]:
+            html = convert.get_html_body(document, engine='single')
+            self.assertEqual(html, expected)
+            self.assertTrue(convert.is_html_safe(html))
+
+        # SVG and MathML elements are not HTML, even with the same name
+        documents = [
+            '<p>x<svg><td>y</td></svg></p>',
+            '<ul><li>a<svg><li>b</li></svg></li></ul>',
+            '<ol><li>a<math><mtext><li>b</li></mtext></math></li></ol>',
+            '<h1><svg><foreignObject><h1>x</h1></foreignObject></svg></h1>',
+            '<p><svg><desc><table><td>c</td></table></desc></svg></p>',
+            '<svg><a href="http://x/">l</a><img src="x"><pre>\nq</pre></svg>',
+            '<math><annotation-xml encoding="text/html"><div>z</div>'
+            '</annotation-xml><mi>x<b>y</b></mi></math>',
+        ]
+        for document in documents:
+            expected = convert.get_html_body(document, engine='bleach')
+            html = convert.get_html_body(document, engine='single')
+            self.assertEqual(html, expected)
+            self.assertTrue(convert.is_html_safe(html), html)
+        self.assertEqual(
+            convert.get_html_body('<p>x<svg><td>y</td></svg></p>', 'single'),
+            '<p>xy</p>',
+        )
+
+        with self.assertRaises(ValueError):
+            convert.get_html_body('<p>a</p>', engine='unknown')
+
+    def test_html_safe(self):
+        """Tests recognizing safe HTML"""
+        for html in [
+            '<p>Text &amp; <a href="https://x/">link</a></p>',
+            '<p>a<br/>b</p><img src="/static/missing.png" width="3">',
+            '<pre>code</pre>',
+            '<p>&nbsp;entity</p>',
+            '<p><a title="t" href="#anchor">x</a></p>',
+        ]:
+            self.assertTrue(convert.is_html_safe(html), html)
+        for html in [
+            '<p onclick="alert(1)">a</p>',
+            '<script>alert(1)</script>',
+            '<div>block</div>',
+            '<a href="javascript:alert(1)">x</a>',
+            '<img src="http://tracker/">',
+            '<img>',
+            '<p>a < b</p>',
+        ]:
+            self.assertFalse(convert.is_html_safe(html), html)
+
+    @gen_test
+    async def test_convert_text(self):
+        """Tests converting plain text, Markdown and CSV without Calibre"""
+        with mock.patch('tornado.process.Subprocess', object()):
+            body = await self.to_html(
+                'Caf\xE9 <one>\r\nline two\r\n\r\n\r\nPara\x00 two\n'
+                .encode('latin-1'),
+                'text/plain', 'test.txt', self.config,
+            )
+            self.assertEqual(
+                body,
+                '<p>Caf\xE9 &lt;one&gt;<br>line two</p>\n<p>Para two</p>\n',
+            )
+            self.assertTrue(convert.is_html_safe(body))
+
+            body = await self.to_html(
+                b'name,age\r\n"Smith, J",42\r\nDoe,7\r\n',
+                'text/csv', 'test.csv', self.config,
+            )
+            self.assertEqual(
+                body,
+                '<table><thead><tr><th>name</th><th>age</th></tr></thead>'
+                '<tbody><tr><td>Smith, J</td><td>42</td></tr>\n'
+                '<tr><td>Doe</td><td>7</td></tr>\n</tbody></table>',
+            )
+            self.assertTrue(convert.is_html_safe(body))
+
+            body = await self.to_html(
+                b'Title\n=====\n\n'
+                b'Some *emphasis*, **strong**, snake_case, `code <b>`, '
+                b'[link](https://example.org/?a=1&b=2 "T")  \n'
+                b'[relative](page.html) and \\*not*.\n\n'
+                b'## Sub-heading ##\n\n'
+                b'- one\n- two\n  continued\n\n'
+                b'1. first\n\n   more\n2. second\n\n'
+                b'> quoted\n\n'
+                b'```\nif a < b:\n    pass\n```\n\n'
+                b'<script>alert(1)</script>\n',
+                'text/markdown', 'test.md', self.config,
+            )
+            self.assertEqual(
+                body,
+                '<h1>Title</h1>\n'
+                '<p>Some <em>emphasis</em>, <strong>strong</strong>, '
+                'snake_case, <code>code &lt;b&gt;</code>, '
+                '<a href="https://example.org/?a=1&amp;b=2">link</a><br>'
+                '<a title="page.html">relative</a> and *not*.</p>\n'
+                '<h2>Sub-heading</h2>\n'
+                '<ul><li>one</li><li>two\ncontinued</li></ul>\n'
+                '<ol><li><p>first</p>\n<p>more</p></li>'
+                '<li>second</li></ol>\n'
+                '<blockquote><p>quoted</p>\n</blockquote>\n'
+                '<pre><code>if a &lt; b:\n    pass\n</code></pre>\n'
+                '<p>&lt;script&gt;alert(1)&lt;/script&gt;</p>',
+            )
+            self.assertTrue(convert.is_html_safe(body))
+
+        with self.assertRaises(convert.ConversionError):
+            await self.to_html(
+                b'a\n' * 100, 'text/plain', 'test.txt',
+                dict(self.config, HTML_OUT_SIZE_LIMIT=100),
+            )
+        with self.assertRaises(convert.ConversionError):
+            await self.to_html(
+                b'> *a*\n' * 100, 'text/markdown', 'test.md',
+                dict(self.config, HTML_OUT_SIZE_LIMIT=100),
+            )
+
+        # Deep nesting is limited
+        with mock.patch('tornado.process.Subprocess', object()):
+            body = await self.to_html(
+                b'>' * 2000 + b' quote\n', 'text/markdown', 'test.md',
+                self.config,
+            )
+        self.assertEqual(body.count('<blockquote>'), 16)
+        self.assertIn('<p>' + '&gt;' * 1984 + ' quote</p>', body)
+
+        # Errors reading the header of a CSV file
+        with mock.patch.object(csv.Sniffer, 'sniff', return_value=csv.excel), \
+                mock.patch.object(csv.Sniffer, 'has_header',
+                                  return_value=True):
+            with self.assertRaises(convert.ConversionError):
+                await self.to_html(
+                    b'a' * 200000 + b',b\n1,2\n', 'text/csv', 'test.csv',
+                    self.config,
+                )
+
+    @staticmethod
+    def make_zip(files):
+        fp = io.BytesIO()
+        with zipfile.ZipFile(fp, 'w') as zip:
+            for name, contents in files.items():
+                zip.writestr(name, contents)
+        return fp.getvalue()
+
+    @gen_test
+    async def test_convert_docx(self):
+        """Tests converting DOCX files without Calibre"""
+        def docx(body):
+            return self.make_zip({
+                'word/document.xml': (
+                    '<w:document xmlns:w="http://schemas.openxmlformats.org'
+                    '/wordprocessingml/2006/main" xmlns:r="http://schemas.'
+                    'openxmlformats.org/officeDocument/2006/relationships">'
+                    '<w:body>%s</w:body></w:document>' % body
+                ),
+                'word/styles.xml': (
+                    '<w:styles xmlns:w="http://schemas.openxmlformats.org/'
+                    'wordprocessingml/2006/main"><w:style w:type="paragraph" '
+                    'w:styleId="Titre1"><w:name w:val="heading 1"/>'
+                    '</w:style></w:styles>'
+                ),
+                'word/numbering.xml': (
+                    '<w:numbering xmlns:w="http://schemas.openxmlformats.org'
+                    '/wordprocessingml/2006/main"><w:abstractNum '
+                    'w:abstractNumId="0"><w:lvl w:ilvl="0"><w:numFmt '
+                    'w:val="bullet"/></w:lvl><w:lvl w:ilvl="1"><w:numFmt '
+                    'w:val="decimal"/></w:lvl></w:abstractNum><w:num '
+                    'w:numId="1"><w:abstractNumId w:val="0"/></w:num>'
+                    '</w:numbering>'
+                ),
+                'word/_rels/document.xml.rels': (
+                    '<Relationships xmlns="http://schemas.openxmlformats.org'
+                    '/package/2006/relationships"><Relationship Id="rId5" '
+                    'Target="https://example.org/" TargetMode="External"/>'
+                    '</Relationships>'
+                ),
+            })
+
+        def list_item(level, text):
+            return (
+                '<w:p><w:pPr><w:numPr><w:ilvl w:val="%d"/><w:numId '
+                'w:val="1"/></w:numPr></w:pPr><w:r><w:t>%s</w:t></w:r>'
+                '</w:p>' % (level, text)
+            )
+
+        body = docx(
+            '<w:p><w:pPr><w:pStyle w:val="Titre1"/></w:pPr><w:r><w:t>'
+            'Interview</w:t></w:r></w:p>'
+            '<w:p><w:pPr><w:tabs><w:tab w:pos="720"/></w:tabs></w:pPr>'
+            '<w:r><w:rPr><w:b/></w:rPr><w:t xml:space="preserve">Q: </w:t>'
+            '</w:r><w:r><w:t>What &lt;do&gt; you</w:t></w:r><w:r><w:rPr>'
+            '<w:i/></w:rPr><w:t xml:space="preserve"> think</w:t></w:r>'
+            '<w:r><w:rPr><w:b w:val="0"/></w:rPr><w:tab/><w:t>?</w:t><w:br/>'
+            '</w:r><w:hyperlink r:id="rId5"><w:r><w:t>link</w:t></w:r>'
+            '</w:hyperlink><w:del><w:r><w:delText>deleted</w:delText></w:r>'
+            '</w:del><w:r><w:instrText>PAGE</w:instrText></w:r></w:p><w:p/>'
+            + list_item(0, 'one') + list_item(1, 'nested')
+            + list_item(0, 'two')
+            + '<w:tbl><w:tblGrid/><w:tr><w:tc><w:p><w:r><w:t>cell</w:t>'
+            '</w:r></w:p></w:tc></w:tr></w:tbl>'
+            '<w:p><w:r><w:drawing/><w:t>image</w:t></w:r></w:p>'
+        )
         with mock.patch('tornado.process.Subprocess', object()):
-            body = await convert.to_html(body, 'text/html', 'test.html',
-                                         self.config)
+            html = await self.to_html(
+                body, 'application/octet-stream', 'test.docx', self.config,
+            )
         self.assertEqual(
-            body,
-            '<h1>Example</h1><p>This is an example text document.\n'
-            'It should be converted.</p>\n\n'
-            '<p>It has another paragraph <strong>here</strong>, '
-            'images: <img src="/static/missing.png"> '
-            '<img src="/static/missing.png"> '
-            '<img src="/static/missing.png">, and '
-            'links: <a title="here">1</a> '
-            '<a title="/over/there">2</a> '
-            '<a href="http://last/one">3</a></p>\n'
-            '<table><thead><tr><th>Header1</th><th>Another</th></tr></thead>'
-            '<tbody><tr><td>1</td><td>34.9</td><td>2</td><td>98.1</td></tr>'
-            '</tbody></table>'
-        )
-
-        self.assertTrue(convert.is_html_safe(body))
+            html,
+            '<h1>Interview</h1>\n'
+            '<p><strong>Q: </strong>What &lt;do&gt; you<em> think</em>\t?<br>'
+            '<a href="https://example.org/">link</a></p>\n'
+            '<ul><li>one<ol><li>nested</li></ol>\n</li><li>two</li></ul>\n'
+            '<table><tbody><tr><td><p>cell</p>\n</td></tr>\n</tbody></table>\n'
+            '<p><img src="/static/missing.png">image</p>',
+        )
+        self.assertTrue(convert.is_html_safe(html))
+
+        # Documents with footnotes go through Calibre
+        body = docx(
+            '<w:p><w:r><w:t>Text</w:t></w:r><w:r><w:footnoteReference '
+            'w:id="1"/></w:r></w:p>'
+        )
+
+        async def calibre_to_html(input_filename, temp_dir, config):
+            with open(input_filename, 'rb') as fp:
+                self.assertEqual(fp.read(), body)
+            return '<p>From Calibre</p>'
+
+        with mock.patch.object(convert, 'calibre_to_html', calibre_to_html):
+            html = await self.to_html(
+                body, 'application/octet-stream', 'test.docx', self.config,
+            )
+        self.assertEqual(html, '<p>From Calibre</p>')
+
+        # Output is limited as it is written
+        body = docx('<w:p><w:r><w:t>word</w:t></w:r></w:p>' * 30)
+        config = dict(self.config, HTML_OUT_SIZE_LIMIT=100)
+        with mock.patch.object(convert, 'calibre_to_html', calibre_to_html):
+            with self.assertRaises(convert.ConversionError):
+                await self.to_html(
+                    body, 'application/octet-stream', 'test.docx', config,
+                )
+
+        # Members are limited before they are decompressed
+        body = docx('<w:p><w:r><w:t>word</w:t></w:r></w:p>' + ' ' * 2000)
+        with mock.patch.object(convert, '_docx_body') as docx_body:
+            with self.assertRaises(convert.ConversionError):
+                await self.to_html(
+                    body, 'application/octet-stream', 'test.docx', config,
+                )
+        docx_body.assert_not_called()
+
+    @gen_test
+    async def test_convert_odt(self):
+        """Tests converting ODT files without Calibre"""
+        namespaces = (
+            'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+            'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+            'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+            'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+            'xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0" '
+            'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:'
+            'xsl-fo-compatible:1.0" xmlns:xlink="http://www.w3.org/1999/xlink"'
+        )
+        body = self.make_zip({
+            'styles.xml': (
+                '<office:document-styles %s><office:styles><style:style '
+                'style:name="Emphasis" style:family="text"><style:text-'
+                'properties fo:font-style="italic"/></style:style>'
+                '</office:styles></office:document-styles>' % namespaces
+            ),
+            'content.xml': (
+                '<office:document-content %s><office:automatic-styles>'
+                '<style:style style:name="T1" style:family="text">'
+                '<style:text-properties fo:font-weight="bold"/></style:style>'
+                '<text:list-style style:name="L1"><text:list-level-style-'
+                'bullet text:level="1"/><text:list-level-style-number '
+                'text:level="2"/></text:list-style></office:automatic-styles>'
+                '<office:body><office:text><text:tracked-changes><text:p>'
+                'deleted</text:p></text:tracked-changes>'
+                '<text:h text:outline-level="1">Interview</text:h>\n'
+                '<text:p><text:span text:style-name="T1">Q: </text:span>What '
+                '&lt;do&gt;\n  you<text:span text:style-name="Emphasis"> '
+                'think</text:span><text:tab/>?<text:line-break/><text:a '
+                'xlink:href="https://example.org/">link</text:a></text:p>'
+                '<text:p/><text:list text:style-name="L1"><text:list-item>'
+                '<text:p>one</text:p><text:list><text:list-item><text:p>'
+                'nested</text:p></text:list-item></text:list></text:list-item>'
+                '<text:list-item><text:p>two</text:p></text:list-item>'
+                '</text:list><table:table><table:table-column/><table:table-'
+                'row><table:table-cell><text:p>cell</text:p></table:table-'
+                'cell></table:table-row></table:table><text:p><draw:frame>'
+                '<draw:image/></draw:frame>image</text:p></office:text>'
+                '</office:body></office:document-content>' % namespaces
+            ),
+        })
+        with mock.patch('tornado.process.Subprocess', object()):
+            html = await self.to_html(
+                body, 'application/octet-stream', 'test.odt', self.config,
+            )
+        self.assertEqual(
+            html,
+            '<h1>Interview</h1>\n'
+            '<p><strong>Q: </strong>What &lt;do&gt; you<em> think</em>\t?<br>'
+            '<a href="https://example.org/">link</a></p>\n'
+            '<ul><li>one<ol><li>nested</li></ol>\n</li><li>two</li></ul>\n'
+            '<table><tbody><tr><td><p>cell</p>\n</td></tr>\n</tbody></table>\n'
+            '<p><img src="/static/missing.png">image</p>',
+        )
+        self.assertTrue(convert.is_html_safe(html))
+
+    @gen_test(timeout=30)
+    async def test_sanitize_files(self):
+        """Tests sanitizing Calibre's output files in order"""
+        with tempfile.TemporaryDirectory(prefix='taguette_test_') as tmp:
+            filenames = []
+            for i in range(5):
+                filenames.append(os.path.join(tmp, 'part%d.html' % i))
+                with open(filenames[-1], 'w') as fp:
+                    fp.write('<div class="x"><p>Part %d</p></div>' % i)
+            with mock.patch.object(convert.pool, 'size', lambda: 2):
+                html = await convert.sanitize_files(filenames, self.config)
+                self.assertEqual(
+                    html,
+                    '\n'.join('<p>Part %d</p>' % i for i in range(5)),
+                )
+
+                # The limit applies to the sanitized output
+                config = dict(self.config, HTML_OUT_SIZE_LIMIT=len(html))
+                await convert.sanitize_files(filenames, config)
+                config = dict(self.config, HTML_OUT_SIZE_LIMIT=len(html) - 1)
+                with self.assertRaises(convert.ConversionError):
+                    await convert.sanitize_files(filenames, config)
+
+            # Files waiting for a worker are dropped when the limit is reached,
+            # files being sanitized keep their worker until they are done
+            workers = pool.ProcessPool(1, 5)
+            try:
+                with mock.patch.object(pool, '_pool', workers), \
+                        mock.patch.object(pool, 'size', lambda: 2):
+                    config = dict(self.config, HTML_OUT_SIZE_LIMIT=1)
+                    with self.assertRaises(convert.ConversionError):
+                        await convert.sanitize_files(filenames, config)
+                self.assertEqual(workers._waiting, 0)
+                self.assertEqual(await workers.run(abs, -1), 1)
+                self.assertFalse(workers._slots.locked())
+            finally:
+                workers.shutdown()
 
     def test_filename(self):
         old_windows_flag = sanitize_filename.windows
@@ -185,8 +616,8 @@ class TestConvert(AsyncTestCase):
             b'NOTE style blocks cannot appear after the first cue.\n'
         )
         with mock.patch('tornado.process.Subprocess', object()):
-            body = await convert.to_html(body, 'text/vtt', 'test.vtt',
-                                         self.config)
+            body = await self.to_html(body, 'text/vtt', 'test.vtt',
+                                      self.config)
         self.assertEqual(
             body,
             (
@@ -197,6 +628,217 @@ class TestConvert(AsyncTestCase):
         )
 
 
+class TestPool(AsyncTestCase):
+    @gen_test
+    async def test_inline(self):
+        """Tests running functions in this process."""
+        inline = pool.ProcessPool(0, 0)
+        self.assertEqual(
+            await inline.run(extract.extract, '<p>Hello</p>', 1, 3),
+            '<p>el</p>',
+        )
+
+    @gen_test(timeout=30)
+    async def test_queue(self):
+        """Tests running functions in workers, with a queue limit."""
+        workers = pool.ProcessPool(1, 1)
+        try:
+            self.assertEqual(
+                await workers.run(
+                    extract.highlight,
+                    '<p>Hello</p>', [(1, 3)],
+                    engine='stream',
+                ),
+                '<p>H<span class="highlight">el</span>lo</p>',
+            )
+
+            # One running, one waiting, one rejected
+            running = asyncio.ensure_future(workers.run(time.sleep, 1))
+            await asyncio.sleep(0)
+            waiting = asyncio.ensure_future(workers.run(time.sleep, 0))
+            await asyncio.sleep(0)
+            with self.assertRaises(pool.PoolFull):
+                await workers.run(time.sleep, 0)
+            await running
+            await waiting
+        finally:
+            workers.shutdown()
+
+    @gen_test(timeout=30)
+    async def test_timeout(self):
+        """Tests that a worker that timed out is replaced."""
+        # Leave time for a new worker process to start
+        workers = pool.ProcessPool(1, 1, timeout=3)
+        try:
+            with self.assertRaises(pool.PoolTimeout):
+                await workers.run(time.sleep, 60)
+            self.assertFalse(workers._slots.locked())
+            start = time.perf_counter()
+            self.assertEqual(await workers.run(abs, -1), 1)
+            self.assertLess(time.perf_counter() - start, 3)
+            # Again, the pool doesn't shrink
+            with self.assertRaises(pool.PoolTimeout):
+                await workers.run(time.sleep, 60)
+            self.assertEqual(await workers.run(abs, -2), 2)
+            self.assertEqual(workers._retired, set())
+        finally:
+            workers.shutdown()
+
+    @gen_test(timeout=30)
+    async def test_cancel(self):
+        """Tests that a worker is busy until its cancelled task is done."""
+        workers = pool.ProcessPool(1, 1)
+        try:
+            running = asyncio.ensure_future(workers.run(time.sleep, 1))
+            await asyncio.sleep(0.2)
+            running.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await running
+            self.assertTrue(workers._slots.locked())
+            self.assertEqual(await workers.run(abs, -1), 1)
+            self.assertFalse(workers._slots.locked())
+        finally:
+            workers.shutdown()
+
+    @gen_test(timeout=30)
+    async def test_metrics(self):
+        """Tests that metrics changed in workers are counted."""
+        def get_samples():
+            return (
+                prometheus_client.REGISTRY.get_sample_value(
+                    'html_extract_seconds_count',
+                ),
+                prometheus_client.REGISTRY.get_sample_value(
+                    'html_highlight_engine_total', {'engine': 'stream'},
+                ),
+            )
+
+        workers = pool.ProcessPool(1, 1)
+        try:
+            extracts, highlights = get_samples()
+            await workers.run(extract.extract, '<p>Hello</p>', 1, 3)
+            await workers.run(
+                extract.highlight,
+                '<p>Hello</p>', [(1, 3)],
+                engine='stream',
+            )
+            self.assertEqual(get_samples(), (extracts + 1, highlights + 1))
+        finally:
+            workers.shutdown()
+
+
+class TestScheduler(AsyncTestCase):
+    @gen_test
+    async def test_fair(self):
+        """Tests the order in which waiting conversions run."""
+        scheduler = convert.ConversionScheduler(1)
+        order = []
+
+        async def conversion(name, user, project, priority):
+            with convert.conversion_owner(user, project):
+                async with scheduler.slot(priority):
+                    order.append(name)
+                    await asyncio.sleep(0.01)
+
+        tasks = [
+            asyncio.ensure_future(conversion(name, user, project, priority))
+            for name, user, project, priority in [
+                ('first', 'a', 1, convert.PRIORITY_INTERACTIVE),
+                ('export', 'c', 3, convert.PRIORITY_BULK),
+                ('a1', 'a', 1, convert.PRIORITY_INTERACTIVE),
+                ('a2', 'a', 1, convert.PRIORITY_INTERACTIVE),
+                ('a3', 'a', 2, convert.PRIORITY_INTERACTIVE),
+                ('a4', 'a', 1, convert.PRIORITY_INTERACTIVE),
+                ('b1', 'b', 4, convert.PRIORITY_INTERACTIVE),
+            ]
+        ]
+
+        # Cancel a waiting conversion
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.waiting, 6)
+        tasks[3].cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertEqual(order, ['first', 'a1', 'b1', 'a3', 'a4', 'export'])
+        self.assertEqual(scheduler.running, 0)
+        self.assertEqual(scheduler.waiting, 0)
+
+        # Limit increase starts waiting conversions
+        order = []
+        scheduler.configure(0)
+        tasks = [
+            asyncio.ensure_future(
+                conversion(name, 'a', 1, convert.PRIORITY_INTERACTIVE),
+            )
+            for name in ['one', 'two']
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(order, [])
+        scheduler.configure(2)
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ['one', 'two'])
+
+    @gen_test
+    async def test_strategies(self):
+        """Tests trying conversion strategies in turn, or at once."""
+        history = convert.StrategyHistory()
+        key = history.key('.PDF', 5000000)
+        self.assertEqual(key, ('.pdf', 1))
+        calls = []
+
+        def strategy(name, delay, timeout=False):
+            async def run():
+                calls.append(name)
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    calls.append('cancel ' + name)
+                    raise
+                if timeout:
+                    raise asyncio.TimeoutError
+                return name
+            return name, run
+
+        scheduler = convert.ConversionScheduler(2)
+        with mock.patch.object(convert, 'subprocess_scheduler', scheduler):
+            # The next strategy is used if the first one times out
+            result = await convert.run_strategies(
+                [strategy('heuristics', 0.01, True), strategy('default', 0)],
+                key, history=history,
+            )
+            self.assertEqual(result, 'default')
+            self.assertEqual(calls, ['heuristics', 'default'])
+
+            # Heuristics are failing for this kind of file, run both
+            calls = []
+            result = await convert.run_strategies(
+                [strategy('heuristics', 5), strategy('default', 0.01)],
+                key, history=history,
+            )
+            self.assertEqual(result, 'default')
+            self.assertEqual(
+                calls,
+                ['heuristics', 'default', 'cancel heuristics'],
+            )
+
+            # Without speculation, start with what works
+            calls = []
+            result = await convert.run_strategies(
+                [strategy('heuristics', 0), strategy('default', 0)],
+                key, speculative=False, history=history,
+            )
+            self.assertEqual(result, 'default')
+            self.assertEqual(calls, ['default'])
+
+            # Other kinds of files are not affected
+            calls = []
+            result = await convert.run_strategies(
+                [strategy('heuristics', 0), strategy('default', 0)],
+                history.key('.pdf', 10), history=history,
+            )
+            self.assertEqual(result, 'heuristics')
+            self.assertEqual(calls, ['heuristics'])
+
+
 class TestPassword(AsyncTestCase):
     @staticmethod
     def random_password():
@@ -276,22 +918,147 @@ class TestMeasure(unittest.TestCase):
         self.assertEqual(snippet,
                          '<p>R\xE9mi</p>')
 
+    def test_utf8_offsets(self):
+        """Tests converting UTF-8 byte offsets into string indexes."""
+        for text in ['', 'hello', 'h\xE9\u4E2D\U0001F600!']:
+            encoded = text.encode('utf-8')
+            offsets = extract.Utf8Offsets(text)
+            self.assertEqual(offsets.byte_size(), len(encoded))
+            for byte_index in range(len(encoded) + 2):
+                # Round down: only full codepoints before the offset
+                idx = offsets.str_index(byte_index)
+                self.assertLessEqual(
+                    len(text[:idx].encode('utf-8')), byte_index,
+                )
+                self.assertEqual(
+                    idx,
+                    len(encoded[:byte_index].decode('utf-8', 'ignore')),
+                )
+                # Round up, like split_utf8()
+                idx = offsets.str_index(byte_index, round_up=True)
+                self.assertEqual(
+                    extract.split_utf8(text, byte_index),
+                    (text[:idx], text[idx:]),
+                )
+                self.assertGreaterEqual(
+                    len(text[:idx].encode('utf-8')),
+                    min(byte_index, len(encoded)),
+                )
+        offsets = extract.Utf8Offsets('h\xE9\u4E2D\U0001F600!')
+        self.assertEqual(
+            [offsets.str_index(i) for i in range(12)],
+            [0, 1, 1, 2, 2, 2, 3, 3, 3, 3, 4, 5],
+        )
+        self.assertEqual(
+            [offsets.str_index(i, True) for i in range(12)],
+            [0, 1, 2, 2, 3, 3, 3, 4, 4, 4, 4, 5],
+        )
+
+    def test_extract_index(self):
+        """Tests extracting highlights using the text index."""
+        documents = [
+            '<p><u>H\xE9llo</u> R\xE9mi <i>what is</i> up ?</p>',
+            '<h1>Title</h1>\n<p>a &amp; b&nbsp;c &lt;x&gt; <br> caf\xE9 '
+            '\U0001F600 ok</p><table><tr><td>x</td><td>y &amp;&amp; z</td>'
+            '</tr></table><p></p>',
+            '<p>first</p>\n\n<ul><li>one <strong>two</strong></li>'
+            '<li>three</li></ul><p>x<img src="/static/missing.png">y</p>',
+        ]
+        rand = random.Random(1)
+        for html in documents:
+            index = extract.build_index(html)
+            self.assertTrue(extract.is_index_usable(index))
+            for _ in range(100):
+                start = rand.randint(0, index['length'] - 1)
+                end = rand.randint(start + 1, index['length'])
+                self.assertEqual(
+                    extract.extract(html, start, end, index),
+                    extract.extract(html, start, end),
+                    "start=%d end=%d" % (start, end),
+                )
+
+        # Those can't be indexed
+        for html in [
+            '<p>unclosed',
+            '<p>comment <!-- here --></p>',
+            '<pre>\nleading newline</pre>',
+        ]:
+            self.assertFalse(extract.is_index_usable(
+                extract.build_index(html),
+            ))
+
+    def test_extract_many(self):
+        """Tests extracting many highlights at once."""
+        ranges = [(0, 3), (2, 7), (5, 6), (None, 4), (3, None), (0, 7)]
+        for html in [
+            '<p><u>H\xE9llo</u> R\xE9mi <i>what is</i> up ?</p>',
+            '<p>a &amp; b <!-- comment --> c</p>',
+            '<table><tr><td>x</td><td>y</td></tr></table><p>after</p>',
+        ]:
+            expected = [extract.extract(html, a, b) for a, b in ranges]
+            self.assertEqual(extract.extract_many(html, ranges), expected)
+            self.assertEqual(
+                extract.extract_many(html, ranges, extract.build_index(html)),
+                expected,
+            )
+            self.assertEqual(
+                extract.extract_many(html, ranges[1:2]),
+                expected[1:2],
+            )
+
+    def test_split_chunks(self):
+        """Tests splitting documents into chunks."""
+        def text(html):
+            soup = bs4.BeautifulSoup('<body>' + html, 'html5lib')
+            return soup.body.get_text().encode('utf-8')
+
+        html = (
+            '<h1>T\xEEtle</h1>\n<p>a &amp; b <br> caf\xE9</p>'
+            '<table><tbody><tr><td>x</td></tr></tbody></table>'
+            '<p></p>text<ul><li>one</li><li>two</li></ul>'
+        )
+        self.assertEqual(extract.split_chunks(html), [(0, html)])
+        unusable = {'version': extract.INDEX_VERSION, 'nodes': None}
+        for index in (extract.build_index(html), unusable):
+            chunks = extract.split_chunks(html, index, chunk_size=20)
+            self.assertEqual([offset for offset, _ in chunks], [0, 19, 20])
+            for offset, chunk in chunks:
+                self.assertTrue(text(html)[offset:].startswith(text(chunk)))
+            if index is not unusable:
+                self.assertEqual(''.join(c for _, c in chunks), html)
+
+        # Unsupported by the index, split from the html5lib tree
+        html = '<p>a<!-- x --></p><pre>code</pre><p>b</p>'
+        self.assertEqual(
+            extract.split_chunks(html, chunk_size=1),
+            [
+                (0, '<p>a<!-- x --></p>'),
+                (4, '<pre>code</pre>'),
+                (8, '<p>b</p>'),
+            ],
+        )
+
     def test_highlight(self):
         """Tests highlighting an HTML document with only ASCII characters."""
+        for engine in ('soup', 'stream'):
+            with self.subTest(engine=engine):
+                self._test_highlight(engine)
+
+    def _test_highlight(self, engine):
         html = '<p><u>Hello</u> there <i>World</i></p>'
         highlights = [
             (0, 1, ['tag1']), (2, 3, []),
             (4, 8, ['tag1', 'tag2']), (10, 14, ['tag2']), (15, 17, ['tag1']),
         ]
         self.assertEqual(
-            extract.highlight(html, highlights)
+            extract.highlight(html, highlights, engine=engine)
             .replace('<span class="highlight">', '{')
             .replace('</span>', '}'),
             '<p><u>{H}e{l}l{o}</u>{ th}er{e }<i>{Wo}r{ld}</i></p>',
         )
 
         self.assertEqual(
-            extract.highlight(html, highlights, show_tags=True)
+            extract.highlight(html, highlights, show_tags=True, engine=engine)
             .replace('<span class="taglist"> [', '[')
             .replace(']</span>', ']')
             .replace('<span class="highlight">', '{')
@@ -302,13 +1069,18 @@ class TestMeasure(unittest.TestCase):
 
     def test_highlight_unicode(self):
         """Tests highlighting an HTML document with unicode characters."""
+        for engine in ('soup', 'stream'):
+            with self.subTest(engine=engine):
+                self._test_highlight_unicode(engine)
+
+    def _test_highlight_unicode(self, engine):
         html = '<p><u>H\xE9ll\xF6</u> the\xAEe <i>\u1E84o\xAEld</i>!</p>'
         highlights = [
             (0, 1, ['tag1']), (3, 4, []),
             (6, 10, ['tag1', 'tag2']), (13, 19, ['tag2']), (21, 23, ['tag1']),
         ]
         self.assertEqual(
-            extract.highlight(html, highlights)
+            extract.highlight(html, highlights, engine=engine)
             .replace('<span class="highlight">', '{')
             .replace('</span>', '}'),
             '<p><u>{H}\xE9{l}l{\xF6}</u>{ th}e\xAE'
@@ -316,7 +1088,7 @@ class TestMeasure(unittest.TestCase):
         )
 
         self.assertEqual(
-            extract.highlight(html, highlights, show_tags=True)
+            extract.highlight(html, highlights, show_tags=True, engine=engine)
             .replace('<span class="taglist"> [', '[')
             .replace(']</span>', ']')
             .replace('<span class="highlight">', '{')
@@ -327,6 +1099,11 @@ class TestMeasure(unittest.TestCase):
 
     def test_highlight_nested(self):
         """Test highlighting an HTML document when highlights are nested."""
+        for engine in ('soup', 'stream'):
+            with self.subTest(engine=engine):
+                self._test_highlight_nested(engine)
+
+    def _test_highlight_nested(self, engine):
         html = '<p><u>Hello</u> there <i>World</i></p>'
 
         # Do all the combinations of nesting orders
@@ -338,7 +1115,7 @@ class TestMeasure(unittest.TestCase):
             ]
 
             self.assertEqual(
-                extract.highlight(html, highlights)
+                extract.highlight(html, highlights, engine=engine)
                 .replace('<span class="highlight">', '{')
                 .replace('</span>', '}'),
                 '<p><u>{Hello}</u>{ there }<i>{World}</i></p>',
@@ -359,7 +1136,8 @@ class TestMeasure(unittest.TestCase):
                               'e }<i>{Wo}[tag1, tag2]{r}[]{ld}[tag1]</i></p>',
             }[ends]
             self.assertEqual(
-                extract.highlight(html, highlights, show_tags=True)
+                extract.highlight(html, highlights, show_tags=True,
+                                  engine=engine)
                 .replace('<span class="taglist"> [', '[')
                 .replace(']</span>', ']')
                 .replace('<span class="highlight">', '{')
@@ -368,6 +1146,314 @@ class TestMeasure(unittest.TestCase):
                 "ends=%r" % (ends,),
             )
 
+    def test_highlight_engines(self):
+        """Tests that the highlighting engines give the same output."""
+        documents = [
+            '<p><u>Hello</u> there <i>World</i></p>',
+            '<p><u>H\xE9ll\xF6</u> the\xAEe <i>\u1E84o\xAEld</i>!</p>',
+            '<h1>A &amp; B</h1>\n<p>a&nbsp;b <br> &lt;c&gt; \U0001F600</p>'
+            '<table><tbody><tr><td>x</td></tr></tbody></table>'
+            '<p><a href="https://example.org/?a=1&amp;b=2">link</a> '
+            '<img src="/static/missing.png"></p>',
+        ]
+        rand = random.Random(2)
+        for html in documents:
+            for _ in range(50):
+                highlights = []
+                for _ in range(rand.randint(0, 5)):
+                    start = rand.randint(0, 40)
+                    end = rand.randint(start, 40)
+                    highlights.append((start, end, ['tag1', 'a&b']))
+                for show_tags in (False, True):
+                    self.assertEqual(
+                        extract.highlight(
+                            html, highlights, show_tags, engine='stream',
+                        ),
+                        extract.highlight(
+                            html, highlights, show_tags, engine='soup',
+                        ),
+                        "highlights=%r" % (highlights,),
+                    )
+
+        # No empty highlight for whitespace dropped by the parser
+        for engine in ('soup', 'stream'):
+            self.assertEqual(
+                extract.highlight(
+                    '  <p>leading</p>', [(0, 24, ['tag1'])], engine=engine,
+                ),
+                '<p><span class="highlight">leading</span></p>',
+            )
+
+        # Falls back on soup
+        html = '<table><tr><td>Hello</td></tr></table>'
+        self.assertEqual(
+            extract.highlight(html, [(1, 3)], engine='stream'),
+            '<table><tbody><tr><td>H<span class="highlight">el</span>lo'
+            '</td></tr></tbody></table>',
+        )
+
+
+class TestDocumentCache(unittest.TestCase):
+    def test_lru(self):
+        """Tests the eviction order and size accounting of the cache."""
+        cache = DocumentCache(100)
+        cache.put(1, 1, 'a' * 40, None)
+        cache.put(2, 1, 'b' * 40, None)
+        self.assertEqual(cache.get(1), ('a' * 40, None))
+        cache.put(3, 2, '\xE9' * 20, None)  # 40 bytes
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), ('a' * 40, None))
+        self.assertEqual(cache.size, 80)
+
+        # Too big, not stored
+        cache.put(4, 2, 'd' * 101, None)
+        self.assertIsNone(cache.get(4))
+        self.assertEqual(len(cache), 2)
+
+        cache.invalidate_project(2)
+        self.assertIsNone(cache.get(3))
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.size, 0)
+
+
+class TestConversionCache(AsyncTestCase):
+    def test_eviction(self):
+        """Tests storing and evicting conversions on disk."""
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ConversionCache(tmp, 100)
+            key1 = cache.key(b'one', '.pdf', '1')
+            self.assertNotEqual(key1, cache.key(b'one', '.docx', '1'))
+            self.assertNotEqual(key1, cache.key(b'one', '.pdf', '2'))
+            self.assertIsNone(cache.get(key1))
+            cache.put(key1, 'a' * 40)
+            os.utime(os.path.join(tmp, key1 + '.html'), (1000, 1000))
+            key2 = cache.key(b'two', '.pdf', '1')
+            cache.put(key2, 'b' * 40)
+            os.utime(os.path.join(tmp, key2 + '.html'), (2000, 2000))
+            self.assertEqual(cache.get(key1), 'a' * 40)  # Marks it used
+
+            key3 = cache.key(b'three', '.pdf', '1')
+            cache.put(key3, '\xE9' * 20)  # 40 bytes
+            self.assertIsNone(cache.get(key2))
+            self.assertEqual(cache.get(key1), 'a' * 40)
+            self.assertEqual(cache.get(key3), '\xE9' * 20)
+            self.assertEqual(cache.size, 80)
+
+            # Size is recovered from disk
+            self.assertEqual(ConversionCache(tmp, 100).size, 80)
+
+    @gen_test
+    async def test_convert(self):
+        """Tests that cached conversions are used by to_html_chunks()."""
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ConversionCache(tmp, 1000)
+            body = b'<p>Hello</p>'
+            input_filename = os.path.join(tmp, 'upload')
+            with open(input_filename, 'wb') as fp:
+                fp.write(body)
+            html, _, chunks = await convert.to_html_chunks(
+                input_filename, 'text/html', 'a.html',
+                main.DEFAULT_CONFIG, cache,
+            )
+            self.assertEqual(html, '<p>Hello</p>')
+
+            # Replace the cached version, check it is used
+            version = '%s-%s' % (
+                convert.CONVERTER_VERSION,
+                main.DEFAULT_CONFIG['SANITIZE_ENGINE'],
+            )
+            key = cache.key(body, '.html', version)
+            self.assertEqual(
+                key,
+                cache.file_key(input_filename, '.HTML', version),
+            )
+            with open(os.path.join(tmp, key + '.html'), 'w') as fp:
+                fp.write('<p>Cached</p>')
+            html, _, chunks = await convert.to_html_chunks(
+                input_filename, 'text/html', 'b.HTML',
+                main.DEFAULT_CONFIG, cache,
+            )
+            self.assertEqual(html, '<p>Cached</p>')
+            self.assertEqual(chunks, [(0, '<p>Cached</p>')])
+
+    @gen_test
+    async def test_export(self):
+        """Tests caching exports and serving them again."""
+        calls = []
+
+        async def check_call(cmd, timeout, **kwargs):
+            calls.append(cmd)
+            with open(cmd[2], 'wb') as fp:
+                fp.write(b'exported %d' % len(calls))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ExportCache(tmp, 25)
+            with mock.patch.object(convert, 'check_call', check_call):
+                contents = await convert.calibre_from_html(
+                    '<p>one</p>', 'pdf', main.DEFAULT_CONFIG, cache,
+                )
+                self.assertEqual(b''.join(contents), b'exported 1')
+                etag = contents.etag
+                self.assertIsNotNone(etag)
+
+                # Second export comes from the cache
+                contents = await convert.calibre_from_html(
+                    '<p>one</p>', 'pdf', main.DEFAULT_CONFIG, cache,
+                )
+                self.assertEqual(b''.join(contents), b'exported 1')
+                self.assertEqual(contents.etag, etag)
+                self.assertEqual(len(calls), 1)
+
+                # HTML can be passed in chunks
+                contents = await convert.calibre_from_html(
+                    iter(['<p>o', 'ne</p>']), 'pdf', main.DEFAULT_CONFIG,
+                    cache,
+                )
+                self.assertEqual(b''.join(contents), b'exported 1')
+                self.assertEqual(contents.etag, etag)
+                self.assertEqual(len(calls), 1)
+
+                # Other format or document is converted
+                contents = await convert.calibre_from_html(
+                    '<p>one</p>', 'docx', main.DEFAULT_CONFIG, cache,
+                )
+                self.assertEqual(b''.join(contents), b'exported 2')
+                self.assertNotEqual(contents.etag, etag)
+
+                # Least-recently-used entry was evicted
+                os.utime(os.path.join(tmp, etag + '.export'), (1000, 1000))
+                contents = await convert.calibre_from_html(
+                    '<p>two</p>', 'pdf', main.DEFAULT_CONFIG, cache,
+                )
+                self.assertEqual(b''.join(contents), b'exported 3')
+                self.assertIsNone(cache.open(etag))
+                self.assertEqual(cache.size, 20)
+
+                # Without a cache, there is no ETag
+                contents = await convert.calibre_from_html(
+                    '<p>one</p>', 'pdf', main.DEFAULT_CONFIG,
+                )
+                self.assertEqual(b''.join(contents), b'exported 4')
+                self.assertIsNone(contents.etag)
+            self.assertEqual(
+                [name for name in os.listdir(tempfile.gettempdir())
+                 if name.startswith('taguette_calibre_')],
+                [],
+            )
+
+    def test_export_project(self):
+        """Tests storing project exports, pinning and expiring them."""
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ExportCache(tmp, 25, 100)
+            key1 = cache.project_key(1, 12, 'codebook', ['csv'], 'en', '1')
+            self.assertNotEqual(
+                key1,
+                cache.project_key(1, 13, 'codebook', ['csv'], 'en', '1'),
+            )
+            self.assertNotEqual(
+                key1,
+                cache.project_key(1, 12, 'codebook', ['csv'], 'fr', '1'),
+            )
+
+            # Entry is only added if all the chunks were read
+            chunks = cache.tee(key1, ['one', b' two', ' three'])
+            self.assertEqual(next(iter(chunks)), 'one')
+            chunks.close()
+            self.assertIsNone(cache.open(key1))
+            self.assertEqual(
+                list(cache.tee(key1, ['one', b' two', ' three'])),
+                ['one', b' two', ' three'],
+            )
+            self.assertEqual(cache.size, 13)
+
+            # Pinned entries are not evicted
+            fp = cache.open(key1)
+            key2 = cache.project_key(1, 13, 'codebook', ['csv'], 'en', '1')
+            self.assertEqual(list(cache.tee(key2, [b'x' * 20])), [b'x' * 20])
+            self.assertEqual(cache.size, 33)
+            self.assertEqual(fp.read(), b'one two three')
+            fp.close()
+            key3 = cache.project_key(1, 14, 'codebook', ['csv'], 'en', '1')
+            self.assertEqual(list(cache.tee(key3, [b'y'])), [b'y'])
+            self.assertIsNone(cache.open(key1))
+            self.assertEqual(cache.size, 21)
+
+            # Expired entries are evicted, even if there is room
+            os.utime(os.path.join(tmp, key2 + '.export'), (1000, 1000))
+            cache._last_sweep = 0
+            key4 = cache.project_key(1, 15, 'codebook', ['csv'], 'en', '1')
+            self.assertEqual(list(cache.tee(key4, [b'z'])), [b'z'])
+            self.assertEqual(cache.size, 2)
+            self.assertEqual(
+                sorted(os.listdir(tmp)),
+                sorted([key3 + '.export', key4 + '.export']),
+            )
+
+
+class TestMultipartParser(unittest.TestCase):
+    BODY = (
+        b'preamble\r\n--b0undary\r\n'
+        b'Content-Disposition: form-data; name="name"\r\n\r\n'
+        b'caf\xC3\xA9\r\n--b0undary\r\n'
+        b'Content-Disposition: form-data; name="file"; filename="a.txt"\r\n'
+        b'Content-Type: text/plain\r\n\r\n'
+        b'line\r\n--b0und\r\n\r\n--b0undary\r\n'
+        b'Content-Disposition: form-data; name="empty"\r\n\r\n'
+        b'\r\n--b0undary--\r\nepilogue'
+    )
+
+    def test_parse(self):
+        """Tests parsing a multipart body received in chunks"""
+        for size in (1, 3, 7, 64, len(self.BODY)):
+            with tempfile.TemporaryDirectory() as tmp:
+                parser = MultipartParser(b'"b0undary"', tmp)
+                for pos in range(0, len(self.BODY), size):
+                    parser.feed(self.BODY[pos:pos + size])
+                parser.close()
+                self.assertEqual(
+                    parser.arguments,
+                    {'name': ['caf\xE9'.encode('utf-8')], 'empty': [b'']},
+                )
+                file, = parser.files['file']
+                self.assertEqual(file.filename, 'a.txt')
+                self.assertEqual(file.content_type, 'text/plain')
+                self.assertEqual(file.size, 15)
+                with open(file.path, 'rb') as fp:
+                    self.assertEqual(fp.read(), b'line\r\n--b0und\r\n')
+
+    def test_filename(self):
+        """Tests reading the quoted or encoded filenames of files"""
+        for disposition, filename in [
+            (b'filename="C:\\\\Users\\\\a; b.txt"', 'C:\\Users\\a; b.txt'),
+            (b'filename="say \\"hi\\".txt"', 'say "hi".txt'),
+            (b"filename*=UTF-8''r%C3%A9%20mi.txt", 'r\xE9 mi.txt'),
+        ]:
+            with tempfile.TemporaryDirectory() as tmp:
+                parser = MultipartParser(b'b0undary', tmp)
+                parser.feed(
+                    b'--b0undary\r\n'
+                    b'Content-Disposition: Form-Data; name=file; '
+                    + disposition + b'\r\n\r\n'
+                    b'data\r\n--b0undary--\r\n'
+                )
+                parser.close()
+                file, = parser.files['file']
+                self.assertEqual(file.filename, filename)
+
+    def test_invalid(self):
+        """Tests rejecting truncated or oversized bodies"""
+        with tempfile.TemporaryDirectory() as tmp:
+            parser = MultipartParser(b'b0undary', tmp)
+            parser.feed(self.BODY[:150])
+            with self.assertRaises(HTTPError):
+                parser.close()
+
+            parser = MultipartParser(b'b0undary', tmp)
+            parser.FIELD_SIZE_LIMIT = 3
+            with self.assertRaises(HTTPError):
+                parser.feed(self.BODY)
+
 
 class TestValidate(unittest.TestCase):
     def test_export_filename(self):
@@ -486,6 +1572,81 @@ class TestReadCodebook(unittest.TestCase):
         self.assertEqual(err.exception.row, 3)
 
 
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='taguette_test_')
+        self.db_url = 'sqlite:///' + os.path.join(self.tmp, 'db.sqlite3')
+        self.db = database.connect(self.db_url)()
+        self.project = database.Project(name='p', description='')
+        document = database.Document(
+            name='doc', description='', filename='doc.txt',
+            project=self.project, contents='<p>one two three</p>',
+            text_direction=database.TextDirection.LEFT_TO_RIGHT,
+        )
+        tag = database.Tag(project=self.project, path='t', description='')
+        self.db.add_all([
+            database.Highlight(
+                document=document, start_offset=start, end_offset=start,
+                snippet='%d' % start, snippet_text='%d' % start,
+                tags=[tag],
+            )
+            for start in reversed(range(50))
+        ])
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def write_other_connection(self):
+        """Write to the database from another connection"""
+        other = database.connect(self.db_url)()
+        other.add(database.Tag(
+            project_id=self.project.id, path='new', description='',
+        ))
+        other.commit()
+        other.close()
+
+    def test_highlights_batches(self):
+        """Tests that no cursor is left open between batches of highlights"""
+        with mock.patch.object(export, 'EXPORT_BATCH_SIZE', 5):
+            highlights = export._get_highlights_for_export(
+                self.db, self.project.id, 't',
+            )
+            self.assertEqual(next(highlights)[2], '0')
+
+            # The database can be written to while the export is paused
+            self.write_other_connection()
+
+            self.assertEqual(
+                [hl[2] for hl in highlights],
+                ['%d' % start for start in range(1, 50)],
+            )
+
+    def test_highlights_html(self):
+        """Tests that the database is not used while sending an export"""
+        with mock.patch.object(export, 'EXPORT_BATCH_SIZE', 5), \
+                mock.patch.object(export, 'RENDER_CHUNK_SIZE', 1):
+            mimetype, contents = asyncio.run(export.highlights_doc(
+                self.db, self.project.id, 't', 'html',
+                config=main.DEFAULT_CONFIG,
+                locale=tornado.locale.get('en_US'),
+            ))
+            self.assertEqual(mimetype, 'text/html; charset=utf-8')
+            contents = iter(contents)
+            html = next(contents)
+
+            # The connection was released before sending
+            self.assertFalse(self.db.in_transaction())
+            self.write_other_connection()
+
+            html += ''.join(contents)
+        self.assertEqual(
+            re.findall(r'^    ([0-9]+)$', html, re.MULTILINE),
+            ['%d' % start for start in range(50)],
+        )
+
+
 class MyHTTPTestCase(AsyncHTTPTestCase):
     xsrf = None
 
@@ -522,7 +1683,11 @@ class MyHTTPTestCase(AsyncHTTPTestCase):
         cookies = self.http_client.cookie_jar.filter_cookies(self.get_url('/'))
         if '_xsrf' in cookies:
             token = cookies['_xsrf'].value
-            if 'data' in kwargs:
+            if 'files' in kwargs:
+                # Uploads need the token before the body, like the JS sends it
+                kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                         **{'X-Xsrftoken': token})
+            elif 'data' in kwargs:
                 if isinstance(kwargs['data'], dict):
                     kwargs['data'] = dict(kwargs['data'], _xsrf=token)
             else:
@@ -562,6 +1727,7 @@ async def set_dumb_password(DBSession):
 
 class TestMultiuser(MyHTTPTestCase):
     def get_app(self):
+        self.export_cache_dir = tempfile.TemporaryDirectory()
         self.application = web.make_app(dict(
             main.DEFAULT_CONFIG,
             NAME="Test Taguette instance", PORT=7465,
@@ -574,6 +1740,7 @@ class TestMultiuser(MyHTTPTestCase):
             COOKIES_PROMPT=True,
             MULTIUSER=True,
             SECRET_KEY='2PbQ/5Rs005G/nTuWfibaZTUAo3Isng3QuRirmBK',
+            EXPORT_CACHE_DIR=self.export_cache_dir.name,
         ))
         self.io_loop.run_sync(
             lambda: set_dumb_password(self.application.DBSession)
@@ -585,6 +1752,8 @@ class TestMultiuser(MyHTTPTestCase):
         close_all_sessions()
         engine = sqlalchemy.create_engine(DATABASE_URI)
         database.Base.metadata.drop_all(bind=engine)
+        self.export_cache_dir.cleanup()
+        self.application.export_jobs.close()
 
     @gen_test(timeout=30)
     async def test_login(self):
@@ -859,18 +2028,18 @@ class TestMultiuser(MyHTTPTestCase):
                 file=('/dir/r\xE9 mi.html', 'text/plain', b'content here'),
             ),
         ) as response:
-            self.assertEqual(response.status, 200)
-            self.assertEqual(await response.json(), {"created": 1})
+            self.assertEqual(response.status, 202)
+            job = (await response.json())['job']
+        self.assertEqual(
+            await poll_proj1,
+            {'type': 'document_add', 'id': 3, 'document_id': 1,
+             'text_direction': 'LEFT_TO_RIGHT',
+             'document_name': name, 'description': '', 'job': job})
         db = self.application.DBSession()
         doc = db.query(database.Document).get(1)
         self.assertEqual(doc.name, name)
         self.assertEqual(doc.description, '')
         self.assertEqual(doc.filename, 'ré mi.html')
-        self.assertEqual(
-            await poll_proj1,
-            {'type': 'document_add', 'id': 3, 'document_id': 1,
-             'text_direction': 'LEFT_TO_RIGHT',
-             'document_name': name, 'description': ''})
         poll_proj1 = await self.poll_event(1, 3)
 
         # Create document 2 in project 2
@@ -882,19 +2051,36 @@ class TestMultiuser(MyHTTPTestCase):
                 file=('../otherdoc.html', 'text/plain', b'different content'),
             ),
         ) as response:
-            self.assertEqual(response.status, 200)
-            self.assertEqual(await response.json(), {"created": 2})
+            self.assertEqual(response.status, 202)
+            job = (await response.json())['job']
+        self.assertEqual(
+            await poll_proj2,
+            {'type': 'document_add', 'id': 4, 'document_id': 2,
+             'text_direction': 'LEFT_TO_RIGHT',
+             'document_name': 'otherdoc', 'description': 'Other one',
+             'job': job})
         db = self.application.DBSession()
         doc = db.query(database.Document).get(2)
         self.assertEqual(doc.name, 'otherdoc')
         self.assertEqual(doc.description, 'Other one')
         self.assertEqual(doc.filename, 'otherdoc.html')
-        self.assertEqual(
-            await poll_proj2,
-            {'type': 'document_add', 'id': 4, 'document_id': 2,
-             'text_direction': 'LEFT_TO_RIGHT',
-             'document_name': 'otherdoc', 'description': 'Other one'})
         poll_proj2 = await self.poll_event(2, 4)
+        self.assertEqual(self.application.import_jobs, {})
+
+        # Too many documents being imported
+        with mock.patch.dict(self.application.config,
+                             IMPORT_JOBS_PER_USER=0):
+            async with self.apost(
+                '/api/project/2/document/new',
+                data=dict(name='toomany', description=''),
+                files=dict(file=('toomany.html', 'text/plain', b'content')),
+            ) as response:
+                self.assertEqual(response.status, 429)
+                self.assertEqual(
+                    await response.json(),
+                    {'error': "Too many documents are being imported, wait "
+                              "for them to finish"},
+                )
 
         # Create highlight 1 in document 1
         async with self.apost(
@@ -923,6 +2109,14 @@ class TestMultiuser(MyHTTPTestCase):
              'document_id': 1, 'start_offset': 3, 'end_offset': 7,
              'tags': [], 'tag_count_changes': {}})
         poll_proj1 = await self.poll_event(1, 6)
+        db = self.application.DBSession()
+        doc = db.query(database.Document).get(1)
+        hl = db.query(database.Highlight).get(1)
+        self.assertEqual(hl.snippet, extract.extract(doc.contents, 3, 7))
+        self.assertEqual(
+            hl.snippet_text,
+            convert.html_to_plaintext(hl.snippet),
+        )
 
         # Update highlight 1 in document 1: change tags
         async with self.apost(
@@ -973,13 +2167,14 @@ class TestMultiuser(MyHTTPTestCase):
                 b'<strong>Opinions</strong> and <em>facts</em>!',
             )),
         ) as response:
-            self.assertEqual(response.status, 200)
-            self.assertEqual(await response.json(), {"created": 3})
+            self.assertEqual(response.status, 202)
+            job = (await response.json())['job']
         self.assertEqual(
             await poll_proj2,
             {'type': 'document_add', 'id': 9, 'document_id': 3,
              'text_direction': 'RIGHT_TO_LEFT',
-             'document_name': 'third', 'description': 'Last one'})
+             'document_name': 'third', 'description': 'Last one',
+             'job': job})
         poll_proj2 = await self.poll_event(2, 9)
 
         # Create highlight in document 2, using wrong project id
@@ -1007,6 +2202,16 @@ class TestMultiuser(MyHTTPTestCase):
             self.assertEqual(await response.json(),
                              {"error": "No such tag"})
 
+        # Create highlight in document 2, with the process pool full
+        with mock.patch.object(web.base.BaseHandler, 'get_snippet',
+                               side_effect=pool.PoolFull):
+            async with self.apost(
+                '/api/project/2/document/2/highlight/new',
+                json=dict(start_offset=0, end_offset=4, tags=[4]),
+            ) as response:
+                self.assertEqual(response.status, 503)
+                self.assertEqual(response.reason, "Server is busy")
+
         # Create highlight 2 in document 2
         async with self.apost(
             '/api/project/2/document/2/highlight/new',
@@ -1143,6 +2348,7 @@ class TestMultiuser(MyHTTPTestCase):
                      'tags': [2, 3]},
                 ],
                 'text_direction': 'LEFT_TO_RIGHT',
+                'chunk_offsets': [0],
             })
         async with self.aget('/api/project/2/document/2/contents') as response:
             self.assertEqual(response.status, 200)
@@ -1150,11 +2356,38 @@ class TestMultiuser(MyHTTPTestCase):
                 'contents': [{'contents': 'different content', 'offset': 0}],
             })
             self.assertEqual(response.headers['Etag'], '"doc-2-1"')
+        db = self.application.DBSession()
+        self.assertEqual(
+            [
+                (chunk.start_offset, chunk.contents)
+                for chunk in db.query(database.Document).get(2).chunks
+            ],
+            [(0, 'different content')],
+        )
         async with self.aget(
             '/api/project/2/document/2/contents',
             headers={'If-None-Match': '"doc-2-1"'},
         ) as response:
             self.assertEqual(response.status, 304)
+        async with self.aget(
+            '/api/project/2/document/2/contents?from=0&limit=1',
+        ) as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(await response.json(), {
+                'contents': [{'contents': 'different content', 'offset': 0}],
+            })
+            self.assertEqual(response.headers['Etag'], '"doc-2-1-0-1"')
+        async with self.aget(
+            '/api/project/2/document/2/contents?from=5&limit=1',
+        ) as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(await response.json(), {
+                'contents': [{'contents': 'different content', 'offset': 0}],
+            })
+        async with self.aget(
+            '/api/project/2/document/2/contents?from=-1&limit=0',
+        ) as response:
+            self.assertEqual(response.status, 400)
 
         # Export document 2 to HTML
         async with self.aget('/project/2/export/document/2.html') as response:
@@ -1190,6 +2423,64 @@ class TestMultiuser(MyHTTPTestCase):
                   </body>
                 </html>'''),
             )
+            document_html = await response.text()
+
+        # Export all documents of project 2 to a ZIP file
+        async with self.aget(
+            '/project/2/export/documents.zip?format=dat',
+        ) as response:
+            self.assertEqual(response.status, 404)
+        # A document that can't be exported is replaced by the error,
+        # and the archive is not cached
+        highlighted_document_html = export._highlighted_document_html
+
+        async def failing_html(name, *args, **kwargs):
+            if name == 'third':
+                raise convert.ConversionError("Test error")
+            return await highlighted_document_html(name, *args, **kwargs)
+
+        with mock.patch.object(export, '_highlighted_document_html',
+                               failing_html):
+            async with self.aget(
+                '/project/2/export/documents.zip',
+            ) as response:
+                self.assertEqual(response.status, 200)
+                data = await response.read()
+        with zipfile.ZipFile(io.BytesIO(data)) as zip:
+            self.assertEqual(
+                sorted(zip.namelist()),
+                ['otherdoc.html', 'third.error.txt'],
+            )
+            self.assertEqual(
+                zip.read('third.error.txt'),
+                b'Conversion error: Test error\n',
+            )
+
+        async with self.aget('/project/2/export/documents.zip') as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.headers['Content-Type'],
+                             'application/zip')
+            self.assertEqual(
+                response.headers['Content-Disposition'],
+                'attachment; filename="new project_documents.zip"',
+            )
+            data = await response.read()
+            with zipfile.ZipFile(io.BytesIO(data)) as zip:
+                self.assertEqual(
+                    sorted(zip.namelist()),
+                    ['otherdoc.html', 'third.html'],
+                )
+                # Entries have Zip64 local headers, since their size is not
+                # known when they are started
+                offset = zip.getinfo('otherdoc.html').header_offset
+                self.assertEqual(
+                    data[offset + 4:offset + 6],
+                    struct.pack('<H', zipfile.ZIP64_VERSION),
+                )
+                self.assertEqual(
+                    zip.read('otherdoc.html').decode('utf-8'),
+                    document_html,
+                )
 
         # Export document 2 to unknown format
         async with self.aget('/project/2/export/document/2.dat') as response:
@@ -1292,7 +2583,24 @@ class TestMultiuser(MyHTTPTestCase):
                     </html>'''),
             )
 
-        # Export highlights in project 2 under 'interesting' to CSV
+        # Export highlights in project 2 under 'interesting' to CSV, one
+        # highlight per chunk
+        db = self.application.DBSession()
+        with mock.patch.object(export, 'EXPORT_BATCH_SIZE', 1):
+            chunks = list(export.highlights_csv(db, 2, 'interesting'))
+        db.close()
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(chunks[1].startswith('3,otherdoc,interesting,'))
+
+        # Highlights without a stored plain-text version still get exported
+        db = self.application.DBSession()
+        db.execute(
+            database.Highlight.__table__.update()
+            .where(database.Highlight.id == 3)
+            .values(snippet_text=None)
+        )
+        db.commit()
+        db.close()
         async with self.aget(
             '/project/2/export/highlights/interesting.csv',
         ) as response:
@@ -1307,6 +2615,24 @@ class TestMultiuser(MyHTTPTestCase):
                 ''').replace('\n', '\r\n'),
             )
 
+        # Export highlights in project 2 under 'interesting' to Excel
+        async with self.aget(
+            '/project/2/export/highlights/interesting.xlsx',
+        ) as response:
+            self.assertEqual(response.status, 200)
+            with zipfile.ZipFile(io.BytesIO(await response.read())) as zip:
+                sheet = zip.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        # Constant memory mode writes strings inline, in order
+        self.assertEqual(
+            re.findall(r'<t[^>]*>([^<]*)</t>', sheet),
+            [
+                'id', 'document', 'tag', 'content',
+                '2', 'otherdoc', 'interesting\\places', 'diff',
+                '3', 'otherdoc', 'interesting', 'tent',
+                '3', 'otherdoc', 'people', 'tent',
+            ],
+        )
+
         # Export highlights in project 2 under 'interesting\places' to CSV
         async with self.aget(
             '/project/2/export/highlights/interesting%5C.csv',
@@ -1321,21 +2647,37 @@ class TestMultiuser(MyHTTPTestCase):
             )
 
         # Export codebook of project 2 to CSV
+        codebook_csv = textwrap.dedent('''\
+            tag,description,number of highlights,number of documents
+            interesting,Further review required,1,1
+            people,People of interest,2,2
+            interesting\\places,,1,1
+            ''').replace('\n', '\r\n')
         async with self.aget('/project/2/export/codebook.csv') as response:
             self.assertEqual(response.status, 200)
             self.assertEqual(
                 response.headers['Content-Type'],
                 'text/csv; charset=utf-8',
             )
-            self.assertEqual(
-                await response.text(),
-                textwrap.dedent('''\
-                    tag,description,number of highlights,number of documents
-                    interesting,Further review required,1,1
-                    people,People of interest,2,2
-                    interesting\\places,,1,1
-                    ''').replace('\n', '\r\n'),
-            )
+            self.assertEqual(await response.text(), codebook_csv)
+            codebook_etag = response.headers['Etag']
+
+        # Export it again, from the cache
+        hits = PROM_EXPORT_CACHE.labels('hit')._value.get()
+        async with self.aget('/project/2/export/codebook.csv') as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(await response.text(), codebook_csv)
+            self.assertEqual(response.headers['Etag'], codebook_etag)
+        self.assertEqual(
+            PROM_EXPORT_CACHE.labels('hit')._value.get(),
+            hits + 1,
+        )
+        async with self.aget(
+            '/project/2/export/codebook.csv',
+            headers={'If-None-Match': codebook_etag},
+        ) as response:
+            self.assertEqual(response.status, 304)
+            self.assertEqual(await response.read(), b'')
 
         # Export codebook of project 2 to HTML
         async with self.aget('/project/2/export/codebook.html') as response:
@@ -1372,6 +2714,81 @@ class TestMultiuser(MyHTTPTestCase):
                       </body>
                     </html>'''),
             )
+            codebook_html = await response.text()
+
+        # Export it in the background
+        async with self.apost(
+            '/api/project/2/export',
+            json=dict(kind='codebook', extension='pdf2'),
+        ) as response:
+            self.assertEqual(response.status, 400)
+            self.assertEqual(await response.json(),
+                             {'error': "Unsupported format"})
+        async with self.apost(
+            '/api/project/2/export',
+            json=dict(kind='document', extension='html'),
+        ) as response:
+            self.assertEqual(response.status, 400)
+            self.assertEqual(await response.json(),
+                             {'error': "Missing document"})
+        for body, error in [
+            (['codebook'], "Invalid export"),
+            (dict(kind='codebook', extension=3), "Unsupported format"),
+            (dict(kind='highlights', extension='html', path=[]),
+             "Invalid tag path"),
+            (dict(kind='document', extension='html', document_id=[2]),
+             "Invalid document"),
+        ]:
+            async with self.apost(
+                '/api/project/2/export', json=body,
+            ) as response:
+                self.assertEqual(response.status, 400)
+                self.assertEqual(await response.json(), {'error': error})
+        with mock.patch.object(self.application.export_jobs, 'max_running',
+                               0):
+            async with self.apost(
+                '/api/project/2/export',
+                json=dict(kind='codebook', extension='html'),
+            ) as response:
+                self.assertEqual(response.status, 429)
+        async with self.apost(
+            '/api/project/2/export',
+            json=dict(kind='codebook', extension='html'),
+        ) as response:
+            self.assertEqual(response.status, 200)
+            job = await response.json()
+        self.assertEqual(job['status'], 'running')
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            async with self.aget(
+                '/api/project/2/export/%s' % job['job'],
+            ) as response:
+                self.assertEqual(response.status, 200)
+                status = await response.json()
+            if status['status'] != 'running':
+                break
+        self.assertEqual(status, {
+            'job': job['job'],
+            'status': 'done',
+            'url': '/project/2/export/job/%s' % job['job'],
+        })
+        async with self.aget(status['url']) as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(
+                response.headers['Content-Disposition'],
+                'attachment; filename="codebook.html"',
+            )
+            self.assertEqual(await response.text(), codebook_html)
+        async with self.apost(
+            '/api/project/2/export',
+            json=dict(kind='codebook', extension='html'),
+        ) as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(await response.json(), status)
+        async with self.aget(
+            '/api/project/1/export/%s' % job['job'],
+        ) as response:
+            self.assertEqual(response.status, 404)
 
         # Export codebook of project 2 to REFI-QDA
         async with self.aget('/project/2/export/codebook.qdc') as response:
@@ -1429,6 +2846,22 @@ class TestMultiuser(MyHTTPTestCase):
         )
         poll_proj2 = await self.poll_event(2, 15)
 
+        # Codebook changed
+        async with self.aget(
+            '/project/2/export/codebook.csv',
+            headers={'If-None-Match': codebook_etag},
+        ) as response:
+            self.assertEqual(response.status, 200)
+            self.assertNotEqual(response.headers['Etag'], codebook_etag)
+            self.assertEqual(
+                await response.text(),
+                textwrap.dedent('''\
+                    tag,description,number of highlights,number of documents
+                    interesting,Further review required,2,2
+                    interesting\\places,,1,1
+                    ''').replace('\n', '\r\n'),
+            )
+
         # List all highlights in project 2
         async with self.aget('/api/project/2/highlights/') as response:
             self.assertEqual(response.status, 200)
@@ -1445,6 +2878,21 @@ class TestMultiuser(MyHTTPTestCase):
                 'pages': 1,
             })
 
+        # Upload a document that can't be converted
+        async with self.apost(
+            '/api/project/2/document/new',
+            data=dict(name='noext', description=''),
+            files=dict(file=('noext', 'text/plain', b'content')),
+        ) as response:
+            self.assertEqual(response.status, 202)
+            job = (await response.json())['job']
+        self.assertEqual(
+            await poll_proj2,
+            {'type': 'document_import_failed', 'id': 16, 'job': job,
+             'error': "This file doesn't have an extension!"},
+        )
+        poll_proj2 = await self.poll_event(2, 16)
+
         # TODO: Collaborators
 
         await asyncio.sleep(2)
@@ -1683,6 +3131,64 @@ class TestMultiuser(MyHTTPTestCase):
             for rows in (first, second)
         ])
 
+    @gen_test
+    async def test_upload_limits(self):
+        self.application.config['UPLOAD_SIZE_LIMIT'] = 1000
+
+        # Log in
+        async with self.apost('/cookies', data=dict()) as response:
+            self.assertEqual(response.status, 303)
+        async with self.aget('/login') as response:
+            self.assertEqual(response.status, 200)
+        async with self.apost(
+            '/login',
+            data=dict(next='/', login='admin', password='hackme'),
+        ) as response:
+            self.assertEqual(response.status, 303)
+
+        # File too big
+        async with self.apost(
+            '/api/project/1/document/new',
+            data=dict(name='big', description=''),
+            files=dict(file=('big.txt', 'text/plain', b'a' * 2000)),
+        ) as response:
+            self.assertEqual(response.status, 413)
+            self.assertEqual(await response.json(),
+                             {'error': "This file is too big"})
+
+        # XSRF token missing from the body
+        data = aiohttp.FormData()
+        data.add_field('name', 'doc')
+        data.add_field('description', '')
+        data.add_field('file', b'text', filename='doc.txt')
+        async with self._fetch(
+            '/api/project/1/document/new', method='POST', data=data,
+        ) as response:
+            self.assertEqual(response.status, 403)
+
+        # XSRF token in the body, the upload is rejected before reading it
+        cookies = self.http_client.cookie_jar.filter_cookies(self.get_url('/'))
+        rejected = web.base.PROM_UPLOAD_REJECTED.labels('xsrf')._value.get()
+        data = aiohttp.FormData()
+        data.add_field('_xsrf', cookies['_xsrf'].value)
+        data.add_field('name', 'doc')
+        data.add_field('description', '')
+        data.add_field('file', b'text', filename='doc.txt')
+        async with self._fetch(
+            '/api/project/1/document/new', method='POST', data=data,
+        ) as response:
+            self.assertEqual(response.status, 403)
+        self.assertEqual(
+            web.base.PROM_UPLOAD_REJECTED.labels('xsrf')._value.get(),
+            rejected + 1,
+        )
+
+        # The uploaded file was removed
+        self.assertFalse([
+            name for name in os.listdir(tempfile.gettempdir())
+            if name.startswith('taguette_upload_')
+        ])
+
     @with_tempdir
     @gen_test
     async def test_import(self, tmp):
@@ -1709,6 +3215,10 @@ class TestMultiuser(MyHTTPTestCase):
         db2 = database.connect('sqlite:///' + db2_path)()
         db2.add(database.User(login='admin'))
         await self.make_basic_db(db2, 2)
+        db2.execute(
+            database.Highlight.__table__.update()
+            .values(snippet_text='not the snippet')
+        )
         db2.commit()
 
         # List projects in database
@@ -1787,6 +3297,16 @@ class TestMultiuser(MyHTTPTestCase):
                 (8, 'db2doc12.txt'),
             ],
         )
+        # The plain-text version of snippets is not imported
+        self.assertEqual(
+            {row[0] for row in db1.execute(
+                sqlalchemy.select([
+                    database.Highlight.__table__.c.snippet_text,
+                ])
+                .where(database.Highlight.__table__.c.document_id.in_([7, 8]))
+            )},
+            {None},
+        )
         self.assertRowsEqualsExceptDates(
             db1.execute(
                 database.Command.__table__.select()